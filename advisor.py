@@ -0,0 +1,409 @@
+import argparse                 # Command line options
+import json                     # Read and write exported statistics
+import re                       # Parse CREATE TABLE statements and workload queries
+from sql_queries import create_table_queries, analytical_queries    # Current table designs and default workload
+
+"""
+  Words that can follow a table name in a FROM clause but are not an alias
+"""
+NOT_ALIASES = {'on', 'inner', 'left', 'right', 'full', 'cross', 'join', 'where', 'group', 'order', 'limit', 'natural'}
+
+"""
+  KEY distribution is only considered for columns with at least this many distinct values per slice;
+    fewer values leave some slices with far more rows than others
+"""
+MIN_DISTINCT_PER_SLICE = 10
+
+"""
+Purpose:
+    Splits text on commas that are not inside parentheses
+    e.g. column definitions containing IDENTITY(1, 1)
+Arg:
+    text - text to split [Required]
+"""
+def split_top_level(text):
+    parts, depth, current = [], 0, ''
+    for char in text:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == ',' and depth == 0:
+            parts.append(current)
+            current = ''
+        else:
+            current += char
+    parts.append(current)
+    return parts
+
+"""
+Purpose:
+    Reads table name, columns, and current distribution and sort keys from a CREATE TABLE statement
+Arg:
+    create_sql - CREATE TABLE statement defined in sql_queries file [Required]
+Returns:
+    dict with 'name', 'columns' (list of (name, definition) pairs), 'attributes' (text after the column list),
+      and 'design' (dict with 'style', 'distkey', 'sortkey', 'sort_style')
+"""
+def parse_create(create_sql):
+    match = re.search(r'CREATE TABLE\s+(\w+)\s*\(', create_sql, re.IGNORECASE)
+    start = match.end()
+    depth = 1
+    for end in range(start, len(create_sql)):
+        depth += {'(': 1, ')': -1}.get(create_sql[end], 0)
+        if depth == 0:
+            break
+
+    columns = []
+    distkey, sortkey = None, []
+    for definition in split_top_level(create_sql[start:end]):
+        definition = ' '.join(definition.split())
+        name = definition.split(' ')[0].lower()
+        if re.search(r'\bDISTKEY\b', definition, re.IGNORECASE):
+            distkey = name
+        if re.search(r'\bSORTKEY\b', definition, re.IGNORECASE):
+            sortkey.append(name)
+        columns.append((name, definition))
+
+    attributes = ' '.join(create_sql[end + 1:].split()).rstrip(';').strip()
+    style = re.search(r'DISTSTYLE\s+(\w+)', attributes, re.IGNORECASE)
+    style = style.group(1).upper() if style else ('KEY' if distkey else 'AUTO')
+    return {'name': match.group(1).lower(), 'columns': columns, 'attributes': attributes,
+            'design': {'style': style, 'distkey': distkey, 'sortkey': sortkey, 'sort_style': 'COMPOUND'}}
+
+"""
+Purpose:
+    Reads a workload file of SQL queries separated by semicolons
+    A '-- weight: N' comment before a query counts it N times, e.g. to reflect how often a dashboard runs it
+Arg:
+    path - workload file path, e.g. an exported query log [Required]
+Returns:
+    list of (query, weight) pairs
+"""
+def read_workload(path):
+    with open(path) as f:
+        text = f.read()
+    workload = []
+    for statement in text.split(';'):
+        weight = re.search(r'--\s*weight:\s*([\d.]+)', statement, re.IGNORECASE)
+        statement = re.sub(r'--[^\n]*', '', statement).strip()
+        if statement:
+            workload.append((statement, float(weight.group(1)) if weight else 1.0))
+    return workload
+
+"""
+Purpose:
+    Extracts the joins, group by columns, and filter columns a query uses
+    Handles comma and JOIN syntax with table aliases, which covers the README queries and typical dashboard SQL
+Arg:
+    query - SQL query [Required]
+    tables - dict of table name to parsed table from parse_create() [Required]
+Returns:
+    dict with 'joins' (list of ((table, column), (table, column))), 'group_by' and 'filters' (lists of (table, column))
+"""
+def analyze_query(query, tables):
+    sql = ' '.join(re.sub(r'--[^\n]*', '', query).lower().replace('<br>', ' ').split())
+
+    # Tables and aliases in the FROM clause
+    aliases = {}
+    from_clause = re.search(r'\bfrom\s+(.*?)(?=\bwhere\b|\bgroup by\b|\border by\b|\blimit\b|\bhaving\b|$)', sql)
+    if from_clause:
+        for ref in re.split(r',|\bjoin\b', from_clause.group(1)):
+            words = re.sub(r'\bon\b.*', '', ref).replace(' as ', ' ').split()
+            words = [w for w in words if w not in NOT_ALIASES]
+            if words and words[0] in tables:
+                aliases[words[0]] = words[0]
+                if len(words) > 1:
+                    aliases[words[1]] = words[0]
+    query_tables = set(aliases.values())
+
+    def resolve(ref):
+        if '.' in ref:
+            alias, column = ref.split('.', 1)
+            return (aliases[alias], column) if alias in aliases else None
+        owners = [t for t in query_tables if ref in dict(tables[t]['columns'])]
+        return (owners[0], ref) if len(owners) == 1 else None
+
+    joins = []
+    for left, right in re.findall(r'([\w.]+)\s*=\s*([\w.]+)', sql):
+        left, right = resolve(left), resolve(right)
+        if left and right and left[0] != right[0]:
+            joins.append((left, right))
+
+    group_by = []
+    clause = re.search(r'\bgroup by\s+(.*?)(?=\border by\b|\blimit\b|\bhaving\b|$)', sql)
+    if clause:
+        group_by = [c for c in (resolve(ref.strip(' ;')) for ref in clause.group(1).split(',')) if c]
+
+    filters = []
+    clause = re.search(r'\bwhere\s+(.*?)(?=\bgroup by\b|\border by\b|\blimit\b|\bhaving\b|$)', sql)
+    if clause:
+        for ref, op in re.findall(r'([\w.]+)\s*(=|<=|>=|<|>|\bbetween\b|\bin\b)', clause.group(1)):
+            column = resolve(ref)
+            if column and not any(column in join for join in joins):
+                filters.append(column)
+    return {'joins': joins, 'group_by': group_by, 'filters': filters}
+
+"""
+Purpose:
+    Estimates rows moved between slices for one query under a given design
+    Joins: nothing moves if either side is ALL or both sides are distributed on the join columns;
+      if one side is, the other is redistributed; otherwise the cheaper of broadcasting the smaller
+      side to every slice or redistributing both sides
+    Group by: nothing moves if the table is distributed on a group by column; otherwise each slice
+      sends its partial aggregates, bounded by the table rows
+Arg:
+    usage - dict returned by analyze_query() [Required]
+    designs - dict of table name to design [Required]
+    stats - exported statistics [Required]
+"""
+def query_movement(usage, designs, stats):
+    slices = stats['slices']
+    rows = lambda t: stats['tables'][t]['rows']
+    on_key = lambda t, c: designs[t]['style'] == 'KEY' and designs[t]['distkey'] == c
+
+    moved = 0
+    for (t1, c1), (t2, c2) in usage['joins']:
+        if t1 not in designs or t2 not in designs:
+            continue
+        if 'ALL' in (designs[t1]['style'], designs[t2]['style']) or (on_key(t1, c1) and on_key(t2, c2)):
+            continue
+        if on_key(t1, c1):
+            moved += rows(t2)
+        elif on_key(t2, c2):
+            moved += rows(t1)
+        else:
+            moved += min(rows(t1) + rows(t2), min(rows(t1), rows(t2)) * slices)
+
+    by_table = {}
+    for table, column in usage['group_by']:
+        if table in designs:
+            by_table.setdefault(table, []).append(column)
+    for table, columns in by_table.items():
+        if designs[table]['style'] == 'ALL' or any(on_key(table, c) for c in columns):
+            continue
+        distinct = max(stats['tables'][table]['columns'].get(c, rows(table)) for c in columns)
+        moved += min(rows(table), distinct * slices)
+    return moved
+
+"""
+Purpose:
+    Estimates rows copied per load by a design; ALL distribution writes a full copy of the table to every node
+Arg:
+    designs - dict of table name to design [Required]
+    stats - exported statistics [Required]
+"""
+def load_movement(designs, stats):
+    return sum(stats['tables'][t]['rows'] * (stats['nodes'] - 1)
+               for t, d in designs.items() if d['style'] == 'ALL' and t in stats['tables'])
+
+"""
+Purpose:
+    Total estimated data movement of a design: workload queries plus loads
+Arg:
+    designs - dict of table name to design [Required]
+    workload - list of (usage, weight) pairs [Required]
+    stats - exported statistics [Required]
+    loads - number of loads per workload period, e.g. 1 for a nightly load against a day of queries [Required]
+"""
+def design_cost(designs, workload, stats, loads):
+    return sum(weight * query_movement(usage, designs, stats) for usage, weight in workload) + loads * load_movement(designs, stats)
+
+"""
+Purpose:
+    Lists the distribution styles worth trying for a table: ALL, EVEN, and KEY on every join or
+      group by column with enough distinct values to spread rows evenly across slices
+    The current distribution comes first, so it wins ties and is only replaced by a cheaper design
+Arg:
+    table - table name [Required]
+    workload - list of (usage, weight) pairs [Required]
+    stats - exported statistics [Required]
+    current - current design of the table [Required]
+"""
+def distribution_candidates(table, workload, stats, current):
+    candidates = [{'style': 'ALL', 'distkey': None}, {'style': 'EVEN', 'distkey': None}]
+    columns = []
+    if current['distkey']:
+        columns.append(current['distkey'])
+    for usage, _ in workload:
+        for t, c in [ref for join in usage['joins'] for ref in join] + usage['group_by']:
+            if t == table and c not in columns:
+                columns.append(c)
+    min_distinct = stats['slices'] * MIN_DISTINCT_PER_SLICE
+    for column in columns:
+        if stats['tables'][table]['columns'].get(column, 0) >= min_distinct:
+            candidates.append({'style': 'KEY', 'distkey': column})
+    first = [c for c in candidates if (c['style'], c['distkey']) == (current['style'], current['distkey'])]
+    return first + [c for c in candidates if c not in first]
+
+"""
+Purpose:
+    Picks sort keys for a table from how the workload filters and joins it
+    Columns filtered on are ranked by weighted use; when two or more are each used on their own in
+      different queries with similar weight, an INTERLEAVED sort key serves them all, otherwise COMPOUND
+    Without filters, a KEY distributed table is sorted on its distribution key so joins on it can merge
+    Otherwise the current sort key is kept
+Arg:
+    table - table name [Required]
+    design - chosen distribution of the table [Required]
+    workload - list of (usage, weight) pairs [Required]
+    current - current design of the table [Required]
+Returns:
+    tuple of (sort style, list of sort key columns)
+"""
+def sort_key(table, design, workload, current):
+    weights, queries = {}, {}
+    for i, (usage, weight) in enumerate(workload):
+        for t, c in usage['filters']:
+            if t == table:
+                weights[c] = weights.get(c, 0) + weight
+                queries.setdefault(c, set()).add(i)
+    if weights:
+        ranked = sorted(weights, key=lambda c: -weights[c])[:3]
+        top = weights[ranked[0]]
+        independent = [c for c in ranked if weights[c] >= top / 2 and queries[c] - queries[ranked[0]]]
+        if independent:
+            return 'INTERLEAVED', ranked
+        return 'COMPOUND', ranked
+    if design['style'] == 'KEY':
+        return 'COMPOUND', [design['distkey']]
+    return current['sort_style'], current['sortkey']
+
+"""
+Purpose:
+    Finds the lowest cost design by coordinate descent: starting from the current design, each table in
+      turn switches to its cheapest distribution with the other tables fixed, until nothing changes
+Arg:
+    tables - dict of table name to parsed table [Required]
+    workload - list of (usage, weight) pairs [Required]
+    stats - exported statistics [Required]
+    loads - number of loads per workload period [Required]
+Returns:
+    tuple of (best designs, dict of table name to candidates ranked by total cost with other tables at their best)
+"""
+def recommend(tables, workload, stats, loads):
+    modeled = [t for t in tables if t in stats['tables']]
+    designs = {t: dict(tables[t]['design']) for t in modeled}
+    candidates = {t: distribution_candidates(t, workload, stats, tables[t]['design']) for t in modeled}
+
+    for _ in range(10):
+        changed = False
+        for table in modeled:
+            best = min(candidates[table], key=lambda c: design_cost(dict(designs, **{table: dict(designs[table], **c)}), workload, stats, loads))
+            if (best['style'], best['distkey']) != (designs[table]['style'], designs[table]['distkey']):
+                designs[table] = dict(designs[table], **best)
+                changed = True
+        if not changed:
+            break
+
+    ranking = {}
+    for table in modeled:
+        scored = []
+        for c in candidates[table]:
+            design = dict(designs[table], **c)
+            design['sort_style'], design['sortkey'] = sort_key(table, design, workload, tables[table]['design'])
+            scored.append((design_cost(dict(designs, **{table: design}), workload, stats, loads), design))
+        ranking[table] = sorted(scored, key=lambda s: s[0])
+        designs[table] = ranking[table][0][1]
+    return designs, ranking
+
+"""
+Purpose:
+    Writes a CREATE TABLE statement for a table with the given design
+    Column level DISTKEY/SORTKEY markers and the DISTSTYLE clause are replaced by table level attributes;
+      other attributes such as BACKUP NO are kept
+Arg:
+    table - parsed table from parse_create() [Required]
+    design - design to apply [Required]
+"""
+def render_create(table, design):
+    columns = [re.sub(r'\s*\b(DISTKEY|SORTKEY)\b', '', definition, flags=re.IGNORECASE) for _, definition in table['columns']]
+    attributes = re.sub(r'\s*DISTSTYLE\s+\w+', '', table['attributes'], flags=re.IGNORECASE).strip()
+    attributes = (attributes + ' ' if attributes else '') + 'DISTSTYLE ' + design['style']
+    if design['style'] == 'KEY':
+        attributes += ' DISTKEY({})'.format(design['distkey'])
+    if design['sortkey']:
+        attributes += ' {} SORTKEY({})'.format(design['sort_style'], ', '.join(design['sortkey']))
+    return "CREATE TABLE {}({})\n{};".format(table['name'], '\n  , '.join(columns), attributes)
+
+"""
+Purpose:
+    Exports the statistics the advisor needs from a live cluster: row counts and distinct values per column
+    Run once against the cluster; the advisor itself only reads the exported file
+Arg:
+    cur - Redshift connection cursor [Required]
+    tables - dict of table name to parsed table [Required]
+"""
+def export_stats(cur, tables):
+    cur.execute("SELECT count(*) FROM stv_slices;")
+    slices = cur.fetchone()[0]
+    cur.execute("SELECT count(DISTINCT node) FROM stv_slices;")
+    stats = {'slices': slices, 'nodes': cur.fetchone()[0], 'tables': {}}
+    for name, table in tables.items():
+        columns = [c for c, _ in table['columns']]
+        cur.execute("SELECT count(*), {} FROM {};".format(', '.join('count(DISTINCT {})'.format(c) for c in columns), name))
+        row = cur.fetchone()
+        stats['tables'][name] = {'rows': row[0], 'columns': dict(zip(columns, row[1:]))}
+    return stats
+
+"""
+Purpose:
+    Command line entry point
+    e.g. python advisor.py --export stats.json          (reads dwh.cfg and exports statistics from the cluster)
+         python advisor.py stats.json --workload queries.sql --sql designs.sql
+    Without --workload, the README example queries are used
+"""
+def main():
+    parser = argparse.ArgumentParser(description="Recommend DISTSTYLE/DISTKEY/SORTKEY choices from exported statistics")
+    parser.add_argument('stats', help="statistics JSON file to read, or to write with --export")
+    parser.add_argument('--export', action='store_true', help="export statistics from the cluster in dwh.cfg")
+    parser.add_argument('--workload', help="file of SQL queries separated by ';'")
+    parser.add_argument('--loads', type=float, default=1.0, help="loads per workload period")
+    parser.add_argument('--sql', help="write CREATE TABLE statements of the recommended design to this file")
+    args = parser.parse_args()
+
+    tables = {t['name']: t for t in map(parse_create, create_table_queries)}
+
+    if args.export:
+        import configparser     # Parse configuration file
+        from connection import ConnectionManager    # Connection with statement retries; only needed to export statistics
+        config = configparser.ConfigParser()
+        config.read('dwh.cfg')
+        db = ConnectionManager.from_config(config, size=1).open()
+        try:
+            stats = db.run_transaction(None, lambda cur: export_stats(cur, tables))
+        finally:
+            db.close()
+        with open(args.stats, 'w') as f:
+            json.dump(stats, f, indent=2)
+        print("Exported statistics for ", len(stats['tables']), " tables to ", args.stats)
+        return
+
+    with open(args.stats) as f:
+        stats = json.load(f)
+    queries = read_workload(args.workload) if args.workload else [(q, 1.0) for q in analytical_queries]
+    workload = [(analyze_query(q, tables), w) for q, w in queries]
+
+    current = {t: tables[t]['design'] for t in tables if t in stats['tables']}
+    designs, ranking = recommend(tables, workload, stats, args.loads)
+    print("Estimated rows moved, current design: ", design_cost(current, workload, stats, args.loads))
+    print("Estimated rows moved, recommended design: ", design_cost(designs, workload, stats, args.loads))
+    for table, scored in ranking.items():
+        print(table, " (current ", current[table]['style'], current[table]['distkey'] or '', ")")
+        for cost, design in scored:
+            print("   ", cost, " DISTSTYLE ", design['style'], design['distkey'] or '',
+                  design['sort_style'], " SORTKEY ", design['sortkey'])
+
+    if args.sql:
+        with open(args.sql, 'w') as f:
+            for table in designs:
+                f.write(render_create(tables[table], designs[table]) + '\n\n')
+        print("Wrote recommended CREATE TABLE statements to ", args.sql)
+
+
+"""
+    Run above code if the file is labled __main__
+      Python internally labels files at runtime to differentiate between imported files and main file
+"""
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+import argparse                 # Command line options
+import io                       # In memory buffer for COPY FROM STDIN
+import json                     # Results file
+import os                       # Walk the generated dataset
+import resource                 # Peak memory of the benchmark process
+import subprocess               # Git commit the results were measured on
+import time                     # Wall clock timings
+from datetime import datetime, timezone                                 # Run start time
+import psycopg2                 # PostgreSQL database adapter for the Python
+from compact import table_columns, to_row, read_records                 # Source record validation, same as compact.py
+from metrics import MetricsRecorder, run_statement                      # Per statement timing and row counts
+from sql_queries import (registry, staging_events_table_create, staging_songs_table_create,
+                         unmatched_events_select)                       # SQL query definitions
+from benchmarks.sparkify_data import generate                           # Synthetic dataset
+
+"""
+  Statements are rendered for the local PostgreSQL stand-in by the query registry in sql_queries file
+"""
+TARGET = 'postgres'
+
+"""
+  Source dataset copied into each staging table, in the same order as copy_table_queries
+"""
+STAGING_TABLES = [('log_data', 'staging_events', staging_events_table_create),
+                  ('song_data', 'staging_songs', staging_songs_table_create)]
+
+STAR_TABLES = ['songplays', 'users', 'songs', 'artists', 'time']
+
+ANALYTICAL_NAMES = ['top_songs_select', 'top_locations_select', 'users_by_level_select']
+ROLLUP_NAMES = ['top_songs_rollup_select', 'top_locations_rollup_select', 'users_by_level_rollup_select']
+
+"""
+Purpose:
+    Formats a value for PostgreSQL COPY text format; None becomes NULL
+Arg:
+    value - column value [Required]
+"""
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+"""
+Purpose:
+    Local equivalent of the staging COPY: streams every JSON file under input_dir into a staging table
+      with COPY FROM STDIN in chunks
+    Records are mapped to columns the way compact.py does
+Arg:
+    cur - PostgreSQL connection cursor [Required]
+    input_dir - local directory holding source JSON files [Required]
+    table - staging table name [Required]
+    create_sql - CREATE TABLE statement of the staging table [Required]
+    chunk_rows - rows sent per COPY FROM STDIN call [Optional]
+Returns:
+    dict with counts of files, rows, and rejected records
+"""
+def copy_dataset(cur, input_dir, table, create_sql, chunk_rows=50000):
+    columns = table_columns(create_sql)
+    copy_sql = "COPY {} ({}) FROM STDIN".format(table, ', '.join(name for name, _, _ in columns))
+    stats = {'files': 0, 'rows': 0, 'rejected': 0}
+    buf = io.StringIO()
+    buffered = 0
+    for dirpath, _, filenames in sorted(os.walk(input_dir)):
+        for filename in sorted(filenames):
+            if not filename.endswith('.json'):
+                continue
+            stats['files'] += 1
+            for record in read_records(os.path.join(dirpath, filename)):
+                row = to_row(record, columns) if isinstance(record, dict) else None
+                if row is None:
+                    stats['rejected'] += 1
+                    continue
+                buf.write('\t'.join(copy_value(row[name]) for name, _, _ in columns) + '\n')
+                buffered += 1
+                stats['rows'] += 1
+                if buffered == chunk_rows:
+                    buf.seek(0)
+                    cur.copy_expert(copy_sql, buf)
+                    buf = io.StringIO()
+                    buffered = 0
+    if buffered:
+        buf.seek(0)
+        cur.copy_expert(copy_sql, buf)
+    return stats
+
+"""
+Purpose:
+    Times a benchmark stage and records the benchmark process peak memory at its end
+Arg:
+    stages - dict collecting stage results [Required]
+    name - stage name [Required]
+    fn - function running the stage; its return value is stored with the stage [Required]
+"""
+def timed_stage(stages, name, fn):
+    print("Running ", name, " stage...")
+    start = time.perf_counter()
+    result = fn()
+    stages[name] = {'seconds': time.perf_counter() - start,
+                    'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+    if result is not None:
+        stages[name]['result'] = result
+    return result
+
+"""
+Purpose:
+    Runs a list of statements one at a time and commits each, recording per statement metrics
+Arg:
+    cur - PostgreSQL connection cursor [Required]
+    conn - PostgreSQL connection [Required]
+    steps - list of (name, query) [Required]
+    stage - stage recorded with each statement [Required]
+    recorder - MetricsRecorder collecting per statement metrics [Required]
+"""
+def run_statements(cur, conn, steps, stage, recorder):
+    for name, query in steps:
+        run_statement(cur, query, stage, recorder, name=name)
+        if cur.description is not None:
+            cur.fetchall()
+        conn.commit()
+
+"""
+Purpose:
+    Runs the pipeline against a local PostgreSQL on a generated dataset
+    Stages: generate, create, copy, match_key, insert, analytical, rollup (rebuild), and rollup_queries (the
+      analytical questions answered from the rollups); each is timed with the benchmark process peak memory,
+      and every statement is timed on its own
+Arg:
+    conn - PostgreSQL connection [Required]
+    data_dir - generated dataset directory [Required]
+    params - dataset parameters returned by generate() [Required]
+    stages - dict with the generate stage already timed [Required]
+Returns:
+    results record written to the results file
+"""
+def run_pipeline(conn, data_dir, params, stages):
+    cur = conn.cursor()
+    recorder = MetricsRecorder(None, server_stats=False)
+    started_at = datetime.now(timezone.utc).isoformat()
+
+    timed_stage(stages, 'create', lambda: run_statements(
+        cur, conn, [(None, q) for q in registry.get('drop_table_queries', TARGET) + registry.get('create_table_queries', TARGET)],
+        'create', recorder))
+
+    def copy():
+        stats = {}
+        for dataset, table, create_sql in STAGING_TABLES:
+            start = time.perf_counter()
+            stats[table] = copy_dataset(cur, os.path.join(data_dir, dataset), table, create_sql)
+            cur.execute("ANALYZE {};".format(table))
+            conn.commit()
+            stats[table]['seconds'] = time.perf_counter() - start
+        return stats
+    timed_stage(stages, 'copy', copy)
+
+    timed_stage(stages, 'match_key', lambda: run_statements(
+        cur, conn, [(None, q) for q in registry.get('keyed_table_truncates', TARGET) + registry.get('match_key_queries', TARGET)],
+        'match_key', recorder))
+    timed_stage(stages, 'insert', lambda: run_statements(
+        cur, conn, [(step['name'], step['query']) for step in registry.get('insert_table_steps', TARGET)], 'insert', recorder))
+    timed_stage(stages, 'analytical', lambda: run_statements(
+        cur, conn, list(zip(ANALYTICAL_NAMES, registry.get('analytical_queries', TARGET))), 'analytical', recorder))
+    timed_stage(stages, 'rollup', lambda: run_statements(
+        cur, conn, [(None, q) for q in registry.get('rollup_rebuild_queries', TARGET)], 'rollup', recorder))
+    timed_stage(stages, 'rollup_queries', lambda: run_statements(
+        cur, conn, list(zip(ROLLUP_NAMES, registry.get('rollup_queries', TARGET))), 'rollup_queries', recorder))
+
+    tables = {}
+    for table in STAR_TABLES:
+        cur.execute("SELECT count(*) FROM {};".format(table))
+        tables[table] = cur.fetchone()[0]
+    cur.execute(unmatched_events_select)
+    nextsong, unmatched = cur.fetchone()
+    cur.close()
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'run_id': recorder.run_id, 'started_at': started_at, 'commit': commit, 'dataset': params,
+            'stages': stages, 'statements': [{k: r[k] for k in ('stage', 'statement', 'seconds', 'rows')} for r in recorder.records],
+            'tables': tables, 'nextsong_events': nextsong, 'unmatched_events': unmatched}
+
+"""
+Purpose:
+    Finds the latest earlier result measured on a dataset with the same parameters
+Arg:
+    path - results file [Required]
+    params - dataset parameters [Required]
+"""
+def previous_result(path, params):
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                if result['dataset'] == params:
+                    previous = result
+    return previous
+
+"""
+Purpose:
+    Prints stage and statement timings, with the change against an earlier result when given
+Arg:
+    result - results record [Required]
+    previous - earlier results record on the same dataset [Optional]
+"""
+def print_result(result, previous=None):
+    def change(seconds, before):
+        return "" if not before else " ({:+.0%})".format(seconds / before - 1)
+
+    before = previous['stages'] if previous else {}
+    print("Stages:")
+    for name, stage in result['stages'].items():
+        print("  ", name, ": ", round(stage['seconds'], 3), "s", change(stage['seconds'], before.get(name, {}).get('seconds')),
+              ", peak ", round(stage['peak_rss_mb']), " MB")
+    before = {(s['stage'], s['statement']): s['seconds'] for s in previous['statements']} if previous else {}
+    print("Statements:")
+    for s in result['statements']:
+        print("  ", s['stage'], " ", s['statement'], ": ", round(s['seconds'], 3), "s", change(s['seconds'], before.get((s['stage'], s['statement']))),
+              ", ", s['rows'], " rows")
+    print("Rows: ", result['tables'], ", NextSong events without a matching song: ", result['unmatched_events'],
+          " of ", result['nextsong_events'])
+
+"""
+Purpose:
+    Command line entry point
+    Generates (or reuses) a synthetic dataset, runs the pipeline on a local PostgreSQL, appends the results
+      to the results file, and compares them with the previous result on the same dataset
+    e.g. python -m benchmarks.pipeline_bench --dsn "dbname=sparkify" --scale 10
+"""
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Sparkify pipeline on a local PostgreSQL")
+    parser.add_argument('--dsn', default='dbname=sparkify')
+    parser.add_argument('--scale', type=float, default=1, help="multiple of the Sparkify dataset size, e.g. 1, 10, 100")
+    parser.add_argument('--match-rate', type=float, default=0.05, help="share of NextSong events matching a song")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--songs-per-file', type=int, default=1)
+    parser.add_argument('--data-dir', help="generated dataset directory (default bench_data/<scale>x)")
+    parser.add_argument('--output', default='bench_results.jsonl', help="JSON lines results file to append to")
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or os.path.join('bench_data', "{:g}x".format(args.scale))
+    stages = {}
+    params = timed_stage(stages, 'generate', lambda: generate(data_dir, args.scale, args.match_rate, args.seed,
+                                                             args.songs_per_file))
+    del stages['generate']['result']
+
+    conn = psycopg2.connect(args.dsn)
+    try:
+        result = run_pipeline(conn, data_dir, params, stages)
+    finally:
+        conn.close()
+
+    print_result(result, previous_result(args.output, params))
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(result, default=str) + '\n')
+    print("Results appended to ", args.output)
+
+
+if __name__ == "__main__":
+    main()
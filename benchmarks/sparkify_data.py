@@ -0,0 +1,211 @@
+import argparse                 # Command line options
+import json                     # Write source files and generation parameters
+import os                       # Output directories
+import random                   # Synthetic songs and events
+import shutil                   # Removes a dataset generated with other parameters
+import string                   # Random ids and words
+
+"""
+  Size of the Udacity Sparkify dataset; scale 1 generates about the same number of songs and events
+  Roughly 85% of events are NextSong, and only a few percent of them match a song in the song dataset
+"""
+BASE_SONGS = 14896
+BASE_EVENTS = 8056
+BASE_USERS = 96
+SONGS_PER_ARTIST = 1.4
+NEXTSONG_RATIO = 0.85
+LOG_DAYS = 30
+START_MS = 1541030400000        # 2018-11-01, start of the Sparkify log data
+MATCH_SAMPLE = 100000           # Songs kept in memory for events to match against
+
+PAGES = ['Home', 'Login', 'Logout', 'Settings', 'Help', 'About', 'Upgrade', 'Downgrade', 'Error']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Portland-South Portland, ME', 'Lansing-East Lansing, MI',
+             'Chicago-Naperville-Elgin, IL-IN-WI', 'Atlanta-Sandy Springs-Roswell, GA', 'Waterloo-Cedar Falls, IA',
+             'New York-Newark-Jersey City, NY-NJ-PA', 'Houston-The Woodlands-Sugar Land, TX']
+USER_AGENTS = ['"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+               '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+               'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0']
+FIRST_NAMES = ['Lily', 'Jacob', 'Kate', 'Chloe', 'Tegan', 'Aleena', 'Jayden', 'Matthew', 'Ryan', 'Layla']
+LAST_NAMES = ['Koch', 'Klein', 'Harrell', 'Cuevas', 'Levine', 'Kirby', 'Bell', 'Jones', 'Smith', 'Griffin']
+
+"""
+Purpose:
+    Builds a random word sequence used for song titles and artist names
+Arg:
+    rng - random.Random instance [Required]
+    words - number of words [Required]
+"""
+def random_name(rng, words):
+    return ' '.join(''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 8))).capitalize()
+                    for _ in range(words))
+
+"""
+Purpose:
+    Builds an 18 character id in the style of the Sparkify song and artist ids, e.g. SOABCDE12F34GH5678
+Arg:
+    rng - random.Random instance [Required]
+    prefix - 'SO' for songs, 'AR' for artists [Required]
+"""
+def random_id(rng, prefix):
+    return prefix + ''.join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(16))
+
+"""
+Purpose:
+    Builds the artist with the given number; artists are derived from the seed and their number, so songs of
+      the same artist share its details without keeping every artist in memory
+Arg:
+    seed - dataset random seed [Required]
+    number - artist number [Required]
+"""
+def artist_record(seed, number):
+    rng = random.Random("{}-artist-{}".format(seed, number))
+    return {'artist_id': random_id(rng, 'AR'), 'artist_name': random_name(rng, rng.randint(1, 3)),
+            'artist_location': rng.choice(LOCATIONS + ['']),
+            'artist_latitude': round(rng.uniform(-60, 60), 5) if rng.random() < 0.4 else None,
+            'artist_longitude': round(rng.uniform(-120, 120), 5) if rng.random() < 0.4 else None}
+
+"""
+Purpose:
+    Yields song records one at a time; artists have about SONGS_PER_ARTIST songs each
+Arg:
+    rng - random.Random instance [Required]
+    seed - dataset random seed [Required]
+    num_songs - number of songs [Required]
+"""
+def generate_songs(rng, seed, num_songs):
+    num_artists = max(1, int(num_songs / SONGS_PER_ARTIST))
+    for i in range(num_songs):
+        artist = artist_record(seed, i if i < num_artists else rng.randrange(num_artists))
+        yield dict(artist, num_songs=1, song_id=random_id(rng, 'SO'), title=random_name(rng, rng.randint(1, 4)),
+                   duration=round(rng.uniform(60, 600), 5), year=rng.choice([0] + list(range(1960, 2011))))
+
+"""
+Purpose:
+    Generates one day of events for a set of users
+    NextSong events pick a song from the song dataset with probability match_rate, otherwise a song
+      that isn't in it, so the share of events that become songplays can be controlled
+Arg:
+    rng - random.Random instance [Required]
+    day - day number from START_MS [Required]
+    num_events - number of events that day [Required]
+    users - list of user dicts [Required]
+    songs - (title, artist name, duration) of songs events can match [Required]
+    match_rate - share of NextSong events matching a song [Required]
+"""
+def generate_day(rng, day, num_events, users, songs, match_rate):
+    day_ms = START_MS + day * 24 * 3600 * 1000
+    events = []
+    sessions = {}
+    for ts in sorted(day_ms + rng.randrange(24 * 3600 * 1000) for _ in range(num_events)):
+        user = rng.choice(users)
+        session = sessions.setdefault(user['userId'], {'sessionId': rng.randrange(1, 10 ** 6), 'item': 0})
+        event = {'artist': None, 'auth': 'Logged In', 'firstName': user['firstName'], 'gender': user['gender'],
+                 'itemInSession': session['item'], 'lastName': user['lastName'], 'length': None,
+                 'level': user['level'], 'location': user['location'], 'method': 'PUT', 'page': 'NextSong',
+                 'registration': user['registration'], 'sessionId': session['sessionId'], 'song': None,
+                 'status': 200, 'ts': ts, 'userAgent': user['userAgent'], 'userId': str(user['userId'])}
+        session['item'] += 1
+        if rng.random() < NEXTSONG_RATIO:
+            if rng.random() < match_rate:
+                title, artist, duration = rng.choice(songs)
+                event.update(artist=artist, song=title, length=duration)
+            else:
+                event.update(artist=random_name(rng, 2), song=random_name(rng, 3), length=round(rng.uniform(60, 600), 5))
+        else:
+            event.update(page=rng.choice(PAGES), method='GET')
+            if event['page'] in ('Home', 'Login', 'About', 'Help') and rng.random() < 0.1:
+                event.update(auth='Logged Out', firstName=None, lastName=None, gender=None, level='free',
+                             location=None, registration=None, userAgent=None, userId='')
+        # Level changes on upgrade and downgrade pages, so later events of a user carry the new level
+        if event['page'] == 'Upgrade':
+            user['level'] = 'paid'
+        elif event['page'] == 'Downgrade':
+            user['level'] = 'free'
+        events.append(event)
+    return events
+
+"""
+Purpose:
+    Writes a synthetic Sparkify dataset in the layout of the S3 source data
+      song_data/A/B/C/TR<id>.json - song files, songs_per_file records each (one per file like the original by default)
+      log_data/2018/11/2018-11-DD-events.json - one newline delimited JSON file per day
+    Parameters are written to generate.json; an existing dataset with the same parameters is kept as is,
+      one generated with other parameters is replaced
+Arg:
+    output_dir - directory to write the dataset to [Required]
+    scale - multiple of the Sparkify dataset size, e.g. 1, 10, or 100 [Optional]
+    match_rate - share of NextSong events matching a song [Optional]
+    seed - random seed so datasets are repeatable [Optional]
+    songs_per_file - song records per song file [Optional]
+Returns:
+    dict of generation parameters and counts
+"""
+def generate(output_dir, scale=1, match_rate=0.05, seed=42, songs_per_file=1):
+    params = {'scale': scale, 'match_rate': match_rate, 'seed': seed, 'songs_per_file': songs_per_file,
+              'songs': int(BASE_SONGS * scale), 'events': int(BASE_EVENTS * scale), 'users': int(BASE_USERS * scale)}
+    params_path = os.path.join(output_dir, 'generate.json')
+    if os.path.exists(params_path):
+        with open(params_path) as f:
+            if json.load(f) == params:
+                return params
+
+    # Files of a dataset generated with other parameters would be loaded along with the new ones
+    for dataset in ('song_data', 'log_data'):
+        shutil.rmtree(os.path.join(output_dir, dataset), ignore_errors=True)
+
+    rng = random.Random(seed)
+    # Events match against a uniform sample of at most MATCH_SAMPLE songs, so memory stays flat at large scales
+    match_songs = []
+    batch = []
+    for i, song in enumerate(generate_songs(rng, seed, params['songs'])):
+        if len(match_songs) < MATCH_SAMPLE:
+            match_songs.append((song['title'], song['artist_name'], song['duration']))
+        elif rng.randrange(i + 1) < MATCH_SAMPLE:
+            match_songs[rng.randrange(MATCH_SAMPLE)] = (song['title'], song['artist_name'], song['duration'])
+        batch.append(song)
+        if len(batch) == songs_per_file or i == params['songs'] - 1:
+            song_id = batch[0]['song_id']
+            song_dir = os.path.join(output_dir, 'song_data', song_id[2], song_id[3], song_id[4])
+            os.makedirs(song_dir, exist_ok=True)
+            with open(os.path.join(song_dir, "TR{}.json".format(song_id[2:])), 'w') as f:
+                f.write('\n'.join(json.dumps(song) for song in batch))
+            batch = []
+
+    users = [{'userId': i, 'firstName': rng.choice(FIRST_NAMES), 'lastName': rng.choice(LAST_NAMES),
+              'gender': rng.choice('FM'), 'level': rng.choice(['free', 'free', 'paid']),
+              'location': rng.choice(LOCATIONS), 'userAgent': rng.choice(USER_AGENTS),
+              'registration': float(START_MS - rng.randrange(365 * 24 * 3600 * 1000))}
+             for i in range(1, params['users'] + 1)]
+    log_dir = os.path.join(output_dir, 'log_data', '2018', '11')
+    os.makedirs(log_dir, exist_ok=True)
+    per_day = params['events'] // LOG_DAYS
+    for day in range(LOG_DAYS):
+        num_events = per_day + (params['events'] % LOG_DAYS if day == LOG_DAYS - 1 else 0)
+        events = generate_day(rng, day, num_events, users, match_songs, match_rate)
+        with open(os.path.join(log_dir, "2018-11-{:02d}-events.json".format(day + 1)), 'w') as f:
+            f.write('\n'.join(json.dumps(event) for event in events))
+
+    with open(params_path, 'w') as f:
+        json.dump(params, f)
+    return params
+
+"""
+Purpose:
+    Command line entry point
+    e.g. python -m benchmarks.sparkify_data bench_data/10x --scale 10
+"""
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Sparkify song and log dataset")
+    parser.add_argument('output_dir')
+    parser.add_argument('--scale', type=float, default=1, help="multiple of the Sparkify dataset size, e.g. 1, 10, 100")
+    parser.add_argument('--match-rate', type=float, default=0.05, help="share of NextSong events matching a song")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--songs-per-file', type=int, default=1)
+    args = parser.parse_args()
+
+    params = generate(args.output_dir, args.scale, args.match_rate, args.seed, args.songs_per_file)
+    print("Generated ", params['songs'], " songs and ", params['events'], " events in ", args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import argparse                 # Command line options
+import io                       # In memory buffer for COPY FROM STDIN
+import json                     # Write results file
+import random                   # Synthetic events
+import statistics               # Median of repeated runs
+import time                     # Wall clock timings
+import psycopg2                 # PostgreSQL database adapter for the Python
+from sql_queries import registry, postgres_sql   # SQL query definitions rendered for a local PostgreSQL
+
+"""
+  time_table_insert as it was before the single scan rewrite, kept to benchmark against
+  Converts ts seven times per row over every event and de-duplicates afterwards
+"""
+OLD_TIME_TABLE_INSERT = ("""INSERT INTO time(start_time, hour, day, week, month, year, weekday)
+                            SELECT DISTINCT (timestamp 'epoch' + (ts/1000) * interval '1 second')
+                                           , extract(hr from (timestamp 'epoch' + (ts/1000) * interval '1 second'))
+                                           , extract(day from (timestamp 'epoch' + (ts/1000) * interval '1 second'))
+                                           , extract(week from (timestamp 'epoch' + (ts/1000) * interval '1 second'))
+                                           , extract(month from (timestamp 'epoch' + (ts/1000) * interval '1 second'))
+                                           , extract(year from (timestamp 'epoch' + (ts/1000) * interval '1 second'))
+                                           , extract(weekday from (timestamp 'epoch' + (ts/1000) * interval '1 second'))
+                            FROM staging_events;
+                         """)
+
+PAGES = ['Home', 'Login', 'Logout', 'Settings', 'Help', 'About', 'Upgrade', 'Downgrade']
+
+"""
+Purpose:
+    Loads synthetic events into staging_events with COPY FROM STDIN in chunks
+    Event times are spread over the given number of days at millisecond resolution;
+      nextsong_ratio of the events are song plays, the rest are other app pages
+Arg:
+    cur - PostgreSQL connection cursor [Required]
+    rows - number of events to generate [Required]
+    days - number of days the events span [Required]
+    nextsong_ratio - share of NextSong events [Required]
+    seed - random seed so runs are comparable [Required]
+"""
+def load_events(cur, rows, days, nextsong_ratio, seed):
+    rng = random.Random(seed)
+    start_ms = 1541030400000        # 2018-11-01, start of the Sparkify log data
+    span_ms = days * 24 * 3600 * 1000
+    columns = ('page', 'ts', 'userid', 'sessionid', 'iteminsession')
+    chunk = 100000
+    for offset in range(0, rows, chunk):
+        buf = io.StringIO()
+        for i in range(offset, min(rows, offset + chunk)):
+            page = 'NextSong' if rng.random() < nextsong_ratio else rng.choice(PAGES)
+            buf.write("{}\t{}\t{}\t{}\t{}\n".format(page, start_ms + rng.randrange(span_ms), rng.randrange(1, 100),
+                                                    rng.randrange(1, 1000), i))
+        buf.seek(0)
+        cur.copy_from(buf, 'staging_events', columns=columns)
+
+"""
+Purpose:
+    Runs a time table statement repeatedly against an empty time table
+Arg:
+    cur - PostgreSQL connection cursor [Required]
+    conn - PostgreSQL connection [Required]
+    sql - time table insert statement [Required]
+    repeat - number of timed runs [Required]
+Returns:
+    dict with median and individual timings in seconds and rows inserted
+"""
+def time_statement(cur, conn, sql, repeat):
+    timings = []
+    rows = None
+    for _ in range(repeat):
+        cur.execute("TRUNCATE time;")
+        conn.commit()
+        start = time.perf_counter()
+        cur.execute(sql)
+        rows = cur.rowcount
+        conn.commit()
+        timings.append(time.perf_counter() - start)
+    return {'median_s': statistics.median(timings), 'timings_s': timings, 'rows': rows}
+
+"""
+Purpose:
+    Compares the old and new time table statements on a synthetic events set in a local PostgreSQL
+    Also times the new statement on a second run, when every timestamp is already in time,
+      which is what incremental loads see for overlapping days
+    e.g. python -m benchmarks.time_table_bench --dsn "dbname=sparkify" --rows 1000000
+"""
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark old and new time table SQL on local PostgreSQL")
+    parser.add_argument('--dsn', default='dbname=sparkify')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--nextsong-ratio', type=float, default=0.8)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    cur = conn.cursor()
+    try:
+        print("Creating tables and loading ", args.rows, " synthetic events...")
+        cur.execute("DROP TABLE IF EXISTS staging_events; DROP TABLE IF EXISTS time;")
+        cur.execute(registry.get('staging_events_table_create', 'postgres'))
+        cur.execute(registry.get('time_table_create', 'postgres'))
+        load_events(cur, args.rows, args.days, args.nextsong_ratio, args.seed)
+        cur.execute("ANALYZE staging_events;")
+        conn.commit()
+
+        results = {'rows': args.rows, 'days': args.days, 'nextsong_ratio': args.nextsong_ratio}
+        results['old'] = time_statement(cur, conn, postgres_sql(OLD_TIME_TABLE_INSERT), args.repeat)
+        results['new'] = time_statement(cur, conn, registry.get('time_table_insert', 'postgres'), args.repeat)
+
+        start = time.perf_counter()
+        cur.execute(registry.get('time_table_insert', 'postgres'))
+        results['new_rerun'] = {'seconds': time.perf_counter() - start, 'rows': cur.rowcount}
+        conn.commit()
+    finally:
+        cur.close()
+        conn.close()
+
+    print("old       : ", round(results['old']['median_s'], 3), "s, ", results['old']['rows'], " rows")
+    print("new       : ", round(results['new']['median_s'], 3), "s, ", results['new']['rows'], " rows")
+    print("new rerun : ", round(results['new_rerun']['seconds'], 3), "s, ", results['new_rerun']['rows'], " rows")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
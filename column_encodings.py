@@ -0,0 +1,341 @@
+import argparse                 # Command line options
+import json                     # Read and write sampled rows
+import os                       # Walk local source directories
+import random                   # Reservoir sampling of local source records
+import re                       # Parse and rewrite column definitions
+import struct                   # Binary form of numeric sample values
+import zlib                     # Compressed size estimates
+from sql_queries import (staging_events_table_create, staging_songs_table_create, staging_plays_table_create,
+                         star_table_creates)                                                     # Table definitions
+from advisor import parse_create                                        # Parse CREATE TABLE statements
+from compact import DATASET_TABLES, table_columns, to_row, read_records     # Source records mapped like COPY maps them
+
+"""
+  Tables whose columns carry an explicit ENCODE in sql_queries file
+"""
+ENCODED_TABLES = ([('staging_events', staging_events_table_create), ('staging_songs', staging_songs_table_create),
+                   ('staging_plays', staging_plays_table_create)]
+                  + star_table_creates)
+
+"""
+  Staging table each local source dataset is sampled into
+"""
+DATASET_NAMES = {'song_data': 'staging_songs', 'log_data': 'staging_events'}
+
+"""
+  Column types always encoded AZ64; it beats ZSTD on numbers and timestamps and decodes faster
+"""
+AZ64_TYPES = {'smallint', 'int', 'integer', 'bigint', 'timestamp', 'timestamptz', 'date', 'decimal', 'numeric'}
+
+"""
+  Most distinct values a BYTEDICT column can store as one byte dictionary indexes, and the least number of
+    sampled values per distinct value; a column of mostly unique values (e.g. names) would only grow its dictionary
+"""
+BYTEDICT_MAX = 255
+BYTEDICT_MIN_REPEATS = 2
+
+"""
+  Least share by which BYTEDICT has to beat the next smallest estimate to be picked
+  A block past 255 distinct values stores the rest uncompressed, while ZSTD degrades gracefully as a column gains
+    values, so a near tie on the sample (e.g. long, repeated user agents) goes to ZSTD
+"""
+BYTEDICT_MIN_SAVING = 0.1
+
+"""
+Purpose:
+    Reads the type and declared encoding of a column definition
+    e.g. "song_id char(19) ENCODE raw SORTKEY DISTKEY" is ('char', 19, 'raw')
+Arg:
+    definition - column definition returned by parse_create() [Required]
+Returns:
+    tuple of (base type, length or None, declared encoding or None)
+"""
+def column_type(definition):
+    match = re.match(r'\w+\s+(\w+)\s*(?:\(\s*(\d+)\s*\))?', definition)
+    encoding = re.search(r'\bENCODE\s+(\w+)', definition, re.IGNORECASE)
+    return (match.group(1).lower(), int(match.group(2)) if match.group(2) else None,
+            encoding.group(1).lower() if encoding else None)
+
+"""
+Purpose:
+    Samples staging table rows from local source files, the way COPY would load them
+    Rows are reservoir sampled, so any number of files is read with memory for rows rows only
+Arg:
+    dataset - 'song_data' or 'log_data' [Required]
+    input_dir - local directory holding source JSON files [Required]
+    rows - rows kept in the sample [Required]
+    seed - random seed, so a sample can be repeated [Optional]
+Returns:
+    dict with 'rows' (rows read) and 'columns': column name to list of sampled values
+"""
+def sample_files(dataset, input_dir, rows, seed=42):
+    columns = table_columns(DATASET_TABLES[dataset])
+    rng = random.Random(seed)
+    sample = []
+    seen = 0
+    for dirpath, _, filenames in sorted(os.walk(input_dir)):
+        for filename in sorted(filenames):
+            if not filename.endswith('.json'):
+                continue
+            for record in read_records(os.path.join(dirpath, filename)):
+                row = to_row(record, columns) if isinstance(record, dict) else None
+                if row is None:
+                    continue
+                seen += 1
+                if len(sample) < rows:
+                    sample.append(row)
+                else:
+                    slot = rng.randrange(seen)
+                    if slot < rows:
+                        sample[slot] = row
+    return {'rows': seen, 'columns': {name: [row[name] for row in sample] for name, _, _ in columns}}
+
+"""
+Purpose:
+    Samples rows of each table from a live cluster; run once after a load, the analyzer itself only reads the
+      exported file
+Arg:
+    cur - Redshift connection cursor [Required]
+    tables - dict of table name to parsed table [Required]
+    rows - rows sampled per table [Required]
+"""
+def export_samples(cur, tables, rows):
+    samples = {}
+    for name, table in tables.items():
+        columns = [c for c, _ in table['columns']]
+        cur.execute("SELECT {} FROM {} LIMIT {:d};".format(', '.join(columns), name, rows))
+        values = cur.fetchall()
+        samples[name] = {'rows': len(values), 'columns': {c: [row[i] for row in values] for i, c in enumerate(columns)}}
+    return samples
+
+"""
+Purpose:
+    Estimates the bytes a sample of column values takes under each candidate encoding
+    - raw: values as stored; char columns are padded to their length
+    - zstd: zlib compressed size, standing in for ZSTD, which compresses about as well on this kind of data
+    - bytedict: one byte per value plus the dictionary, when the sample has at most BYTEDICT_MAX distinct values,
+        each repeated BYTEDICT_MIN_REPEATS times on average
+    NULLs take no bytes in any encoding
+Arg:
+    col_type - base column type, e.g. 'varchar' [Required]
+    length - declared length of char columns [Optional]
+    values - non NULL sampled values [Required]
+Returns:
+    dict of encoding to estimated bytes
+"""
+def estimate_sizes(col_type, values, length=None):
+    if col_type in ('char', 'varchar'):
+        data = [str(v).encode('utf-8') for v in values]
+        if col_type == 'char':
+            data = [d.ljust(length or 1) for d in data]
+    else:
+        data = [struct.pack('<d', float(v)) for v in values]
+    sizes = {'raw': sum(len(d) for d in data), 'zstd': len(zlib.compress(b''.join(data), 6))}
+    distinct = set(data)
+    if len(distinct) <= BYTEDICT_MAX and len(data) >= BYTEDICT_MIN_REPEATS * len(distinct):
+        sizes['bytedict'] = len(data) + sum(len(d) for d in distinct)
+    return sizes
+
+"""
+Purpose:
+    Picks a column encoding
+    - the leading sort key column is RAW, so range restricted scans use its zone maps without decompressing
+    - integers, decimals, dates, and timestamps are AZ64
+    - other columns take the smallest estimate from estimate_sizes(); BYTEDICT only when it is BYTEDICT_MIN_SAVING
+        smaller than the next one, and ZSTD when nothing was sampled
+Arg:
+    col_type - base column type [Required]
+    values - sampled values, NULLs included [Required]
+    length - declared length of char columns [Optional]
+    sortkey - the column leads the sort key [Optional]
+Returns:
+    tuple of (encoding, dict of estimated bytes per encoding, empty when no estimate was needed)
+"""
+def choose_encoding(col_type, values, length=None, sortkey=False):
+    if sortkey:
+        return 'raw', {}
+    if col_type in AZ64_TYPES:
+        return 'az64', {}
+    values = [v for v in values if v is not None]
+    if not values:
+        return 'zstd', {}
+    sizes = estimate_sizes(col_type, values, length)
+    encoding = min(sizes, key=sizes.get)
+    if encoding == 'bytedict':
+        runner_up = min((e for e in sizes if e != 'bytedict'), key=sizes.get)
+        if sizes['bytedict'] > (1 - BYTEDICT_MIN_SAVING) * sizes[runner_up]:
+            encoding = runner_up
+    return encoding, sizes
+
+"""
+Purpose:
+    Recommends an encoding for every column of the encoded tables from sampled rows
+    Columns without a sample get the type based choice of choose_encoding()
+Arg:
+    tables - dict of table name to parsed table [Required]
+    samples - dict of table name to sample_files() or export_samples() result [Required]
+Returns:
+    dict of table name to list of dicts with 'column', 'type', 'declared', 'encoding', 'sizes', and 'sampled'
+"""
+def recommend(tables, samples):
+    recommendations = {}
+    for name, table in tables.items():
+        sampled = samples.get(name, {}).get('columns', {})
+        leading = table['design']['sortkey'][0] if table['design']['sortkey'] else None
+        recommendations[name] = []
+        for column, definition in table['columns']:
+            col_type, length, declared = column_type(definition)
+            values = sampled.get(column) or []
+            encoding, sizes = choose_encoding(col_type, values, length, column == leading)
+            recommendations[name].append({'column': column, 'type': col_type, 'declared': declared,
+                                          'encoding': encoding, 'sizes': sizes, 'sampled': len(values)})
+    return recommendations
+
+"""
+Purpose:
+    Writes a CREATE TABLE statement with the given column encodings; an existing ENCODE is replaced,
+      otherwise ENCODE follows the column type (and IDENTITY), ahead of DISTKEY/SORTKEY/NOT NULL
+Arg:
+    create_sql - CREATE TABLE statement [Required]
+    encodings - dict of column name to encoding [Required]
+"""
+def render_encoded_create(create_sql, encodings):
+    for column, encoding in encodings.items():
+        pattern = (r'([(,]\s*' + column + r'\s+\w+(?:\s*\(\s*\d+\s*\))?(?:\s+IDENTITY\s*\(\s*\d+\s*,\s*\d+\s*\))?)'
+                   r'(?:\s+ENCODE\s+\w+)?')
+        create_sql = re.sub(pattern, lambda m: "{} ENCODE {}".format(m.group(1), encoding), create_sql, count=1)
+    return create_sql
+
+"""
+Purpose:
+    Runs ANALYZE COMPRESSION on a loaded table; Redshift samples the table and reports the encoding it would
+      pick for each column with its estimated size reduction
+Arg:
+    cur - Redshift connection cursor [Required]
+    table - table name [Required]
+Returns:
+    dict of column name to (encoding, estimated reduction percent)
+"""
+def analyze_compression(cur, table):
+    cur.execute("ANALYZE COMPRESSION {};".format(table))
+    return {column.strip(): (encoding.strip().lower(), float(reduction or 0))
+            for _, column, encoding, reduction in cur.fetchall()}
+
+"""
+Purpose:
+    Calibration: compares the declared encodings and the local recommendation with ANALYZE COMPRESSION
+      on the cluster, one table at a time
+    ANALYZE COMPRESSION locks the table, so run it once after the first load, or when the data changes shape,
+      rather than on every load
+Arg:
+    db - ConnectionManager [Required]
+    recommendations - dict returned by recommend() [Required]
+Returns:
+    list of (table, column, declared, local, Redshift encoding, estimated reduction) where any of them disagree
+"""
+def calibrate(db, recommendations):
+    differences = []
+    num_tables = len(recommendations)
+    for table_count, (table, columns) in enumerate(recommendations.items(), 1):
+        print("Running ", table_count, "/", num_tables, " ANALYZE COMPRESSION queries: ", table)
+        redshift = db.run_transaction(None, lambda cur: analyze_compression(cur, table), autocommit=True)
+        for c in columns:
+            encoding, reduction = redshift.get(c['column'], (None, 0.0))
+            if len({c['declared'], c['encoding'], encoding}) > 1:
+                differences.append((table, c['column'], c['declared'], c['encoding'], encoding, reduction))
+    return differences
+
+"""
+Purpose:
+    Prints recommended encodings; '*' marks columns whose declared encoding differs
+Arg:
+    recommendations - dict returned by recommend() [Required]
+"""
+def print_recommendations(recommendations):
+    for table, columns in recommendations.items():
+        print(table, ":")
+        for c in columns:
+            sizes = ', '.join("{} {}".format(encoding, size) for encoding, size in sorted(c['sizes'].items(), key=lambda s: s[1]))
+            print("  ", '*' if c['declared'] != c['encoding'] else ' ', c['column'], " ", c['type'], ": ",
+                  c['declared'], " -> ", c['encoding'], " (", c['sampled'], " values", "; bytes " + sizes if sizes else "", ")")
+
+"""
+Purpose:
+    Command line entry point
+    e.g. python column_encodings.py samples.json --song-data data/song_data --log-data data/log_data  (samples local files)
+         python column_encodings.py samples.json --export           (samples every table of the cluster in dwh.cfg)
+         python column_encodings.py samples.json --sql encoded.sql  (recommends encodings offline from saved samples)
+         python column_encodings.py samples.json --calibrate        (also compares them with ANALYZE COMPRESSION)
+"""
+def main():
+    parser = argparse.ArgumentParser(description="Recommend column encodings from sampled rows")
+    parser.add_argument('samples', help="samples JSON file to read, or to write with --export/--song-data/--log-data")
+    parser.add_argument('--export', action='store_true', help="sample the tables of the cluster in dwh.cfg")
+    parser.add_argument('--song-data', help="local song_data directory to sample staging_songs from")
+    parser.add_argument('--log-data', help="local log_data directory to sample staging_events from")
+    parser.add_argument('--rows', type=int, default=20000, help="rows sampled per table")
+    parser.add_argument('--calibrate', action='store_true', help="compare with ANALYZE COMPRESSION on the cluster")
+    parser.add_argument('--sql', help="write CREATE TABLE statements with the recommended encodings to this file")
+    args = parser.parse_args()
+
+    tables = {name: parse_create(create_sql) for name, create_sql in ENCODED_TABLES}
+    creates = dict(ENCODED_TABLES)
+
+    if args.export or args.song_data or args.log_data:
+        samples = {}
+        if os.path.exists(args.samples):
+            with open(args.samples) as f:
+                samples = json.load(f)
+        for dataset, input_dir in (('song_data', args.song_data), ('log_data', args.log_data)):
+            if input_dir:
+                samples[DATASET_NAMES[dataset]] = sample_files(dataset, input_dir, args.rows)
+        if args.export:
+            import configparser     # Parse configuration file
+            from connection import ConnectionManager    # Connection with statement retries; only needed to export samples
+            config = configparser.ConfigParser()
+            config.read('dwh.cfg')
+            db = ConnectionManager.from_config(config, size=1).open()
+            try:
+                samples.update(db.run_transaction(None, lambda cur: export_samples(cur, tables, args.rows)))
+            finally:
+                db.close()
+        with open(args.samples, 'w') as f:
+            json.dump(samples, f, default=str)
+        print("Sampled ", ', '.join("{} ({} of {} rows)".format(t, len(next(iter(s['columns'].values()), [])), s['rows'])
+                                    for t, s in samples.items()), " to ", args.samples)
+
+    with open(args.samples) as f:
+        samples = json.load(f)
+    recommendations = recommend(tables, samples)
+    print_recommendations(recommendations)
+
+    if args.sql:
+        with open(args.sql, 'w') as f:
+            for table, columns in recommendations.items():
+                encodings = {c['column']: c['encoding'] for c in columns}
+                f.write(' '.join(render_encoded_create(creates[table], encodings).split()) + '\n\n')
+        print("Wrote CREATE TABLE statements with the recommended encodings to ", args.sql)
+
+    if args.calibrate:
+        import configparser     # Parse configuration file
+        from connection import ConnectionManager    # Connection with statement retries; only needed to calibrate
+        config = configparser.ConfigParser()
+        config.read('dwh.cfg')
+        db = ConnectionManager.from_config(config, size=1).open()
+        try:
+            differences = calibrate(db, recommendations)
+        finally:
+            db.close()
+        print("Encodings agree with ANALYZE COMPRESSION" if not differences else
+              "Columns where declared, local, and ANALYZE COMPRESSION encodings differ:")
+        for table, column, declared, local, redshift, reduction in differences:
+            print("  ", table, ".", column, ": declared ", declared, ", local ", local, ", Redshift ", redshift,
+                  " (est. ", round(reduction, 1), "% smaller than now)")
+
+
+"""
+    Run above code if the file is labled __main__
+      Python internally labels files at runtime to differentiate between imported files and main file
+"""
+if __name__ == "__main__":
+    main()
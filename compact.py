@@ -0,0 +1,289 @@
+import argparse                 # Command line options
+import gzip                     # Compressed newline delimited JSON output
+import json                     # Parse source files and write compacted records
+import os                       # Walk source directory and write output files
+import re                       # Parse column definitions out of CREATE TABLE statements
+import hashlib                  # Song match key
+from decimal import Decimal, ROUND_HALF_UP             # Rounds durations the way the SQL cast to decimal(12, 2) does
+from concurrent.futures import ProcessPoolExecutor     # Compacts shards of files in parallel
+from sql_queries import staging_events_table_create, staging_songs_table_create    # Staging table definitions
+
+"""
+  Staging table each source dataset is copied into
+  Compacted records are validated against the columns of these tables
+"""
+DATASET_TABLES = {'song_data': staging_songs_table_create,
+                  'log_data': staging_events_table_create}
+
+"""
+  File suffix written for each output format; matches COPY_FORMAT in the ETL section of config file
+"""
+FORMAT_SUFFIXES = {'json_gzip': '.json.gz',
+                   'parquet': '.parquet'}
+
+"""
+Purpose:
+    Reads column names and types from a CREATE TABLE statement defined in sql_queries file
+    Length defaults follow Redshift: varchar without length is varchar(256), char without length is char(1)
+Arg:
+    create_sql - CREATE TABLE statement [Required]
+Returns:
+    list of (column name, type, max length) tuples in table order; max length is None for non character types
+"""
+def table_columns(create_sql):
+    body = create_sql[create_sql.index('(') + 1:]
+    columns = []
+    for definition in body.split(','):
+        match = re.match(r'\s*(\w+)\s+(varchar|char|bigint|int|float)\s*(?:\(\s*(\d+)\s*\))?', definition)
+        if not match:
+            continue
+        name, col_type, length = match.groups()
+        if col_type == 'varchar':
+            length = int(length or 256)
+        elif col_type == 'char':
+            length = int(length or 1)
+        columns.append((name, col_type, length))
+    return columns
+
+"""
+Purpose:
+    Converts a source record to a staging table row
+    Source keys are matched to columns ignoring case, as log files use camel case keys (e.g. userId)
+    Empty strings in numeric columns become NULL, as logged out events carry userId ''
+Arg:
+    record - parsed JSON object from a source file [Required]
+    columns - list returned by table_columns() [Required]
+Returns:
+    dict of column name to value, or None when a value doesn't fit its column type
+"""
+def to_row(record, columns):
+    values = {key.lower(): value for key, value in record.items()}
+    row = {}
+    for name, col_type, length in columns:
+        value = values.get(name)
+        if value is None or (value == '' and col_type in ('int', 'bigint', 'float')):
+            row[name] = None
+            continue
+        try:
+            if col_type in ('int', 'bigint'):
+                if isinstance(value, float) and not value.is_integer():
+                    return None
+                row[name] = int(value)
+            elif col_type == 'float':
+                row[name] = float(value)
+            else:
+                value = str(value)
+                if len(value.encode('utf-8')) > length:
+                    return None
+                row[name] = value
+        except (TypeError, ValueError):
+            return None
+    return row
+
+"""
+Purpose:
+    Computes the song match key in Python; same value as song_match_key_sql() in sql_queries file
+    md5 of lower-cased, trimmed title and artist name and the duration rounded to 2 decimals
+Arg:
+    title - song title [Required]
+    artist - artist name [Required]
+    duration - song duration in seconds [Required]
+Returns:
+    32 character hex digest, or None when any part is missing (SQL concatenation with NULL is NULL)
+"""
+def song_match_key(title, artist, duration):
+    if title is None or artist is None or duration is None:
+        return None
+    duration = Decimal(repr(float(duration))).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+    value = "{}|{}|{}".format(title.strip(' ').lower(), artist.strip(' ').lower(), duration)
+    return hashlib.md5(value.encode('utf-8')).hexdigest()
+
+"""
+Purpose:
+    Yields records from a source file one at a time
+    Log files hold one JSON object per line; song files hold a single object which may span lines
+Arg:
+    path - source file path [Required]
+"""
+def read_records(path):
+    with open(path, encoding='utf-8') as f:
+        try:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+            return
+        except json.JSONDecodeError:
+            pass
+    with open(path, encoding='utf-8') as f:
+        yield json.load(f)
+
+"""
+Purpose:
+    Writes rows to size limited output files, starting a new part file once the current one is full
+    Only the current part is open, and parquet rows are buffered for at most one row group,
+      so memory use doesn't grow with input size
+Arg:
+    output_dir - directory to write part files to [Required]
+    prefix - file name prefix shared by the parts [Required]
+    columns - list returned by table_columns(); sets column order and parquet schema [Required]
+    output_format - 'json_gzip' or 'parquet' [Required]
+    target_bytes - uncompressed bytes written to a part before starting the next one [Required]
+    row_group_rows - rows buffered per parquet row group [Optional]
+"""
+class PartWriter:
+    def __init__(self, output_dir, prefix, columns, output_format, target_bytes, row_group_rows=100000):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.columns = columns
+        self.output_format = output_format
+        self.target_bytes = target_bytes
+        self.row_group_rows = row_group_rows
+        self.parts = []
+        self.file = None
+        self.written = 0
+        self.buffer = []
+        if output_format == 'parquet':
+            import pyarrow              # Optional; only needed to write parquet output
+            import pyarrow.parquet
+            self.pa = pyarrow
+            self.pq = pyarrow.parquet
+            types = {'int': pyarrow.int32(), 'bigint': pyarrow.int64(), 'float': pyarrow.float64(),
+                     'varchar': pyarrow.string(), 'char': pyarrow.string()}
+            self.schema = pyarrow.schema([(name, types[col_type]) for name, col_type, _ in columns])
+
+    def _open(self):
+        path = os.path.join(self.output_dir, "{}-{:04d}{}".format(self.prefix, len(self.parts), FORMAT_SUFFIXES[self.output_format]))
+        if self.output_format == 'parquet':
+            self.file = self.pq.ParquetWriter(path, self.schema, compression='snappy')
+        else:
+            self.file = gzip.open(path, 'wt', encoding='utf-8')
+        self.parts.append({'path': path, 'records': 0})
+        self.written = 0
+
+    def _flush(self):
+        if self.buffer:
+            self.file.write_table(self.pa.Table.from_pylist(self.buffer, schema=self.schema))
+            self.buffer = []
+
+    def write(self, row):
+        if self.file is None:
+            self._open()
+        line = json.dumps(row)
+        if self.output_format == 'parquet':
+            self.buffer.append(row)
+            if len(self.buffer) >= self.row_group_rows:
+                self._flush()
+        else:
+            self.file.write(line + '\n')
+        self.written += len(line) + 1
+        self.parts[-1]['records'] += 1
+        if self.written >= self.target_bytes:
+            self.close()
+
+    def close(self):
+        if self.file is not None:
+            if self.output_format == 'parquet':
+                self._flush()
+            self.file.close()
+            self.file = None
+
+"""
+Purpose:
+    Compacts one shard of source files into a few large output files
+    Runs in a worker process; records are streamed from each file straight to the output
+Arg:
+    job - dict with 'dataset', 'files', 'output_dir', 'shard', 'format', and 'target_bytes' [Required]
+Returns:
+    dict with counts of files, records, and rejected records, and the list of written parts
+"""
+def compact_shard(job):
+    columns = table_columns(DATASET_TABLES[job['dataset']])
+    writer = PartWriter(job['output_dir'], "{}-{:03d}".format(job['dataset'], job['shard']),
+                        columns, job['format'], job['target_bytes'])
+    stats = {'files': 0, 'records': 0, 'rejected': 0}
+    try:
+        for path in job['files']:
+            stats['files'] += 1
+            for record in read_records(path):
+                row = to_row(record, columns) if isinstance(record, dict) else None
+                if row is None:
+                    stats['rejected'] += 1
+                    continue
+                writer.write(row)
+                stats['records'] += 1
+    finally:
+        writer.close()
+    stats['parts'] = writer.parts
+    return stats
+
+"""
+Purpose:
+    Compacts every JSON file under input_dir into large compressed files in output_dir
+    Files are split into one shard per worker, balanced by size, and shards run on a process pool
+Arg:
+    dataset - 'song_data' or 'log_data'; selects the staging table to validate against [Required]
+    input_dir - local directory holding source JSON files [Required]
+    output_dir - local directory to write compacted files to [Required]
+    output_format - 'json_gzip' or 'parquet' [Optional]
+    workers - number of worker processes [Optional]
+    target_mb - uncompressed megabytes per output file [Optional]
+Returns:
+    dict with total counts of files, records, and rejected records, and the list of written parts
+"""
+def compact(dataset, input_dir, output_dir, output_format='json_gzip', workers=4, target_mb=256):
+    files = []
+    for dirpath, _, filenames in os.walk(input_dir):
+        for filename in filenames:
+            if filename.endswith('.json'):
+                path = os.path.join(dirpath, filename)
+                files.append((os.path.getsize(path), path))
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Largest files first into the lightest shard keeps worker run times even
+    shards = [{'bytes': 0, 'files': []} for _ in range(max(1, min(workers, len(files))))]
+    for size, path in sorted(files, reverse=True):
+        shard = min(shards, key=lambda s: s['bytes'])
+        shard['bytes'] += size
+        shard['files'].append(path)
+
+    jobs = [{'dataset': dataset, 'files': sorted(shard['files']), 'output_dir': output_dir, 'shard': i,
+             'format': output_format, 'target_bytes': target_mb * 1024 * 1024}
+            for i, shard in enumerate(shards) if shard['files']]
+    totals = {'files': 0, 'records': 0, 'rejected': 0, 'parts': []}
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        for stats in executor.map(compact_shard, jobs):
+            for key in ('files', 'records', 'rejected'):
+                totals[key] += stats[key]
+            totals['parts'].extend(stats['parts'])
+    return totals
+
+"""
+Purpose:
+    Command line entry point
+    e.g. python compact.py song_data data/song_data compacted/song_data --format json_gzip
+    Upload the output directory to S3, point SONG_DATA / LOG_DATA at it, and set COPY_FORMAT
+      in the ETL section of config file to the format used
+"""
+def main():
+    parser = argparse.ArgumentParser(description="Compact small Sparkify JSON files into large compressed files")
+    parser.add_argument('dataset', choices=sorted(DATASET_TABLES))
+    parser.add_argument('input_dir')
+    parser.add_argument('output_dir')
+    parser.add_argument('--format', dest='output_format', choices=sorted(FORMAT_SUFFIXES), default='json_gzip')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--target-mb', type=int, default=256)
+    args = parser.parse_args()
+
+    print("Compacting ", args.dataset, " files from ", args.input_dir, "...")
+    totals = compact(args.dataset, args.input_dir, args.output_dir, args.output_format, args.workers, args.target_mb)
+    print("Read ", totals['files'], " files, wrote ", totals['records'], " records to ", len(totals['parts']),
+          " files, rejected ", totals['rejected'], " records")
+
+
+"""
+    Run above code if the file is labled __main__
+      Python internally labels files at runtime to differentiate between imported files and main file
+"""
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import os                       # Checkpoint file handling
+import queue                    # Thread safe pool of database connections
+import random                   # Jitter on retry delays
+import threading                # Guards checkpoint file writes
+import time                     # Retry delays
+import psycopg2                 # PostgreSQL database adapter for the Python
+from metrics import run_statement, statement_name               # Per statement timing and row counts
+
+"""
+  Errors worth retrying: dropped connections and network blips raise OperationalError or InterfaceError
+  Anything else (syntax errors, constraint violations, missing tables) fails the same way on every attempt
+"""
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+"""
+  Subclasses of the transient errors that aren't retried: a statement cancelled by statement_timeout
+    (QueryCanceledError is an OperationalError) would run just as long and be cancelled again
+"""
+PERMANENT_ERRORS = (psycopg2.extensions.QueryCanceledError,)
+
+"""
+Purpose:
+    Builds psycopg2.connect() keyword arguments from the CLUSTER section of config file
+    Keys are read by name, so the order they are written in the config file doesn't matter
+    TCP keepalives stop long running COPY and INSERT statements from being dropped by idle network devices
+Arg:
+    config - parsed dwh.cfg config [Required]
+Returns:
+    dict of connection keyword arguments
+"""
+def connect_kwargs(config):
+    cluster = config['CLUSTER']
+    return {'host': cluster['HOST'],
+            'dbname': cluster['DB_NAME'],
+            'user': cluster['DB_USER'],
+            'password': cluster['DB_PASSWORD'],
+            'port': cluster['DB_PORT'],
+            'connect_timeout': config.getint('ETL', 'CONNECT_TIMEOUT', fallback=30),
+            'keepalives': 1,
+            'keepalives_idle': config.getint('ETL', 'KEEPALIVES_IDLE', fallback=60),
+            'keepalives_interval': 10,
+            'keepalives_count': 5}
+
+"""
+Purpose:
+    Keeps the keys of statements that have completed in a text file, one key per line
+    A run that fails part way through is rerun with the same file and skips what already committed,
+      e.g. a failed song_table_upsert resumes there instead of running the COPYs again
+    The file is removed once a run completes, so the next run starts from the beginning
+Arg:
+    path - checkpoint file; keys are only kept in memory when None [Optional]
+"""
+class Checkpoint:
+    def __init__(self, path=None):
+        self.path = path
+        self.keys = set()
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.keys = {line.strip() for line in f if line.strip()}
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def add(self, key):
+        with self.lock:
+            self.keys.add(key)
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(key + '\n')
+
+    def clear(self):
+        with self.lock:
+            self.keys = set()
+            if self.path and os.path.exists(self.path):
+                os.remove(self.path)
+
+"""
+Purpose:
+    Opens a fixed pool of connections once and shares them across every stage of a run
+    Each unit of work (a single statement, or a function running several statements) runs in its own
+      transaction on a borrowed connection and is retried on transient errors with exponential backoff;
+      a connection found closed is replaced before the retry
+    A failed attempt is rolled back, so retrying a statement that was committed on its own never applies it twice
+    Units with a checkpoint key are skipped when the checkpoint already holds it, and added once committed
+    connect, sleep, transient_errors, and permanent_errors can be replaced to run against a fake DB-API connection
+Arg:
+    kwargs - psycopg2.connect() keyword arguments, e.g. from connect_kwargs() [Required]
+    size - number of connections in the pool [Optional]
+    retries - retries after the first attempt of each unit of work [Optional]
+    backoff - delay in seconds before the first retry; doubled on each further retry [Optional]
+    max_backoff - longest delay between retries in seconds [Optional]
+    statement_timeout - statement_timeout set on every connection, in milliseconds; 0 leaves it unset [Optional]
+    checkpoint - Checkpoint of completed units; nothing is skipped when None [Optional]
+    connect - function opening a connection from kwargs [Optional]
+    sleep - function waiting between retries [Optional]
+    transient_errors - exception types that are retried [Optional]
+    permanent_errors - subclasses of transient_errors that fail at once instead [Optional]
+"""
+class ConnectionManager:
+    def __init__(self, kwargs, size=1, retries=3, backoff=2.0, max_backoff=60.0, statement_timeout=0,
+                 checkpoint=None, connect=psycopg2.connect, sleep=time.sleep, transient_errors=TRANSIENT_ERRORS,
+                 permanent_errors=PERMANENT_ERRORS):
+        self.kwargs = kwargs
+        self.size = max(1, size)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statement_timeout = statement_timeout
+        self.checkpoint = checkpoint
+        self.connect = connect
+        self.sleep = sleep
+        self.transient_errors = transient_errors
+        self.permanent_errors = permanent_errors
+        self.conns = []
+        self.pool = queue.Queue()
+
+    """
+    Purpose:
+        Creates a manager from the CLUSTER and ETL sections of config file
+        ETL settings: PARALLEL_CONNECTIONS (pool size), RETRIES, RETRY_BACKOFF, STATEMENT_TIMEOUT
+    Arg:
+        config - parsed dwh.cfg config [Required]
+        checkpoint - Checkpoint of completed units [Optional]
+        size - pool size; read from PARALLEL_CONNECTIONS when not given [Optional]
+    """
+    @classmethod
+    def from_config(cls, config, checkpoint=None, size=None):
+        return cls(connect_kwargs(config),
+                   size=size or config.getint('ETL', 'PARALLEL_CONNECTIONS', fallback=1),
+                   retries=config.getint('ETL', 'RETRIES', fallback=3),
+                   backoff=config.getfloat('ETL', 'RETRY_BACKOFF', fallback=2.0),
+                   statement_timeout=config.getint('ETL', 'STATEMENT_TIMEOUT', fallback=0),
+                   checkpoint=checkpoint)
+
+    def _open_one(self):
+        conn = self.connect(**self.kwargs)
+        if self.statement_timeout:
+            cur = conn.cursor()
+            cur.execute("SET statement_timeout TO %s;", (self.statement_timeout,))
+            cur.close()
+            conn.commit()
+        return conn
+
+    # Opens every connection in the pool; connection errors are retried like statements
+    def open(self):
+        for _ in range(self.size):
+            conn = self._retry("connect", self._open_one)
+            self.conns.append(conn)
+            self.pool.put(conn)
+        return self
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self.conns = []
+        self.pool = queue.Queue()
+
+    def _replace(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        new_conn = self._retry("reconnect", self._open_one)
+        self.conns[self.conns.index(conn)] = new_conn
+        return new_conn
+
+    def _delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.0)
+
+    def _retry(self, label, fn):
+        for attempt in range(self.retries + 1):
+            try:
+                return fn()
+            except self.transient_errors as e:
+                if attempt == self.retries or isinstance(e, self.permanent_errors):
+                    raise
+                delay = self._delay(attempt)
+                print("Retrying ", label, " in ", round(delay, 1), "s after error: ", e)
+                self.sleep(delay)
+
+    """
+    Purpose:
+        Runs work(cur) in one transaction on a borrowed connection and commits it
+        Retried as a whole on transient errors; skipped when key is already in the checkpoint
+        With autocommit, each statement commits as it runs; needed for statements that can't run inside
+          a transaction block, such as VACUUM
+    Arg:
+        key - checkpoint key of the unit of work; never skipped when None [Required]
+        work - function taking a cursor and running the unit's statements [Required]
+        autocommit - run work in autocommit mode instead of one transaction [Optional]
+    Returns:
+        value returned by work, or None when skipped
+    """
+    def run_transaction(self, key, work, autocommit=False):
+        if key is not None and self.checkpoint is not None and key in self.checkpoint:
+            print("Skipping ", key, ", completed in an earlier run")
+            return None
+
+        conn = self.pool.get()
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    if autocommit:
+                        # autocommit can only be switched outside a transaction
+                        conn.rollback()
+                        conn.autocommit = True
+                    cur = conn.cursor()
+                    try:
+                        result = work(cur)
+                        conn.commit()
+                    finally:
+                        cur.close()
+                    break
+                except self.transient_errors as e:
+                    try:
+                        conn.rollback()
+                    except Exception:
+                        pass
+                    if attempt == self.retries or isinstance(e, self.permanent_errors):
+                        raise
+                    delay = self._delay(attempt)
+                    print("Retrying ", key or "statement", " in ", round(delay, 1), "s after error: ", e)
+                    self.sleep(delay)
+                    if getattr(conn, 'closed', False):
+                        conn = self._replace(conn)
+                except Exception:
+                    conn.rollback()
+                    raise
+        finally:
+            if autocommit and not getattr(conn, 'closed', False):
+                conn.autocommit = False
+            self.pool.put(conn)
+
+        if key is not None and self.checkpoint is not None:
+            self.checkpoint.add(key)
+        return result
+
+    """
+    Purpose:
+        Runs and commits a single statement with retries and metrics; see run_transaction()
+    Arg:
+        query - SQL statement [Required]
+        stage - pipeline stage recorded with the statement's metrics; also prefixes its checkpoint key [Required]
+        recorder - MetricsRecorder collecting per statement metrics [Optional]
+        params - query parameters passed to execute() [Optional]
+        name - statement name; derived from the SQL text when not given [Optional]
+        key - checkpoint key; '<stage>:<name>' when not given [Optional]
+        autocommit - run the statement outside a transaction block, e.g. VACUUM [Optional]
+    """
+    def run(self, query, stage, recorder=None, params=None, name=None, key=None, autocommit=False):
+        key = key or "{}:{}".format(stage, name or statement_name(query))
+        return self.run_transaction(key, lambda cur: run_statement(cur, query, stage, recorder, params, name), autocommit)
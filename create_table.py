@@ -1,48 +1,50 @@
 import configparser               # Parse configuration file
-import psycopg2                   # PostgreSQL database adapter for the Python
 import sys                        # Used for exiting python script in case of error
 #from no_op_sql_queries import create_table_queries, drop_table_queries      #Non-Optimized DWH Tables
 from sql_queries import create_table_queries, drop_table_queries    # SQL query definitions
+from metrics import MetricsRecorder                                 # Per statement timing and row counts
+from connection import ConnectionManager, Checkpoint                # Connection with statement retries and checkpoints
 
 """
 Purpose:
     Loops through drop_table_queries list and runs drop table queries
     drop_table_queries are defined in sql_queries file
 Arg:
-    cur - Redshift connection cursor [Required]
-    conn - Redshift connection [Required]
+    db - ConnectionManager running and committing each query [Required]
+    recorder - MetricsRecorder collecting per statement metrics [Optional]
 """
-def drop_tables(cur, conn):
+def drop_tables(db, recorder=None):
     num_queries = len(drop_table_queries)
     query_count = 0
     for query in drop_table_queries:
         query_count += 1
         print("Running ", query_count, "/", num_queries, " drop table queries")
-        cur.execute(query)
-        conn.commit()
+        db.run(query, 'drop', recorder)
 
 """
 Purpose:
     Loops through create_table_queries list and runs create table queries
     create_table_queries are defined in sql_queries file
 Arg:
-    cur - Redshift connection cursor [Required]
-    conn - Redshift connection [Required]
+    db - ConnectionManager running and committing each query [Required]
+    recorder - MetricsRecorder collecting per statement metrics [Optional]
 """
-def create_tables(cur, conn):
+def create_tables(db, recorder=None):
     num_queries = len(create_table_queries)
     query_count = 0
     for query in create_table_queries:
         query_count += 1
         print("Running ", query_count, "/", num_queries, " create table queries")
-        cur.execute(query)
-        conn.commit()
+        db.run(query, 'create', recorder)
 
 """
 Purpose:
     Reads Redshift Cluster connection info stored in dwh.cfg config file
-    Connects to cluster using config details and retrieves Connection and Cursor handle
+    Connects to cluster using config details; statements are retried on transient errors
     Upon connecting successfully, calls drop_tables() and create_table() functions
+    Statement metrics are appended to METRICS_FILE in the ETL section of config file (default etl_metrics.jsonl)
+    Once the tables are dropped, the ETL checkpoint file (CHECKPOINT_FILE, default etl_checkpoint.txt) is removed, as the
+      statements it marks as done loaded tables that no longer exist
 """
 def main():
     config = configparser.ConfigParser()
@@ -58,48 +60,42 @@ def main():
     # Creating a connection using Cluster and DWH details stored in config file
     print("Connecting to Data Warehouse...")
     try:
-        conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+        db = ConnectionManager.from_config(config, size=1).open()
         print("Connected to Data Warehouse")
     except Exception as e:
         print("Error connecting Data Warehouse: ", e)
         sys.exit()
 
-    # Getting conection cursor
-    print("Getting Cursor")
-    try:
-        cur = conn.cursor()
-        print("Connection cursor retrieved")
-    except Exception as e:
-        print("Error getting connection cursor: ", e)
-        print("Closing connection to data warehouse...")
-        conn.close()
-        sys.exit()
+    recorder = MetricsRecorder(config.get('ETL', 'METRICS_FILE', fallback='etl_metrics.jsonl'),
+                               config.getboolean('ETL', 'SERVER_METRICS', fallback=True))
+    print("Recording statement metrics for run ", recorder.run_id)
 
     # Running Drop Table queries
     print("Running Drop Table queries...")
     try:
-        drop_tables(cur, conn)
+        drop_tables(db, recorder)
+        Checkpoint(config.get('ETL', 'CHECKPOINT_FILE', fallback='etl_checkpoint.txt')).clear()
         print("Drop table queries complete")
     except Exception as e:
         print("Error dropping tables: ", e)
         print("Closing connection to data warehouse...")
-        conn.close()
+        db.close()
         sys.exit()
 
     # Running Create Table queries
     print("Running Create Table queries...")
     try:
-        create_tables(cur, conn)
+        create_tables(db, recorder)
         print("Create table queries complete")
     except Exception as e:
         print("Error creating tables: ", e)
         print("Closing connection to data warehouse...")
-        conn.close()
+        db.close()
         sys.exit()
 
     # Closing connection
     print("Closing connection to data warehouse...")
-    conn.close()
+    db.close()
 
 
 """
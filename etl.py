@@ -1,49 +1,499 @@
+import argparse                 # Command line options
 import configparser             # Parse configuration file
-import psycopg2                 # PostgreSQL database adapter for the Python
 import sys                      # Used for exiting python script in case of error
-from sql_queries import copy_table_queries, insert_table_queries            # SQL query definitions
+import hashlib                  # Checkpoint keys of manifest COPYs
+from datetime import datetime, timezone                                     # Manifest names and S3 modified times
+from sql_queries import registry, insert_table_steps                        # SQL query definitions
+from sql_queries import keyed_table_truncates, match_key_queries, unmatched_events_select     # Song match key SQL query definitions
+from sql_queries import (staging_events_truncate, staging_songs_truncate, merge_table_queries,
+                         songplay_merge_queries, load_state_select, staging_events_max_ts_select,
+                         load_state_delete, slice_count_select)     # Incremental load SQL query definitions
+from sql_queries import (star_tables, table_grants_select, relation_privileges_stub_create, dependent_views_select,
+                         grant_sql)                                 # Shadow table swap SQL query definitions
+from sql_queries import rollup_merge_queries                        # Rollup table SQL query definitions
+from sql_queries import (stream_table_drops, stream_songs_create, stream_time_create, stream_songplays_create,
+                         stream_songs_insert, stream_time_insert, stream_songplays_insert, stream_merge_queries,
+                         time_stream_merge, songplay_stream_merge,
+                         rollup_stream_queries)                             # Streaming load SQL query definitions
+from scheduler import run_queries_parallel                                  # Dependency aware parallel query runner
+from metrics import MetricsRecorder, run_statement                          # Per statement timing and row counts
+from connection import ConnectionManager, Checkpoint                        # Connection pool, retries, and checkpoints
+from manifest import (split_s3_path, list_new_objects, build_manifest, upload_manifest,
+                      pack_manifests, print_manifest_report)                # S3 listing and COPY manifests
+from stream import (BatchWriter, SongIndex, read_object_records, stream_songs, stream_events,
+                    upsert_users)                                           # Python transforms of the streaming load
+from maintenance import maintain_tables                                     # Post load VACUUM and ANALYZE
+from explain import dry_run                                                 # EXPLAIN plan capture and regression checks
 
 """
 Purpose:
-    Loops through copy_table_queries list and runs COPY queries
-    copy_table_queries are defined in sql_queries file
+    Empties the staging tables, then loops through copy_table_queries list and runs COPY queries
+    COPY appends, so without the TRUNCATEs every full load would add another copy of the source files to staging
+    The TRUNCATEs are checkpointed like the COPYs, so a resumed run doesn't empty tables it already loaded
+    copy_table_queries are rendered from config by the registry in sql_queries file
 Arg:
-    cur - Redshift connection cursor [Required]
-    conn - Redshift connection [Required]
+    db - ConnectionManager running and committing each query [Required]
+    recorder - MetricsRecorder collecting per statement metrics [Optional]
 """
-def load_staging_tables(cur, conn):
+def load_staging_tables(db, recorder=None):
+    copy_table_queries = [staging_events_truncate, staging_songs_truncate] + registry.get('copy_table_queries')
     num_queries = len(copy_table_queries)
     query_count = 0
     for query in copy_table_queries:
         query_count += 1
         print("Running ", query_count, "/", num_queries, " COPY table queries")
-        cur.execute(query)
-        conn.commit()
+        db.run(query, 'copy', recorder)
 
 """
 Purpose:
-    Loops through insert_table_queries list and runs insert queries
-    insert_table_queries are defined in sql_queries file
+    Empties the keyed staging table and rebuilds it from the events just copied, computing the song
+      match key of every row as it is inserted
+    keyed_table_truncates and match_key_queries are defined in sql_queries file
+Arg:
+    db - ConnectionManager running and committing each query [Required]
+    recorder - MetricsRecorder collecting per statement metrics [Optional]
+"""
+def build_keyed_tables(db, recorder=None):
+    queries = keyed_table_truncates + match_key_queries
+    num_queries = len(queries)
+    query_count = 0
+    for query in queries:
+        query_count += 1
+        print("Running ", query_count, "/", num_queries, " match key queries")
+        db.run(query, 'match_key', recorder)
+
+"""
+Purpose:
+    Prints how many NextSong events in staging have no song with the same match key
+    Those events are left out of songplays, so a jump in this count points at a data or key problem
 Arg:
     cur - Redshift connection cursor [Required]
-    conn - Redshift connection [Required]
 """
-def insert_tables(cur, conn):
-    num_queries = len(insert_table_queries)
+def report_unmatched_events(cur):
+    cur.execute(unmatched_events_select)
+    total, unmatched = cur.fetchone()
+    print("NextSong events: ", total, ", without a matching song: ", unmatched or 0)
+
+"""
+Purpose:
+    Loops through insert_table_steps list and runs insert queries in insert_table_queries order
+    insert_table_steps are defined in sql_queries file
+Arg:
+    db - ConnectionManager running and committing each query [Required]
+    recorder - MetricsRecorder collecting per statement metrics [Optional]
+"""
+def insert_tables(db, recorder=None):
+    num_queries = len(insert_table_steps)
     query_count = 0
-    for query in insert_table_queries:
+    # Named after insert_table_steps, so metrics and checkpoints line up with insert_tables_parallel()
+    for step in insert_table_steps:
         query_count += 1
         print("Running ", query_count, "/", num_queries, " INSERT table queries")
-        cur.execute(query)
-        conn.commit()
+        db.run(step['query'], 'insert', recorder, name=step['name'])
+
+"""
+Purpose:
+    Runs insert_table_queries in parallel using a pool of connections
+    Each query only starts once the queries producing the tables it reads have finished;
+      independent queries (e.g. songs, artists, and time inserts) run at the same time
+    insert_table_steps are defined in sql_queries file
+Arg:
+    db - ConnectionManager; its pool size limits how many queries run at once [Required]
+    recorder - MetricsRecorder collecting per statement metrics [Optional]
+"""
+def insert_tables_parallel(db, recorder=None):
+    run_queries_parallel(insert_table_steps, db, "INSERT table", 'insert', recorder)
+
+"""
+Purpose:
+    Reads the high-water mark of a source dataset from etl_load_state control table
+Arg:
+    cur - Redshift connection cursor [Required]
+    dataset - source dataset name, 'log_data' or 'song_data' [Required]
+Returns:
+    tuple of (last_key, last_modified, max_ts); all None if the dataset was never loaded incrementally
+"""
+def get_load_state(cur, dataset):
+    cur.execute(load_state_select, (dataset,))
+    row = cur.fetchone()
+    return row if row is not None else (None, None, None)
+
+"""
+Purpose:
+    Writes the high-water mark of each source dataset to etl_load_state control table
+    Doesn't commit; caller commits so the mark only moves along with the data it describes
+Arg:
+    cur - Redshift connection cursor [Required]
+    state - dict of dataset name to (last_key, last_modified, max_ts) [Required]
+    target - registry target the statements are rendered for [Optional]
+"""
+def save_load_state(cur, state, target=None):
+    for dataset, (last_key, last_modified, max_ts) in state.items():
+        cur.execute(load_state_delete, (dataset,))
+        cur.execute(registry.get('load_state_insert', target), (dataset, last_key, last_modified, max_ts))
+
+"""
+Purpose:
+    Describes the two source datasets and the staging table each one is copied into
+Arg:
+    config - parsed dwh.cfg config [Required]
+Returns:
+    list of dicts with 'dataset', 'table', 'path', 'by_key', 'truncate', and 'copy' (manifest COPY template)
+"""
+def staging_sources(config):
+    return [{'dataset': 'log_data', 'table': 'staging_events', 'path': config['S3']['LOG_DATA'], 'by_key': True,
+             'truncate': staging_events_truncate, 'copy': registry.get('staging_events_manifest_copy')},
+            {'dataset': 'song_data', 'table': 'staging_songs', 'path': config['S3']['SONG_DATA'], 'by_key': False,
+             'truncate': staging_songs_truncate, 'copy': registry.get('staging_songs_manifest_copy')}]
+
+"""
+Purpose:
+    Reads the number of slices in the cluster from stv_slices
+    Can be overridden by SLICES in the ETL section of config file
+Arg:
+    cur - Redshift connection cursor [Required]
+    config - parsed dwh.cfg config [Required]
+"""
+def get_slice_count(cur, config):
+    if config.has_option('ETL', 'SLICES'):
+        return config.getint('ETL', 'SLICES')
+    cur.execute(slice_count_select)
+    return cur.fetchone()[0]
+
+"""
+Purpose:
+    Packs listed S3 files into manifests sized to the cluster slice count, writes them under
+      MANIFEST_PREFIX, and runs one COPY per manifest
+    COPYs into the same staging table run one after another, while COPYs into staging_events and
+      staging_songs run at the same time on separate connections
+Arg:
+    db - ConnectionManager; a pool of two connections is enough to copy both tables at once [Required]
+    s3 - boto3 S3 client [Required]
+    config - parsed dwh.cfg config [Required]
+    num_slices - number of slices in the cluster [Required]
+    loads - list of (source, objects) pairs; source from staging_sources(), objects from list_new_objects() [Required]
+    recorder - MetricsRecorder collecting per statement metrics [Optional]
+"""
+def copy_from_manifests(db, s3, config, num_slices, loads, recorder=None):
+    run_id = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')
+    manifest_prefix = config['S3']['MANIFEST_PREFIX'].rstrip('/')
+    files_per_slice = config.getint('ETL', 'FILES_PER_SLICE', fallback=1000)
+
+    steps = []
+    for source, objects in loads:
+        bucket, _ = split_s3_path(source['path'])
+        manifests = pack_manifests(objects, num_slices, files_per_slice)
+        print_manifest_report(source['dataset'], manifests)
+        for i, m in enumerate(manifests, 1):
+            manifest_path = upload_manifest(s3, "{}/{}-{}-{}.manifest".format(manifest_prefix, source['dataset'], run_id, i),
+                                            build_manifest(bucket, m['keys'], m['sizes']))
+            # Checkpoint key names the files, not the manifest number, so a resumed run never skips a manifest
+            #   whose files changed because new files were listed
+            files_hash = hashlib.md5('\n'.join(m['keys']).encode('utf-8')).hexdigest()
+            steps.append({'name': "{} manifest {}".format(source['dataset'], i), 'query': source['copy'].format(manifest_path),
+                          'reads': [], 'writes': [source['table']], 'key': "copy:{} {}".format(source['dataset'], files_hash)})
+    run_queries_parallel(steps, db, "COPY table", 'copy', recorder)
+
+"""
+Purpose:
+    Copies every S3 file into the staging tables through generated manifests instead of one COPY per prefix
+    Staging tables are emptied first, like load_staging_tables(); checkpointed so a resumed run keeps what it copied
+    Used in place of load_staging_tables() when PARTITIONED_COPY is set in the ETL section of config file
+Arg:
+    db - ConnectionManager [Required]
+    s3 - boto3 S3 client [Required]
+    config - parsed dwh.cfg config [Required]
+    recorder - MetricsRecorder collecting per statement metrics [Optional]
+"""
+def load_staging_tables_partitioned(db, s3, config, recorder=None):
+    num_slices = db.run_transaction(None, lambda cur: get_slice_count(cur, config))
+    loads = []
+    for source in staging_sources(config):
+        bucket, prefix = split_s3_path(source['path'])
+        print("Listing ", source['dataset'], " files...")
+        loads.append((source, list_new_objects(s3, bucket, prefix, suffix=registry.get('copy_file_suffix'))))
+    for source in staging_sources(config):
+        db.run(source['truncate'], 'copy', recorder)
+    copy_from_manifests(db, s3, config, num_slices, loads, recorder)
+
+"""
+Purpose:
+    Lists the S3 files added since the last load of each source dataset
+    Events (log) files are named by day, so the listing starts after the last loaded key;
+      song files are picked up by modified time
+Arg:
+    cur - Redshift connection cursor [Required]
+    s3 - boto3 S3 client [Required]
+    config - parsed dwh.cfg config [Required]
+Returns:
+    tuple of (state, loads)
+      state - dict of dataset name to (last_key, last_modified, max_ts) to be saved once the load completes
+      loads - list of (source, objects) pairs for the datasets with new files
+"""
+def list_new_files(cur, s3, config):
+    state = {}
+    loads = []
+    for source in staging_sources(config):
+        last_key, last_modified, max_ts = get_load_state(cur, source['dataset'])
+        if last_modified is not None:
+            last_modified = last_modified.replace(tzinfo=timezone.utc)
+
+        bucket, prefix = split_s3_path(source['path'])
+        print("Listing new ", source['dataset'], " files...")
+        if source['by_key']:
+            objects = list_new_objects(s3, bucket, prefix, start_after=last_key, suffix=registry.get('copy_file_suffix'))
+        else:
+            objects = list_new_objects(s3, bucket, prefix, modified_after=last_modified, suffix=registry.get('copy_file_suffix'))
+        print("Found ", len(objects), " new ", source['dataset'], " files")
+
+        if objects:
+            loads.append((source, objects))
+            last_key = objects[-1]['key']
+            last_modified = max(o['last_modified'] for o in objects)
+
+        if last_modified is not None:
+            last_modified = last_modified.astimezone(timezone.utc).replace(tzinfo=None)
+        state[source['dataset']] = (last_key, last_modified, max_ts)
+    return state, loads
+
+"""
+Purpose:
+    Copies only the S3 files added since the last load into the staging tables
+    Staging tables are emptied first so they only hold the current increment
+    New files are listed by list_new_files() and copied through manifests by copy_from_manifests()
+Arg:
+    db - ConnectionManager [Required]
+    s3 - boto3 S3 client [Required]
+    config - parsed dwh.cfg config [Required]
+    recorder - MetricsRecorder collecting per statement metrics [Optional]
+Returns:
+    dict of dataset name to (last_key, last_modified, max_ts) to be saved once the merge completes
+"""
+def load_staging_tables_incremental(db, s3, config, recorder=None):
+    num_slices = db.run_transaction(None, lambda cur: get_slice_count(cur, config))
+    state, loads = db.run_transaction(None, lambda cur: list_new_files(cur, s3, config))
+    for source in staging_sources(config):
+        db.run(source['truncate'], 'copy', recorder)
+    copy_from_manifests(db, s3, config, num_slices, loads, recorder)
+    return state
+
+"""
+Purpose:
+    Merges the increment held in staging tables into the fact and dimension tables
+    merge_table_queries are run and committed one at a time; each of them can be rerun safely
+    songplay_merge_queries, the rollup refresh, and the new high-water marks are committed together, so a failed
+      run never skips or duplicates song plays on the next run; rollups add only the song plays of this run,
+      read from the same new_songplays temporary table that songplays is merged from
+Arg:
+    db - ConnectionManager running and committing each query [Required]
+    state - high-water marks returned by load_staging_tables_incremental() [Required]
+    recorder - MetricsRecorder collecting per statement metrics [Optional]
+"""
+def insert_tables_incremental(db, state, recorder=None):
+    num_queries = len(merge_table_queries) + 1
+    query_count = 0
+    for query in merge_table_queries:
+        query_count += 1
+        print("Running ", query_count, "/", num_queries, " MERGE table queries")
+        db.run(query, 'merge', recorder)
+
+    print("Running ", num_queries, "/", num_queries, " MERGE table queries")
+    def merge_songplays(cur):
+        cur.execute(staging_events_max_ts_select)
+        staged_max_ts = cur.fetchone()[0]
+        for query in songplay_merge_queries:
+            run_statement(cur, query, 'merge', recorder)
+        for query in rollup_merge_queries:
+            run_statement(cur, query, 'rollup', recorder)
+        new_state = dict(state)
+        last_key, last_modified, max_ts = state['log_data']
+        if staged_max_ts is not None:
+            new_state['log_data'] = (last_key, last_modified, max(staged_max_ts, max_ts or 0))
+        save_load_state(cur, new_state)
+    db.run_transaction('merge:songplays and load state', merge_songplays)
+
+"""
+Purpose:
+    Loads the files added since the last load without staging tables, for small intraday increments
+    Records are read from S3 one line at a time and transformed in Python by stream.py: new songs are merged
+      first, then events are matched against an in-memory index of every song, and only the finished time,
+      songplays, and users rows are sent to the database, in batches of at most STREAM_BATCH_ROWS rows
+    Memory holds one batch, the song index, and the latest record of each user in the new events,
+      whatever the size of the files
+    Everything, including the new high-water marks, is committed in one transaction, so a failed run
+      is simply rerun
+Arg:
+    db - ConnectionManager [Required]
+    s3 - boto3 S3 client [Required]
+    config - parsed dwh.cfg config [Required]
+    recorder - MetricsRecorder collecting per statement metrics [Optional]
+"""
+def load_tables_streaming(db, s3, config, recorder=None):
+    if registry.get('copy_format') == 'parquet':
+        raise ValueError("LOAD_MODE 'stream' reads JSON source files; COPY_FORMAT 'parquet' isn't supported")
+    batch_rows = config.getint('ETL', 'STREAM_BATCH_ROWS', fallback=10000)
+    state, loads = db.run_transaction(None, lambda cur: list_new_files(cur, s3, config))
+    files = {source['dataset']: objects for source, objects in loads}
+    sources = {source['dataset']: source for source in staging_sources(config)}
+
+    def records(dataset):
+        bucket, _ = split_s3_path(sources[dataset]['path'])
+        num_files = len(files.get(dataset, []))
+        for file_count, o in enumerate(files.get(dataset, []), 1):
+            print("Streaming ", file_count, "/", num_files, " ", dataset, " files")
+            yield from read_object_records(s3, bucket, o['key'])
+
+    def load(cur):
+        for query in stream_table_drops + [stream_songs_create, stream_time_create, stream_songplays_create]:
+            cur.execute(query)
+
+        # Songs go first, so events can match songs added by the same load
+        songs = BatchWriter(cur, stream_songs_insert, batch_rows)
+        rejected = stream_songs(songs, records('song_data'))
+        songs.flush()
+        print("Streamed ", songs.rows, " song rows, ", rejected, " rejected")
+        for query in stream_merge_queries:
+            run_statement(cur, query, 'stream', recorder)
+
+        index = SongIndex(cur)
+        print("Indexed ", len(index), " songs")
+        last_key, last_modified, max_ts = state['log_data']
+        time_rows = BatchWriter(cur, stream_time_insert, batch_rows)
+        songplays = BatchWriter(cur, stream_songplays_insert, batch_rows)
+        users = {}
+        stats = {'events': 0, 'rejected': 0, 'nextsong': 0, 'unmatched': 0, 'max_ts': None}
+        stream_events(time_rows, songplays, records('log_data'), index, max_ts or 0, users, stats)
+        time_rows.flush()
+        songplays.flush()
+        print("Streamed ", stats['events'], " events, ", stats['rejected'], " rejected; ", stats['unmatched'], " of ",
+              stats['nextsong'], " new NextSong events without a matching song")
+
+        upsert_users(cur, users, batch_rows)
+        run_statement(cur, time_stream_merge, 'stream', recorder)
+        run_statement(cur, songplay_stream_merge, 'stream', recorder)
+        for query in rollup_stream_queries:
+            run_statement(cur, query, 'rollup', recorder)
+
+        new_state = dict(state)
+        if stats['max_ts'] is not None:
+            new_state['log_data'] = (last_key, last_modified, max(stats['max_ts'], max_ts or 0))
+        save_load_state(cur, new_state)
+        for query in stream_table_drops:
+            cur.execute(query)
+    db.run_transaction('stream:load', load)
+
+"""
+Purpose:
+    Records the max event ts after a full load so a following incremental load doesn't add the
+      same song plays again
+    S3 keys aren't listed in full mode; the first incremental load after it lists every file once
+Arg:
+    cur - Redshift connection cursor [Required]
+    target - registry target the statements are rendered for [Optional]
+"""
+def save_full_load_state(cur, target=None):
+    cur.execute(staging_events_max_ts_select)
+    save_load_state(cur, {'log_data': (None, None, cur.fetchone()[0])}, target)
+
+"""
+Purpose:
+    Rebuilds the rollup tables from every row in songplays and users after a full load
+    Doesn't commit; caller runs it in the transaction that loaded songplays, or as its own unit of work
+    rollup_rebuild_queries are defined in sql_queries file
+Arg:
+    cur - Redshift connection cursor [Required]
+    recorder - MetricsRecorder collecting per statement metrics [Optional]
+    target - registry target the statements are rendered for [Optional]
+"""
+def rebuild_rollups(cur, recorder=None, target=None):
+    for query in registry.get('rollup_rebuild_queries', target):
+        run_statement(cur, query, 'rollup', recorder)
+
+"""
+Purpose:
+    Reads the grants on the star schema tables so they can be applied again once the shadow tables take their place
+    Fails before anything is dropped if a regular view reads one of the tables, as DROP TABLE would fail on it
+      and dropping the view would lose it; late-binding views (WITH NO SCHEMA BINDING) aren't affected
+Arg:
+    cur - Redshift connection cursor [Required]
+Returns:
+    list of GRANT statements for the swapped in tables
+"""
+def star_table_grants(cur):
+    cur.execute(dependent_views_select, (star_tables,))
+    views = cur.fetchall()
+    if views:
+        raise ValueError("SINGLE_TRANSACTION can't replace tables read by views; recreate them WITH NO SCHEMA BINDING: "
+                         + ", ".join("{} reads {}".format(view, table) for view, table in views))
+    cur.execute(table_grants_select, (star_tables,))
+    grants = [grant_sql(*row) for row in cur.fetchall()]
+    return [grant for grant in grants if grant is not None]
+
+"""
+Purpose:
+    Rebuilds the fact and dimension tables in shadow tables and swaps them in, all in one transaction
+    Every statement runs on one connection and nothing is committed until the end, so readers see the
+      old tables right up to the swap and a failure rolls everything back, leaving them untouched
+    Grants on the old tables are applied to the new ones after the swap; views bound to the old tables aren't supported
+    Rollups are rebuilt from the new songplays and the full load high-water mark is written in the same transaction
+    A transient error retries the whole transaction, as it starts by dropping any leftover shadow tables
+    Statements are rendered for the target, so the swap can be tried on a local PostgreSQL (DIALECT = 'postgres')
+    The shadow tables start empty and the staging tables are truncated before every full COPY, so a reload
+      doesn't need create_table.py to be run first
+    Used in place of insert_tables() when SINGLE_TRANSACTION is set in the ETL section of config file
+Arg:
+    db - ConnectionManager running and committing the transaction [Required]
+    recorder - MetricsRecorder collecting per statement metrics [Optional]
+    target - registry target the statements are rendered for [Optional]
+"""
+def insert_tables_shadow(db, recorder=None, target=None):
+    if registry.dialect(target) == 'postgres':
+        db.run_transaction(None, lambda cur: cur.execute(relation_privileges_stub_create))
+    stages = [('shadow', registry.get('shadow_create_table_queries', target)),
+              ('insert', registry.get('shadow_insert_table_queries', target)),
+              ('swap', registry.get('shadow_swap_table_queries', target))]
+    num_queries = sum(len(queries) for _, queries in stages)
+
+    def rebuild(cur):
+        query_count = 0
+        for stage, queries in stages:
+            # Grants are read before the swap drops the old tables
+            if stage == 'swap':
+                grants = star_table_grants(cur)
+            for query in queries:
+                query_count += 1
+                print("Running ", query_count, "/", num_queries, " SHADOW table queries")
+                run_statement(cur, query, stage, recorder)
+        for grant in grants:
+            run_statement(cur, grant, 'grant', recorder)
+        rebuild_rollups(cur, recorder, target)
+        save_full_load_state(cur, target)
+    db.run_transaction('swap:shadow tables', rebuild)
 
 """
 Purpose:
     Reads Redshift Cluster connection info stored in dwh.cfg config file
-    Connects to cluster using config details and retrieves Connection and Cursor handle
+    Opens a pool of connections to the cluster using config details
     Upon connecting successfully, calls load_staging_tables() and insert_tables() functions
+    Every statement is retried on transient errors; in full mode, completed statements are recorded in a
+      checkpoint file so a failed run resumes from the failed statement when rerun
+    Optional settings in the ETL section of config file change how each stage runs:
+      PARALLEL_CONNECTIONS - opens that many connections and calls insert_tables_parallel() instead of insert_tables()
+      SINGLE_TRANSACTION - full loads rebuild the tables with insert_tables_shadow() and commit once
+      PARTITIONED_COPY - copies through generated manifests with load_staging_tables_partitioned()
+      LOAD_MODE - 'incremental' copies and merges only the files added since the last run
+      METRICS_FILE - JSON lines file every statement's metrics are appended to (default etl_metrics.jsonl)
+      SERVER_METRICS - look up query ids and COPY load statistics in Redshift system tables (default true)
+      CHECKPOINT_FILE - completed statements of a full load (default etl_checkpoint.txt)
+      RETRIES, RETRY_BACKOFF, STATEMENT_TIMEOUT - see ConnectionManager in connection.py
 """
 def main():
+    parser = argparse.ArgumentParser(description="Load the Sparkify song and log data into the Redshift star schema")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="EXPLAIN every statement that doesn't depend on COPY and compare the plans with the baseline")
+    parser.add_argument('--update-baseline', action='store_true', help="with --dry-run, save the plans as the new baseline")
+    args = parser.parse_args()
+
     config = configparser.ConfigParser()    
     # Open and Read config file to retrieve Cluster and DWH details required to connect
     print("Reading 'dwh.cfg' Config file...")
@@ -53,52 +503,136 @@ def main():
     except Exception as e:
         print("Error reading config file: ", e)
         sys.exit()
+    # SQL statements are rendered from the same parsed config instead of reading the file again
+    registry.use_config(config)
+
+    load_mode = config.get('ETL', 'LOAD_MODE', fallback='full')
+    incremental = load_mode == 'incremental'
+    streaming = load_mode == 'stream'
+    partitioned = config.getboolean('ETL', 'PARTITIONED_COPY', fallback=False)
+    single_transaction = config.getboolean('ETL', 'SINGLE_TRANSACTION', fallback=False)
 
-    # Creating a connection using Cluster and DWH details stored in config file
+    # Incremental loads are rerun from the start: staging is truncated first and every merge can be rerun safely,
+    #   while a new file listing could pack different files into manifests a checkpoint marks as done
+    checkpoint = None if incremental or streaming else Checkpoint(config.get('ETL', 'CHECKPOINT_FILE', fallback='etl_checkpoint.txt'))
+    if checkpoint is not None and checkpoint.keys:
+        print("Resuming from checkpoint; ", len(checkpoint.keys), " statements completed in an earlier run")
+
+    # Opening the pool of connections used by every stage; PARALLEL_CONNECTIONS sets its size
     print("Connecting to Data Warehouse...")
     try:
-        conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-        print("Connected to Data Warehouse")
+        db = ConnectionManager.from_config(config, checkpoint).open()
+        print("Connected to Data Warehouse with ", db.size, " connections")
     except Exception as e:
         print("Error connecting Data Warehouse: ", e)
         sys.exit()
 
-    # Getting conection cursor
-    print("Getting Cursor")
-    try:
-        cur = conn.cursor()
-        print("Connection cursor retrieved")
-    except Exception as e:
-        print("Error getting connection cursor: ", e)
-        print("Closing connection to data warehouse...")
-        conn.close()
-        sys.exit()
-    
-    # Executing COPY commands defined in sql_queries file
-    print("Loading staging tables")
-    try:
-        load_staging_tables(cur, conn)
-        print("Loading staging tables complete")
-    except Exception as e:
-        print('Error loading staging table: ', e)
-        print("Closing connection to data warehouse...")
-        conn.close()
-        sys.exit()
-        
-    # Executing INSERT commands defined in sql_queries file
-    print("Inserting rows into DWH tables from staging tables")
-    try:
-        insert_tables(cur, conn)
-        print("Inserting rows into DWH tables complete")
-    except Exception as e:
-        print('Error inserting data in DWH: ', e)
-        print("Closing connection to data warehouse...")
-        conn.close()
-        sys.exit()
+    # Dry run only plans statements; nothing is loaded, and plan regressions fail the run
+    if args.dry_run:
+        print("Explaining statements")
+        try:
+            report = dry_run(db, config, args.update_baseline)
+        finally:
+            print("Closing connections to data warehouse...")
+            db.close()
+        sys.exit(1 if report else 0)
+
+    recorder = MetricsRecorder(config.get('ETL', 'METRICS_FILE', fallback='etl_metrics.jsonl'),
+                               config.getboolean('ETL', 'SERVER_METRICS', fallback=True))
+    print("Recording statement metrics for run ", recorder.run_id)
+
+    if incremental or streaming or partitioned:
+        import boto3            # AWS SDK; only needed to list S3 files and write manifests
+        s3 = boto3.client('s3', region_name='us-west-2')
+
+    # Stream mode transforms new files in Python and loads the finished rows without staging tables
+    if streaming:
+        print("Streaming new files into DWH tables")
+        try:
+            load_tables_streaming(db, s3, config, recorder)
+            print("Streaming new files complete")
+        except Exception as e:
+            print('Error streaming data into DWH: ', e)
+            print("Closing connections to data warehouse...")
+            db.close()
+            sys.exit()
+
+    # Incremental mode copies and merges only new files
+    elif incremental:
+        print("Loading new files into staging tables")
+        try:
+            state = load_staging_tables_incremental(db, s3, config, recorder)
+            build_keyed_tables(db, recorder)
+            print("Loading staging tables complete")
+        except Exception as e:
+            print('Error loading staging table: ', e)
+            print("Closing connections to data warehouse...")
+            db.close()
+            sys.exit()
+
+        print("Merging new rows into DWH tables from staging tables")
+        try:
+            insert_tables_incremental(db, state, recorder)
+            print("Merging rows into DWH tables complete")
+        except Exception as e:
+            print('Error merging data in DWH: ', e)
+            print("Closing connections to data warehouse...")
+            db.close()
+            sys.exit()
+
+    else:
+        # Executing COPY commands defined in sql_queries file
+        print("Loading staging tables")
+        try:
+            if partitioned:
+                load_staging_tables_partitioned(db, s3, config, recorder)
+            else:
+                load_staging_tables(db, recorder)
+            build_keyed_tables(db, recorder)
+            print("Loading staging tables complete")
+        except Exception as e:
+            print('Error loading staging table: ', e)
+            print("Rerun to resume from the failed statement")
+            print("Closing connections to data warehouse...")
+            db.close()
+            sys.exit()
+
+        # Executing INSERT commands defined in sql_queries file
+        print("Inserting rows into DWH tables from staging tables")
+        try:
+            if single_transaction:
+                insert_tables_shadow(db, recorder)
+            else:
+                if db.size > 1:
+                    insert_tables_parallel(db, recorder)
+                else:
+                    insert_tables(db, recorder)
+                print("Rebuilding rollup tables")
+                db.run_transaction('rollup:rebuild', lambda cur: rebuild_rollups(cur, recorder))
+                db.run_transaction('state:full load', save_full_load_state)
+            # Events are matched to the match keys stored in songs, so they can only be counted once songs is loaded
+            db.run_transaction(None, report_unmatched_events)
+            print("Inserting rows into DWH tables complete")
+        except Exception as e:
+            print('Error inserting data in DWH: ', e)
+            print("Rerun to resume from the failed statement")
+            print("Closing connections to data warehouse...")
+            db.close()
+            sys.exit()
+        checkpoint.clear()
+
+    # VACUUM and ANALYZE the tables past the thresholds; the load is already committed, so a failure here is only reported
+    if config.getboolean('ETL', 'MAINTENANCE', fallback=True):
+        print("Running table maintenance")
+        try:
+            maintain_tables(db, config, recorder)
+            print("Table maintenance complete")
+        except Exception as e:
+            print('Error running table maintenance: ', e)
 
-    # Closing connection
-    print("Closing connection to data warehouse...")
-    conn.close()
+    # Closing connections
+    print("Closing connections to data warehouse...")
+    db.close()
 
 """
     Run above code if the file is labled __main__
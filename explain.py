@@ -0,0 +1,300 @@
+import argparse                 # Command line options
+import json                     # Plan captures and baseline are stored as JSON
+import re                       # Parse EXPLAIN output
+from sql_queries import registry                                       # SQL query definitions rendered per target
+from metrics import statement_name                                     # Short, stable statement names
+
+"""
+  Statement lists explained by the dry run, as (group, registry name)
+  Only statements that read tables already in the cluster are included; COPY needs S3 files, and the temporary
+    tables of the streaming load and of the incremental songplays merge only exist inside their transactions,
+    so the songplays merge is explained through the statement that fills new_songplays
+"""
+EXPLAIN_GROUPS = [('match_key', 'match_key_queries'),
+                  ('insert', 'insert_table_queries'),
+                  ('merge', 'merge_table_queries'),
+                  ('merge', 'new_songplays_create'),
+                  ('rollup', 'rollup_rebuild_queries'),
+                  ('analytical', 'analytical_queries'),
+                  ('rollup_queries', 'rollup_queries')]
+
+"""
+  Join distribution labels that need no data movement; every other DS_ label redistributes or broadcasts rows
+"""
+LOCAL_DISTRIBUTIONS = {'DS_DIST_NONE', 'DS_DIST_ALL_NONE'}
+
+"""
+  One plan node line, in Redshift or PostgreSQL EXPLAIN format, e.g.
+    ->  XN Hash Join DS_BCAST_INNER  (cost=0.10..1000.50 rows=120 width=64)
+    ->  Seq Scan on songs s  (cost=0.00..10.70 rows=70 width=92)
+"""
+PLAN_NODE = re.compile(r'^(?P<indent>\s*)(?:->\s+)?(?:XN\s+)?(?P<op>.+?)(?:\s+(?P<dist>DS_[A-Z_]+))?'
+                       r'(?:\s+on\s+(?P<relation>[\w."]+)(?:\s+\w+)?)?'
+                       r'\s+\(cost=(?P<startup>[\d.]+)\.\.(?P<total>[\d.]+)\s+rows=(?P<rows>\d+)\s+width=(?P<width>\d+)\)')
+
+"""
+Purpose:
+    Parses EXPLAIN output into a tree of plan nodes
+    Lines that aren't nodes (join conditions, sort keys, 'Send to leader') are kept as details of the node above
+      them; Redshift's '-----' notices (e.g. about nested loop joins) are kept as plan warnings
+Arg:
+    text - EXPLAIN output, one plan line per line [Required]
+Returns:
+    root node dict with 'op', 'dist', 'relation', 'startup_cost', 'total_cost', 'rows', 'width', 'details',
+      and 'children'; plus 'warnings' on the root. None when text holds no plan node
+"""
+def parse_plan(text):
+    root = None
+    stack = []
+    warnings = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        if line.strip().startswith('-----'):
+            warnings.append(line.strip(' -'))
+            continue
+        match = PLAN_NODE.match(line)
+        if match is None:
+            if stack:
+                stack[-1][1]['details'].append(line.strip())
+            continue
+        node = {'op': match.group('op').strip(), 'dist': match.group('dist'), 'relation': match.group('relation'),
+                'startup_cost': float(match.group('startup')), 'total_cost': float(match.group('total')),
+                'rows': int(match.group('rows')), 'width': int(match.group('width')), 'details': [], 'children': []}
+        indent = len(line) - len(line.lstrip())
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+        if stack:
+            stack[-1][1]['children'].append(node)
+        elif root is None:
+            root = node
+        stack.append((indent, node))
+    if root is not None:
+        root['warnings'] = warnings
+    return root
+
+"""
+Purpose:
+    Yields a plan node and every node below it
+Arg:
+    node - plan node returned by parse_plan() [Required]
+"""
+def walk(node):
+    yield node
+    for child in node['children']:
+        yield from walk(child)
+
+"""
+Purpose:
+    Reduces a plan to the figures regressions are judged on
+Arg:
+    plan - root node returned by parse_plan() [Required]
+Returns:
+    dict with 'cost' (total cost of the root), 'rows', 'data_movement' (count of each join step that moves data,
+      keyed by '<op> <DS_ label>'), and 'nested_loops'
+"""
+def summarize(plan):
+    movement = {}
+    nested_loops = 0
+    for node in walk(plan):
+        if node['dist'] and node['dist'] not in LOCAL_DISTRIBUTIONS:
+            step = "{} {}".format(node['op'], node['dist'])
+            movement[step] = movement.get(step, 0) + 1
+        if 'Nested Loop' in node['op']:
+            nested_loops += 1
+    return {'cost': plan['total_cost'], 'rows': plan['rows'], 'data_movement': movement, 'nested_loops': nested_loops}
+
+"""
+Purpose:
+    Compares the summary of a statement's plan with its baseline summary
+Arg:
+    baseline - summarize() result of the baseline plan [Required]
+    current - summarize() result of the current plan [Required]
+    cost_increase - cost ratio over the baseline reported as a regression [Optional]
+Returns:
+    list of regression messages; empty when the plan is no worse
+"""
+def compare_summaries(baseline, current, cost_increase=1.5):
+    findings = []
+    for step, count in sorted(current['data_movement'].items()):
+        before = baseline['data_movement'].get(step, 0)
+        if count > before:
+            findings.append("{} new {} step(s)".format(count - before, step))
+    if current['nested_loops'] > baseline['nested_loops']:
+        findings.append("{} new nested loop join(s)".format(current['nested_loops'] - baseline['nested_loops']))
+    if baseline['cost'] > 0 and current['cost'] > baseline['cost'] * cost_increase:
+        findings.append("cost up {:.1f}x ({:.2f} -> {:.2f})".format(current['cost'] / baseline['cost'], baseline['cost'],
+                                                                   current['cost']))
+    return findings
+
+"""
+Purpose:
+    Compares captured plans with a baseline capture, re-parsing the saved plan text of both
+Arg:
+    baseline - capture dict, as written by capture_plans() [Required]
+    current - capture dict [Required]
+    cost_increase - cost ratio over the baseline reported as a regression [Optional]
+Returns:
+    dict of statement name to list of messages; only statements with something to report are included
+"""
+def compare_plans(baseline, current, cost_increase=1.5):
+    report = {}
+    for name, entry in current['statements'].items():
+        if entry.get('error'):
+            report[name] = ["EXPLAIN failed: {}".format(entry['error'])]
+            continue
+        before = baseline['statements'].get(name)
+        if before is None or before.get('error'):
+            report[name] = ["no baseline plan"]
+            continue
+        plan, before_plan = parse_plan(entry['plan']), parse_plan(before['plan'])
+        if plan is None or before_plan is None:
+            report[name] = ["plan could not be parsed"]
+            continue
+        findings = compare_summaries(summarize(before_plan), summarize(plan), cost_increase)
+        if findings:
+            report[name] = findings
+    return report
+
+"""
+Purpose:
+    Lists the statements the dry run explains, each named '<group>:<statement name>'
+    Strings holding several statements (e.g. an UPDATE followed by an INSERT) are explained one statement at a time,
+      as EXPLAIN takes a single statement; statements shared by several lists are explained once
+Arg:
+    target - registry target the statements are rendered for [Optional]
+Returns:
+    list of (name, query)
+"""
+def explain_statements(target=None):
+    statements = []
+    seen = {}
+    explained = set()
+    for group, registry_name in EXPLAIN_GROUPS:
+        queries = registry.get(registry_name, target)
+        for query in ([queries] if isinstance(queries, str) else queries):
+            for part in (p.strip() for p in query.split(';')):
+                if not part or part in explained:
+                    continue
+                explained.add(part)
+                name = "{}:{}".format(group, statement_name(part))
+                seen[name] = seen.get(name, 0) + 1
+                statements.append((name if seen[name] == 1 else "{} #{}".format(name, seen[name]), part))
+    return statements
+
+"""
+Purpose:
+    Runs EXPLAIN on every statement and keeps the plan text
+    Each EXPLAIN runs in its own transaction, so a statement that fails to plan (e.g. a missing table)
+      is recorded and the rest still run
+Arg:
+    db - ConnectionManager [Required]
+    statements - list returned by explain_statements() [Required]
+Returns:
+    capture dict with 'statements': statement name to dict of 'query' and 'plan' (or 'error')
+"""
+def capture_plans(db, statements):
+    def explain(query):
+        def work(cur):
+            cur.execute("EXPLAIN " + query)
+            return '\n'.join(row[0] for row in cur.fetchall())
+        return work
+
+    capture = {'statements': {}}
+    num_statements = len(statements)
+    for statement_count, (name, query) in enumerate(statements, 1):
+        print("Running ", statement_count, "/", num_statements, " EXPLAIN queries: ", name)
+        try:
+            capture['statements'][name] = {'query': query, 'plan': db.run_transaction(None, explain(query))}
+        except Exception as e:
+            capture['statements'][name] = {'query': query, 'error': str(e).strip()}
+    return capture
+
+"""
+Purpose:
+    Prints the regression report
+Arg:
+    report - dict returned by compare_plans() [Required]
+"""
+def print_report(report):
+    if not report:
+        print("No plan regressions")
+    for name, findings in report.items():
+        print(name, ":")
+        for finding in findings:
+            print("   ", finding)
+
+"""
+Purpose:
+    Dry run of etl.py: explains every statement that doesn't depend on COPY, writes the plans to EXPLAIN_FILE,
+      and compares them with EXPLAIN_BASELINE
+    The first run, or a run with update_baseline, saves the plans as the baseline
+Arg:
+    db - ConnectionManager [Required]
+    config - parsed dwh.cfg config [Required]
+    update_baseline - save the captured plans as the new baseline [Optional]
+Returns:
+    dict returned by compare_plans(); empty when there is nothing to report
+"""
+def dry_run(db, config, update_baseline=False):
+    baseline_path = config.get('ETL', 'EXPLAIN_BASELINE', fallback='explain_baseline.json')
+    capture = capture_plans(db, explain_statements())
+    with open(config.get('ETL', 'EXPLAIN_FILE', fallback='explain_plans.json'), 'w') as f:
+        json.dump(capture, f, indent=2)
+
+    try:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = None
+    report = {}
+    if baseline is not None:
+        report = compare_plans(baseline, capture, config.getfloat('ETL', 'EXPLAIN_COST_INCREASE', fallback=1.5))
+        print_report(report)
+    if baseline is None or update_baseline:
+        with open(baseline_path, 'w') as f:
+            json.dump(capture, f, indent=2)
+        print("Saved ", len(capture['statements']), " plans as the baseline in ", baseline_path)
+    return report
+
+"""
+Purpose:
+    Command line entry point; works offline on saved plans
+    e.g. python explain.py explain_plans.json --baseline explain_baseline.json     (compares two captures)
+         python explain.py plan.txt                                               (parses one saved EXPLAIN output)
+    Plans are captured from the cluster by python etl.py --dry-run
+"""
+def main():
+    parser = argparse.ArgumentParser(description="Compare EXPLAIN plans captured by etl.py --dry-run with a baseline")
+    parser.add_argument('plans', help="plan capture JSON file, or a text file holding one EXPLAIN output")
+    parser.add_argument('--baseline', default='explain_baseline.json', help="baseline plan capture JSON file")
+    parser.add_argument('--cost-increase', type=float, default=1.5, help="cost ratio reported as a regression")
+    args = parser.parse_args()
+
+    if not args.plans.endswith('.json'):
+        with open(args.plans) as f:
+            plan = parse_plan(f.read())
+        if plan is None:
+            print("No plan found in ", args.plans)
+            return
+        print(json.dumps(summarize(plan), indent=2))
+        for warning in plan['warnings']:
+            print("Warning: ", warning)
+        return
+
+    with open(args.plans) as f:
+        capture = json.load(f)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    report = compare_plans(baseline, capture, args.cost_increase)
+    print_report(report)
+    if report:
+        raise SystemExit(1)
+
+
+"""
+    Run above code if the file is labled __main__
+      Python internally labels files at runtime to differentiate between imported files and main file
+"""
+if __name__ == "__main__":
+    main()
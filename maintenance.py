@@ -0,0 +1,194 @@
+import argparse                 # Command line options
+import configparser             # Parse configuration file
+import json                     # Read table statistics saved from svv_table_info
+import sys                      # Used for exiting python script in case of error
+import time                     # Time budget
+from sql_queries import (registry, DIALECTS, maintained_tables, table_info_select, table_info_stub_create,
+                         vacuum_sql, analyze_sql)                       # Table maintenance SQL query definitions
+from connection import ConnectionManager                               # Connection with statement retries
+from metrics import run_statement                                      # Per statement timing and row counts
+
+"""
+  Default thresholds, in percent, and time budget, in seconds; overridden by the ETL section of config file
+"""
+DEFAULT_THRESHOLDS = {'unsorted': 10.0, 'deleted': 10.0, 'stats_off': 10.0}
+DEFAULT_BUDGET = 900
+
+"""
+Purpose:
+    Reads maintenance thresholds from the ETL section of config file
+    VACUUM_UNSORTED_PCT, VACUUM_DELETED_PCT, and ANALYZE_STATS_OFF_PCT, in percent
+Arg:
+    config - parsed dwh.cfg config [Required]
+"""
+def thresholds_from_config(config):
+    return {'unsorted': config.getfloat('ETL', 'VACUUM_UNSORTED_PCT', fallback=DEFAULT_THRESHOLDS['unsorted']),
+            'deleted': config.getfloat('ETL', 'VACUUM_DELETED_PCT', fallback=DEFAULT_THRESHOLDS['deleted']),
+            'stats_off': config.getfloat('ETL', 'ANALYZE_STATS_OFF_PCT', fallback=DEFAULT_THRESHOLDS['stats_off'])}
+
+"""
+Purpose:
+    Reads unsorted percentage, statistics staleness, and row counts of the maintained tables from svv_table_info
+Arg:
+    cur - Redshift connection cursor [Required]
+    tables - table names [Optional]
+Returns:
+    list of dicts with 'table', 'unsorted', 'stats_off', 'rows', and 'deleted' (percent of rows marked for deletion)
+"""
+def table_stats(cur, tables=maintained_tables):
+    cur.execute(table_info_select, (tuple(tables),))
+    stats = []
+    for table, unsorted, stats_off, tbl_rows, visible_rows in cur.fetchall():
+        tbl_rows = int(tbl_rows or 0)
+        deleted = 100.0 * (tbl_rows - int(visible_rows or 0)) / tbl_rows if tbl_rows else 0.0
+        stats.append({'table': table.strip(), 'unsorted': float(unsorted or 0), 'stats_off': float(stats_off or 0),
+                      'rows': tbl_rows, 'deleted': max(deleted, 0.0)})
+    return stats
+
+"""
+Purpose:
+    Works out which tables need a VACUUM or ANALYZE from their statistics
+    Tables without a sort key report no unsorted percentage and are never sorted
+    Tasks are ordered by rows times how far past its threshold the table is, so the tables that slow queries
+      the most go first when the time budget runs out
+Arg:
+    stats - list returned by table_stats(), or loaded from a saved statistics file [Required]
+    thresholds - dict with 'unsorted', 'deleted', and 'stats_off' percentages [Required]
+Returns:
+    list of task dicts with 'table', 'action' ('vacuum' or 'analyze'), 'query', 'reason', and 'priority'
+"""
+def plan_maintenance(stats, thresholds):
+    tasks = []
+    for s in stats:
+        sort = s['unsorted'] >= thresholds['unsorted']
+        delete = s['deleted'] >= thresholds['deleted']
+        if sort or delete:
+            excess = max(s['unsorted'] - thresholds['unsorted'] if sort else 0, s['deleted'] - thresholds['deleted'] if delete else 0)
+            tasks.append({'table': s['table'], 'action': 'vacuum', 'query': vacuum_sql(s['table'], sort, delete),
+                          'reason': "unsorted {:.1f}%, deleted {:.1f}%".format(s['unsorted'], s['deleted']),
+                          'priority': s['rows'] * (1 + excess)})
+        if s['stats_off'] >= thresholds['stats_off']:
+            tasks.append({'table': s['table'], 'action': 'analyze', 'query': analyze_sql(s['table']),
+                          'reason': "stats off {:.1f}%".format(s['stats_off']),
+                          'priority': s['rows'] * (1 + s['stats_off'] - thresholds['stats_off'])})
+    # A table's VACUUM runs before its ANALYZE, so statistics are taken on the vacuumed table
+    table_priority = {}
+    for task in tasks:
+        table_priority[task['table']] = max(table_priority.get(task['table'], 0), task['priority'])
+    return sorted(tasks, key=lambda t: (-table_priority[t['table']], t['table'], t['action'] != 'vacuum'))
+
+"""
+Purpose:
+    Runs maintenance tasks one at a time in autocommit mode until the time budget is spent
+    A task is only started while budget remains; one already running is left to finish, so a run can go
+      over the budget by at most one task. Tasks not started are printed and picked up by the next run
+Arg:
+    db - ConnectionManager [Required]
+    tasks - list returned by plan_maintenance() [Required]
+    budget - seconds available for maintenance [Required]
+    recorder - MetricsRecorder collecting per statement metrics [Optional]
+    convert - rewrites each statement for the target dialect [Optional]
+    clock - function returning seconds, replaceable in tests [Optional]
+Returns:
+    tuple of (tasks run, tasks skipped)
+"""
+def run_maintenance(db, tasks, budget, recorder=None, convert=DIALECTS['redshift'], clock=time.monotonic):
+    start = clock()
+    done = []
+    num_tasks = len(tasks)
+    for task_count, task in enumerate(tasks, 1):
+        if clock() - start >= budget:
+            skipped = tasks[task_count - 1:]
+            print("Maintenance time budget of ", budget, "s spent; skipping ", len(skipped), " tasks: ",
+                  ', '.join(t['query'] for t in skipped))
+            return done, skipped
+        print("Running ", task_count, "/", num_tasks, " maintenance queries: ", task['query'], " (", task['reason'], ")")
+        # Not checkpointed: whether a table needs maintenance is read from svv_table_info on every run
+        query = convert(task['query'])
+        db.run_transaction(None, lambda cur: run_statement(cur, query, 'maintenance', recorder, name=query.rstrip(';')),
+                           autocommit=True)
+        done.append(task)
+    return done, []
+
+"""
+Purpose:
+    Maintenance stage run by etl.py after the fact and dimension tables are loaded
+    Reads svv_table_info, then vacuums and analyzes the tables past the thresholds within MAINTENANCE_BUDGET seconds
+    On a PostgreSQL target (DIALECT = 'postgres'), svv_table_info is stubbed with a view over pg_stat_user_tables
+Arg:
+    db - ConnectionManager [Required]
+    config - parsed dwh.cfg config [Required]
+    recorder - MetricsRecorder collecting per statement metrics [Optional]
+    target - registry target the statements are rendered for [Optional]
+    dry_run - only print the statistics and the tasks they call for [Optional]
+Returns:
+    tuple of (tasks run, tasks skipped)
+"""
+def maintain_tables(db, config, recorder=None, target=None, dry_run=False):
+    dialect = registry.dialect(target)
+    if dialect == 'postgres':
+        db.run_transaction(None, lambda cur: cur.execute(table_info_stub_create))
+    stats = db.run_transaction(None, table_stats)
+    tasks = plan_maintenance(stats, thresholds_from_config(config))
+    if dry_run or not tasks:
+        print_plan(stats, tasks)
+        return [], tasks
+    return run_maintenance(db, tasks, config.getfloat('ETL', 'MAINTENANCE_BUDGET', fallback=DEFAULT_BUDGET),
+                           recorder, DIALECTS[dialect])
+
+"""
+Purpose:
+    Prints table statistics and the maintenance tasks they call for
+Arg:
+    stats - list returned by table_stats() [Required]
+    tasks - list returned by plan_maintenance() [Required]
+"""
+def print_plan(stats, tasks):
+    for s in stats:
+        print("  ", s['table'], ": ", s['rows'], " rows, unsorted ", round(s['unsorted'], 1), "%, deleted ",
+              round(s['deleted'], 1), "%, stats off ", round(s['stats_off'], 1), "%")
+    print("Maintenance tasks:" if tasks else "No table past the maintenance thresholds")
+    for task in tasks:
+        print("  ", task['query'], " (", task['reason'], ")")
+
+"""
+Purpose:
+    Command line entry point
+    e.g. python maintenance.py                          (maintains the tables of the cluster in dwh.cfg)
+         python maintenance.py --dry-run                (prints what would run)
+         python maintenance.py --stats table_info.json  (plans offline from a saved list of table_stats() dicts)
+"""
+def main():
+    parser = argparse.ArgumentParser(description="VACUUM and ANALYZE tables past the thresholds in dwh.cfg")
+    parser.add_argument('--dry-run', action='store_true', help="print the plan without running it")
+    parser.add_argument('--stats', help="JSON file of table statistics to plan from instead of svv_table_info")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    registry.use_config(config)
+    thresholds = thresholds_from_config(config)
+
+    if args.stats:
+        with open(args.stats) as f:
+            stats = json.load(f)
+        print_plan(stats, plan_maintenance(stats, thresholds))
+        return
+
+    try:
+        db = ConnectionManager.from_config(config, size=1).open()
+    except Exception as e:
+        print("Error connecting Data Warehouse: ", e)
+        sys.exit()
+    try:
+        maintain_tables(db, config, dry_run=args.dry_run)
+    finally:
+        db.close()
+
+
+"""
+    Run above code if the file is labled __main__
+      Python internally labels files at runtime to differentiate between imported files and main file
+"""
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import heapq                    # Balances bytes across manifests while packing
+import io                       # File backed object bodies of the local stand-in for S3
+import json                     # Serialize COPY manifest files
+import math                     # Rounds manifest counts up
+import os                       # Walks the local directory stand-in for S3
+from datetime import datetime, timezone     # Modified times reported by the local stand-in for S3
+
+"""
+Purpose:
+    Splits an S3 path into bucket and key prefix
+    e.g. 's3://udacity-dend/log_data' returns ('udacity-dend', 'log_data')
+Arg:
+    path - S3 path as stored in config file [Required]
+Returns:
+    tuple of (bucket, prefix)
+"""
+def split_s3_path(path):
+    if not path.startswith('s3://'):
+        raise ValueError("Not an S3 path: {}".format(path))
+    bucket, _, prefix = path[len('s3://'):].partition('/')
+    return bucket, prefix
+
+"""
+Purpose:
+    Lists objects under an S3 prefix that were added since the last load
+    Events (log) files are named by day, so new files sort after the last loaded key; start_after
+      lets S3 skip the already loaded keys while listing
+    Song files are not named in load order, so they are filtered on last modified time instead
+    Only keys ending in suffix are returned, which skips JSON path files, "folder" placeholder keys,
+      and files of other formats
+Arg:
+    client - boto3 S3 client or any object with a compatible list_objects_v2 method [Required]
+    bucket - S3 bucket name [Required]
+    prefix - key prefix to list [Required]
+    start_after - only return keys that sort after this key [Optional]
+    modified_after - only return objects modified after this datetime [Optional]
+    suffix - file name suffix of the source format [Optional]
+Returns:
+    list of dicts with 'key', 'size', and 'last_modified', sorted by key
+"""
+def list_new_objects(client, bucket, prefix, start_after=None, modified_after=None, suffix='.json'):
+    objects = []
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    if start_after:
+        kwargs['StartAfter'] = start_after
+    while True:
+        response = client.list_objects_v2(**kwargs)
+        for item in response.get('Contents', []):
+            key = item['Key']
+            if not key.endswith(suffix) or key.endswith('/'):
+                continue
+            if modified_after is not None and item['LastModified'] <= modified_after:
+                continue
+            objects.append({'key': key, 'size': item['Size'], 'last_modified': item['LastModified']})
+        if not response.get('IsTruncated'):
+            break
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+    return sorted(objects, key=lambda o: o['key'])
+
+"""
+Purpose:
+    Builds a Redshift COPY manifest listing the given keys
+    All entries are mandatory so COPY fails rather than silently skipping a missing file
+    Each entry carries its object size in meta.content_length when sizes are given; COPY of columnar
+      files (COPY_FORMAT 'parquet') rejects a manifest without it
+Arg:
+    bucket - S3 bucket holding the keys [Required]
+    keys - list of S3 keys to load [Required]
+    sizes - dict of S3 key to object size in bytes, as listed by list_new_objects() [Optional]
+Returns:
+    manifest as a dict, ready to be serialized to JSON
+"""
+def build_manifest(bucket, keys, sizes=None):
+    entries = []
+    for key in keys:
+        entry = {'url': 's3://{}/{}'.format(bucket, key), 'mandatory': True}
+        if sizes is not None:
+            entry['meta'] = {'content_length': sizes[key]}
+        entries.append(entry)
+    return {'entries': entries}
+
+"""
+Purpose:
+    Writes a manifest to S3 so COPY can read it
+Arg:
+    client - boto3 S3 client [Required]
+    path - S3 path of the manifest file, e.g. 's3://my-bucket/manifests/log_data.json' [Required]
+    manifest - manifest dict returned by build_manifest() [Required]
+Returns:
+    S3 path of the written manifest
+"""
+def upload_manifest(client, path, manifest):
+    bucket, key = split_s3_path(path)
+    client.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode('utf-8'))
+    return path
+
+"""
+Purpose:
+    Packs S3 objects into manifests so every COPY keeps all cluster slices busy
+    Redshift loads one file per slice at a time, so each manifest gets a whole multiple of the slice
+      count where possible and at most num_slices * files_per_slice files; only the last manifest
+      may carry a partial wave
+    Within those counts objects are placed largest first into the manifest holding the fewest bytes,
+      so COPYs take about the same time
+Arg:
+    objects - list of dicts with 'key' and 'size' as returned by list_new_objects() [Required]
+    num_slices - number of slices in the cluster [Required]
+    files_per_slice - maximum number of files each slice loads per COPY [Required]
+Returns:
+    list of manifests, each a dict with 'keys', 'sizes' (key to bytes), 'files', and 'bytes'
+"""
+def pack_manifests(objects, num_slices, files_per_slice):
+    if not objects:
+        return []
+    num_slices = max(1, num_slices)
+    num_manifests = max(1, math.ceil(len(objects) / (num_slices * max(1, files_per_slice))))
+
+    # Number of files per manifest, in whole waves of num_slices files
+    waves, partial = divmod(len(objects), num_slices)
+    capacity = [(waves // num_manifests + (1 if i < waves % num_manifests else 0)) * num_slices
+                for i in range(num_manifests)]
+    capacity[-1] += partial
+
+    manifests = [{'keys': [], 'sizes': {}, 'files': 0, 'bytes': 0} for _ in range(num_manifests)]
+    heap = [(0, i) for i in range(num_manifests) if capacity[i] > 0]
+    heapq.heapify(heap)
+    for obj in sorted(objects, key=lambda o: o['size'], reverse=True):
+        size, i = heapq.heappop(heap)
+        manifests[i]['keys'].append(obj['key'])
+        manifests[i]['sizes'][obj['key']] = obj['size']
+        manifests[i]['files'] += 1
+        manifests[i]['bytes'] += obj['size']
+        if manifests[i]['files'] < capacity[i]:
+            heapq.heappush(heap, (size + obj['size'], i))
+
+    for m in manifests:
+        m['keys'].sort()
+    return [m for m in manifests if m['files'] > 0]
+
+"""
+Purpose:
+    Prints the number of files and bytes in each manifest
+Arg:
+    dataset - source dataset name used as report heading [Required]
+    manifests - list of manifests returned by pack_manifests() [Required]
+"""
+def print_manifest_report(dataset, manifests):
+    print("Packed ", sum(m['files'] for m in manifests), " ", dataset, " files (",
+          sum(m['bytes'] for m in manifests), " bytes) into ", len(manifests), " manifests")
+    for i, m in enumerate(manifests, 1):
+        print("  manifest ", i, ": ", m['files'], " files, ", m['bytes'], " bytes")
+
+"""
+Purpose:
+    Local directory stand-in for the boto3 S3 client
+    Implements the list_objects_v2, put_object, and get_object calls used by this module and the
+      streaming load in etl.py, treating <root>/<bucket>/<key> as an S3 object, so listing, manifest
+      packing, and streaming can run without AWS
+Arg:
+    root - local directory holding one sub-directory per bucket [Required]
+    page_size - maximum number of keys returned per list_objects_v2 call [Optional]
+"""
+class LocalS3Client:
+    def __init__(self, root, page_size=1000):
+        self.root = root
+        self.page_size = page_size
+
+    def list_objects_v2(self, Bucket, Prefix='', StartAfter=None, ContinuationToken=None):
+        bucket_dir = os.path.join(self.root, Bucket)
+        keys = []
+        for dirpath, _, filenames in os.walk(bucket_dir):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(dirpath, filename), bucket_dir).replace(os.sep, '/')
+                if key.startswith(Prefix) and (StartAfter is None or key > StartAfter):
+                    keys.append(key)
+        keys.sort()
+
+        start = int(ContinuationToken or 0)
+        page = keys[start:start + self.page_size]
+        response = {'Contents': [], 'IsTruncated': start + self.page_size < len(keys)}
+        for key in page:
+            stat = os.stat(os.path.join(bucket_dir, key))
+            response['Contents'].append({'Key': key, 'Size': stat.st_size,
+                                         'LastModified': datetime.fromtimestamp(stat.st_mtime, timezone.utc)})
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(start + self.page_size)
+        return response
+
+    def put_object(self, Bucket, Key, Body):
+        path = os.path.join(self.root, Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body)
+
+    # Body supports read() and iter_lines() like the botocore StreamingBody
+    def get_object(self, Bucket, Key):
+        return {'Body': LocalBody(os.path.join(self.root, Bucket, Key))}
+
+class LocalBody(io.FileIO):
+    def iter_lines(self):
+        for line in self:
+            yield line.rstrip(b'\r\n')
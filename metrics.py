@@ -0,0 +1,186 @@
+import argparse                 # Command line options for the run report
+import json                     # Metrics are stored as JSON lines
+import re                       # Derives a short statement name from SQL text
+import statistics               # Median of earlier runs in the trend report
+import threading                # Records are written from parallel query workers
+import time                     # Wall clock timings
+import uuid                     # Run ids
+from datetime import datetime, timezone     # Record timestamps
+
+"""
+  Server side statistics queries
+  pg_last_query_id() returns the id of the last query run in the session, used to look the statement up
+    in Redshift system tables; stl_load_commits holds the files and lines each COPY loaded
+"""
+last_query_id_select = "SELECT pg_last_query_id();"
+load_commits_select = ("""SELECT count(DISTINCT filename), sum(lines_scanned)
+                          FROM stl_load_commits
+                          WHERE query = %s;
+                       """)
+
+"""
+Purpose:
+    Derives a short, stable name for a SQL statement from its leading keywords and table name
+    e.g. 'INSERT INTO songs', 'COPY staging_events', 'DROP TABLE IF EXISTS users'
+Arg:
+    query - SQL statement [Required]
+"""
+def statement_name(query):
+    sql = ' '.join(query.split())
+    match = re.match(r'((?:INSERT INTO|DELETE FROM|UPDATE|COPY|TRUNCATE|CREATE (?:TEMP )?TABLE|DROP TABLE IF EXISTS|DROP TABLE|'
+                     r'ALTER TABLE|VACUUM(?: \w+ ONLY)?|ANALYZE|SELECT|EXPLAIN)\s+\(?\s*[\w.]*)', sql, re.IGNORECASE)
+    return match.group(1).rstrip('( ') if match else sql[:40]
+
+"""
+Purpose:
+    Collects one record per SQL statement and appends it to a JSON lines metrics file
+    Every record carries the run id, so the report can compare statements across runs
+    Safe to use from the parallel query workers in scheduler.py
+Arg:
+    path - metrics file to append to; records are only kept in memory when None [Optional]
+    server_stats - look up query id and COPY load statistics in Redshift system tables;
+                   turn off against a local PostgreSQL, which has neither [Optional]
+    run_id - id shared by every record of this run; generated when not given [Optional]
+"""
+class MetricsRecorder:
+    def __init__(self, path=None, server_stats=True, run_id=None):
+        self.path = path
+        self.server_stats = server_stats
+        self.run_id = run_id or "{}-{}".format(datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:6])
+        self.records = []
+        self.lock = threading.Lock()
+
+    def record(self, record):
+        record = dict(record, run_id=self.run_id)
+        with self.lock:
+            self.records.append(record)
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record, default=str) + '\n')
+
+"""
+Purpose:
+    Runs one SQL statement and records its wall time, row count, server query id, and for COPY the
+      files and lines loaded
+    Doesn't commit; callers keep their own commit points
+    Without a recorder the statement is just executed
+Arg:
+    cur - Redshift connection cursor [Required]
+    query - SQL statement [Required]
+    stage - pipeline stage the statement belongs to, e.g. 'copy' or 'insert' [Required]
+    recorder - MetricsRecorder collecting the record [Optional]
+    params - query parameters passed to execute() [Optional]
+    name - statement name to record; derived from the SQL text when not given [Optional]
+"""
+def run_statement(cur, query, stage, recorder=None, params=None, name=None):
+    if recorder is None:
+        cur.execute(query, params)
+        return
+
+    started_at = datetime.now(timezone.utc)
+    start = time.perf_counter()
+    cur.execute(query, params)
+    record = {'stage': stage, 'statement': name or statement_name(query), 'started_at': started_at.isoformat(),
+              'seconds': time.perf_counter() - start, 'rows': cur.rowcount}
+
+    if recorder.server_stats:
+        cur.execute(last_query_id_select)
+        record['query_id'] = cur.fetchone()[0]
+        if statement_name(query).upper().startswith('COPY'):
+            cur.execute(load_commits_select, (record['query_id'],))
+            record['load_files'], record['load_lines'] = cur.fetchone()
+    recorder.record(record)
+
+"""
+Purpose:
+    Reads every record from a JSON lines metrics file
+Arg:
+    path - metrics file [Required]
+Returns:
+    dict of run id to list of records, in file order
+"""
+def read_runs(path):
+    runs = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                runs.setdefault(record['run_id'], []).append(record)
+    return runs
+
+"""
+Purpose:
+    Builds a run report: total time of each run, the slowest statements of the latest run, and
+      how each statement's time in the latest run compares with its median over earlier runs
+    Statements are keyed by stage and statement name, so they line up across runs
+Arg:
+    runs - dict returned by read_runs() [Required]
+    history - number of earlier runs to compare against [Optional]
+    top - number of slowest statements to list [Optional]
+Returns:
+    dict with 'runs', 'slowest', and 'trends'
+"""
+def build_report(runs, history=10, top=10):
+    ordered = sorted(runs, key=lambda r: min(rec['started_at'] for rec in runs[r]))
+    totals = [{'run_id': r, 'statements': len(runs[r]), 'seconds': sum(rec['seconds'] for rec in runs[r])} for r in ordered]
+    if not ordered:
+        return {'runs': [], 'slowest': [], 'trends': []}
+
+    def by_statement(records):
+        seconds = {}
+        for rec in records:
+            key = (rec['stage'], rec['statement'])
+            seconds[key] = seconds.get(key, 0) + rec['seconds']
+        return seconds
+
+    latest = by_statement(runs[ordered[-1]])
+    earlier = [by_statement(runs[r]) for r in ordered[-history - 1:-1]]
+    slowest = sorted(latest.items(), key=lambda item: -item[1])[:top]
+
+    trends = []
+    for key, seconds in latest.items():
+        past = [run[key] for run in earlier if key in run]
+        median = statistics.median(past) if past else None
+        trends.append({'stage': key[0], 'statement': key[1], 'seconds': seconds, 'median_seconds': median,
+                       'change': (seconds / median - 1) if median else None})
+    trends.sort(key=lambda t: -(t['change'] or 0))
+    return {'runs': totals,
+            'slowest': [{'stage': k[0], 'statement': k[1], 'seconds': s} for k, s in slowest],
+            'trends': trends}
+
+"""
+Purpose:
+    Command line entry point; prints the run report of a metrics file
+    e.g. python metrics.py etl_metrics.jsonl --history 10
+"""
+def main():
+    parser = argparse.ArgumentParser(description="Report slowest statements and trends across ETL runs")
+    parser.add_argument('path', help="JSON lines metrics file written by etl.py and create_table.py")
+    parser.add_argument('--history', type=int, default=10, help="earlier runs to compare the latest run against")
+    parser.add_argument('--top', type=int, default=10, help="number of slowest statements to list")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+
+    report = build_report(read_runs(args.path), args.history, args.top)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print("Runs:")
+    for run in report['runs'][-args.history - 1:]:
+        print("  ", run['run_id'], ": ", run['statements'], " statements, ", round(run['seconds'], 1), "s")
+    print("Slowest statements in latest run:")
+    for i, item in enumerate(report['slowest'], 1):
+        print("  ", i, ". ", item['stage'], " ", item['statement'], ": ", round(item['seconds'], 1), "s")
+    print("Change against median of earlier runs:")
+    for item in report['trends']:
+        change = "n/a" if item['change'] is None else "{:+.0%}".format(item['change'])
+        print("  ", item['stage'], " ", item['statement'], ": ", round(item['seconds'], 1), "s (", change, ")")
+
+
+"""
+    Run above code if the file is labled __main__
+      Python internally labels files at runtime to differentiate between imported files and main file
+"""
+if __name__ == "__main__":
+    main()
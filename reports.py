@@ -0,0 +1,89 @@
+import configparser             # Parse configuration file
+import sys                      # Used for exiting python script in case of error
+from sql_queries import analytical_queries, rollup_queries             # Example analytical queries and their rollup equivalents
+from sql_queries import top_songs_rollup_select, top_locations_rollup_select, users_by_level_rollup_select
+from connection import ConnectionManager                               # Connection with statement retries
+
+"""
+  Rollup query answering each example analytical query; keyed by whitespace normalized SQL text
+"""
+ROUTES = {' '.join(query.split()): rollup for query, rollup in zip(analytical_queries, rollup_queries)}
+
+"""
+Purpose:
+    Returns the rollup query answering the same question as query, or query itself when no rollup covers it
+    Lets BI tools and scripts send the README example queries and have them read the small rollup tables
+      instead of scanning songplays
+Arg:
+    query - SQL query [Required]
+"""
+def route(query):
+    return ROUTES.get(' '.join(query.split()), query)
+
+"""
+Purpose:
+    Ten most played song titles with their play counts, read from song_plays_daily
+Arg:
+    cur - Redshift connection cursor [Required]
+"""
+def top_songs(cur):
+    cur.execute(top_songs_rollup_select)
+    return cur.fetchall()
+
+"""
+Purpose:
+    Ten locations with the most song plays, read from location_plays
+Arg:
+    cur - Redshift connection cursor [Required]
+"""
+def top_locations(cur):
+    cur.execute(top_locations_rollup_select)
+    return cur.fetchall()
+
+"""
+Purpose:
+    User counts by level, read from level_users
+Arg:
+    cur - Redshift connection cursor [Required]
+"""
+def users_by_level(cur):
+    cur.execute(users_by_level_rollup_select)
+    return cur.fetchall()
+
+"""
+Purpose:
+    Prints the answers to the example analytical queries from the rollup tables
+"""
+def main():
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    try:
+        db = ConnectionManager.from_config(config, size=1).open()
+    except Exception as e:
+        print("Error connecting Data Warehouse: ", e)
+        sys.exit()
+
+    try:
+        # Read in one transaction, so the answers come from the same rollup refresh and a retry prints nothing twice
+        songs, locations, levels = db.run_transaction(None, lambda cur: (top_songs(cur), top_locations(cur),
+                                                                         users_by_level(cur)))
+    finally:
+        db.close()
+
+    print("Top ten most played songs:")
+    for title, play_count in songs:
+        print("  ", title, ": ", play_count)
+    print("Top ten locations by song plays:")
+    for location, play_count in locations:
+        print("  ", location, ": ", play_count)
+    print("Users by level:")
+    for level, user_count in levels:
+        print("  ", level, ": ", user_count)
+
+
+"""
+    Run above code if the file is labled __main__
+      Python internally labels files at runtime to differentiate between imported files and main file
+"""
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import threading                                                # Guards the shared progress counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED   # Runs independent queries at the same time
+
+"""
+Purpose:
+    Works out which steps each step has to wait for, using the tables every step reads and writes
+    A step waits on an earlier step when:
+        the earlier step writes a table this step reads or writes (read/write after write)
+        the earlier step reads a table this step writes (write after read)
+    Steps that touch unrelated tables have no dependency and can run at the same time
+Arg:
+    steps - list of dicts with 'name', 'reads', and 'writes' keys, in the order they would run serially [Required]
+Returns:
+    dict of step name to set of step names it depends on
+"""
+def build_dependencies(steps):
+    dependencies = {}
+    for i, step in enumerate(steps):
+        reads = set(step['reads'])
+        writes = set(step['writes'])
+        dependencies[step['name']] = set()
+        for earlier in steps[:i]:
+            earlier_writes = set(earlier['writes'])
+            if earlier_writes & (reads | writes) or set(earlier['reads']) & writes:
+                dependencies[step['name']].add(earlier['name'])
+    return dependencies
+
+"""
+Purpose:
+    Runs steps on a thread pool in dependency order
+    A step is submitted as soon as every step it depends on has finished
+    On the first failure no further steps are started; running steps are allowed to finish
+      and the first error is raised to the caller
+Arg:
+    steps - list of dicts with 'name', 'reads', and 'writes' keys [Required]
+    run_step - callable that runs a single step; called from worker threads [Required]
+    max_workers - maximum number of steps running at the same time [Required]
+Returns:
+    list of step names in the order they finished
+"""
+def run_dag(steps, run_step, max_workers):
+    dependencies = build_dependencies(steps)
+    by_name = {step['name']: step for step in steps}
+    pending = [step['name'] for step in steps]
+    finished = []
+    running = {}
+    error = None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            # Submit every pending step whose dependencies have all finished
+            if error is None:
+                for name in list(pending):
+                    if dependencies[name] <= set(finished):
+                        pending.remove(name)
+                        running[executor.submit(run_step, by_name[name])] = name
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    error = error or future.exception()
+                else:
+                    finished.append(name)
+
+    if error is not None:
+        raise error
+    return finished
+
+"""
+Purpose:
+    Runs query steps in parallel using the connection pool of a ConnectionManager
+    Each worker borrows a connection, runs and commits its query, and returns the connection to the pool;
+      transient errors are retried and steps already in the checkpoint are skipped by the manager
+    Progress is printed in the same format as the serial loops in etl.py
+Arg:
+    steps - list of dicts with 'name', 'query', 'reads', and 'writes' keys, and an optional checkpoint 'key' [Required]
+    db - ConnectionManager; one query runs per pooled connection at a time [Required]
+    label - query type used in progress messages [Required]
+    stage - pipeline stage recorded with each statement's metrics [Optional]
+    recorder - MetricsRecorder collecting per statement metrics [Optional]
+Returns:
+    list of step names in the order they finished
+"""
+def run_queries_parallel(steps, db, label, stage=None, recorder=None):
+    num_queries = len(steps)
+    counter = {'started': 0}
+    lock = threading.Lock()
+
+    def run_step(step):
+        with lock:
+            counter['started'] += 1
+            print("Running ", counter['started'], "/", num_queries, " ", label, " queries (", step['name'], ")")
+        db.run(step['query'], stage or label, recorder, name=step['name'], key=step.get('key'))
+
+    return run_dag(steps, run_step, db.size)
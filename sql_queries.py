@@ -1,20 +1,25 @@
 import configparser
+import re
+import threading
 
 # Using config file to store AWS credentials and cluster details
-# Using configparser library to extract the config details to be used within ETL process 
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
+# Config is only read when a statement that needs it is first rendered; see QueryRegistry at the end of this file
 
 
 # DROP TABLE STATEMENTS
 staging_events_table_drop = "DROP TABLE IF EXISTS staging_events;"
 staging_songs_table_drop = "DROP TABLE IF EXISTS staging_songs;"
 songplay_table_drop = "DROP TABLE IF EXISTS songplays;"
-user_table_max_ts_drop = "DROP TABLE IF EXISTS users_max_ts;"
+user_table_max_ts_drop = "DROP TABLE IF EXISTS users_max_ts;"       # No longer created; dropped to clean up older clusters
 user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE IF EXISTS time;"
+load_state_table_drop = "DROP TABLE IF EXISTS etl_load_state;"
+song_plays_daily_table_drop = "DROP TABLE IF EXISTS song_plays_daily;"
+location_plays_table_drop = "DROP TABLE IF EXISTS location_plays;"
+level_users_table_drop = "DROP TABLE IF EXISTS level_users;"
+staging_plays_table_drop = "DROP TABLE IF EXISTS staging_plays;"
 
 
 # CREATE TABLE STATEMENTS
@@ -23,34 +28,39 @@ time_table_drop = "DROP TABLE IF EXISTS time;"
 # However, query optimizer uses this information in planning
 # Varchar w/o length defaults to varchar(256)
 # Char w/o length defaults to char(1)
+# Column encodings are chosen by column_encodings.py from sampled rows: RAW for the leading sort key column,
+#   AZ64 for integers and timestamps, ZSTD otherwise; BYTEDICT only where it is clearly smaller than ZSTD, which on
+#   the sampled data no column is (user agents come closest)
+# COPY runs with COMPUPDATE OFF, so these encodings are kept rather than re-analyzed on every load
 
 """ 
   Events (log) files stored on AWS S3 will be copied to staging_events table using COPY function
   Data from this table is transformed and stored in other tables for analysis purpose
   Log files contain user activity on the app
   Given that the table is staging, setting table Backup to No; Snapshot will not backup this table
-  Using Distribution Style by Key; Using Song attribute as distribution key
-"""
-staging_events_table_create= ("""CREATE TABLE staging_events(artist varchar
-                                                           , auth varchar
-                                                           , firstname varchar
-                                                           , gender char
-                                                           , iteminsession int
-                                                           , lastname varchar
-                                                           , length float
-                                                           , level varchar
-                                                           , location varchar
-                                                           , method varchar
-                                                           , page varchar
-                                                           , registration bigint
-                                                           , sessionid int
-                                                           , song varchar           DISTKEY
-                                                           , status int
-                                                           , ts bigint
-                                                           , useragent varchar
-                                                           , userid int)
+  Using Distribution Style EVEN so COPY spreads rows over every slice; no column of the raw events is a good
+    join key, and the songplays join reads staging_plays, which is distributed on the song match key
+"""
+staging_events_table_create= ("""CREATE TABLE staging_events(artist varchar         ENCODE zstd
+                                                           , auth varchar           ENCODE zstd
+                                                           , firstname varchar      ENCODE zstd
+                                                           , gender char            ENCODE zstd
+                                                           , iteminsession int      ENCODE az64
+                                                           , lastname varchar       ENCODE zstd
+                                                           , length float           ENCODE zstd
+                                                           , level varchar          ENCODE zstd
+                                                           , location varchar       ENCODE zstd
+                                                           , method varchar         ENCODE zstd
+                                                           , page varchar           ENCODE zstd
+                                                           , registration bigint    ENCODE az64
+                                                           , sessionid int          ENCODE az64
+                                                           , song varchar           ENCODE zstd
+                                                           , status int             ENCODE az64
+                                                           , ts bigint              ENCODE az64
+                                                           , useragent varchar      ENCODE zstd
+                                                           , userid int             ENCODE az64)
                                      BACKUP NO
-                                     DISTSTYLE KEY;
+                                     DISTSTYLE EVEN;
                               """)
 
 """
@@ -58,21 +68,41 @@ staging_events_table_create= ("""CREATE TABLE staging_events(artist varchar
   Data from this table is transformed and stored in other tables for analysis purpose
   Song files contain metadata of the songs on app
   Given that the table is staging, setting table Backup to No; Snapshot will not backup this table
-  Using Distribution Style of ALL in order to replicate table on all data nodes
-    Considering songs table is small and won't grow as fast as log data, we can copy table on all nodes
-"""
-staging_songs_table_create = ("""CREATE TABLE staging_songs(num_songs int
-                                                          , artist_id char(19)
-                                                          , artist_latitude float
-                                                          , artist_longitude float
-                                                          , artist_location varchar
-                                                          , artist_name varchar
-                                                          , song_id char(19)
-                                                          , title varchar
-                                                          , duration float
-                                                          , year  int)
+  Using Distribution Style EVEN, like staging_events; events are matched to the match_key the songs upsert stores
+"""
+staging_songs_table_create = ("""CREATE TABLE staging_songs(num_songs int              ENCODE az64
+                                                          , artist_id char(19)       ENCODE zstd
+                                                          , artist_latitude float    ENCODE zstd
+                                                          , artist_longitude float   ENCODE zstd
+                                                          , artist_location varchar  ENCODE zstd
+                                                          , artist_name varchar      ENCODE zstd
+                                                          , song_id char(19)         ENCODE zstd
+                                                          , title varchar            ENCODE zstd
+                                                          , duration float           ENCODE zstd
+                                                          , year  int                ENCODE az64)
+                                 BACKUP NO
+                                 DISTSTYLE EVEN;
+                              """)
+
+"""
+  Keyed staging table
+  Built from staging_events by INSERT ... SELECT after COPY, so match_key is computed as the rows are
+    written and every row lands on the slice of its key; a column filled in by an UPDATE after COPY would
+    put every row on the slice of NULL first and leave the table unsorted with deleted rows
+  match_key is a hash of the normalized song title, artist name, and duration (see song_match_key_sql)
+  Events are joined to songs.match_key, stored once per song by the songs upsert, in every load mode
+  Only NextSong events with a complete key are kept, so no NULL key skews a slice
+"""
+staging_plays_table_create = ("""CREATE TABLE staging_plays(match_key char(32)    ENCODE raw      SORTKEY DISTKEY NOT NULL
+                                                          , ts bigint             ENCODE az64                     NOT NULL
+                                                          , start_time timestamp  ENCODE az64                     NOT NULL
+                                                          , user_id int           ENCODE az64
+                                                          , level varchar         ENCODE zstd
+                                                          , session_id int        ENCODE az64
+                                                          , location varchar      ENCODE zstd
+                                                          , user_agent varchar    ENCODE zstd)
                                  BACKUP NO
-                                 DISTSTYLE ALL;
+                                 DISTSTYLE KEY;
                               """)
 
 
@@ -82,40 +112,29 @@ staging_songs_table_create = ("""CREATE TABLE staging_songs(num_songs int
   Using song_id as distribution key and sort key to optimize songs play end-user queries
   Songs table is also designed to distribute table using song_id key to enable colocating with fact table key
 """
-songplay_table_create = ("""CREATE TABLE songplays(songplay_id int                      IDENTITY(1, 1) PRIMARY KEY
-                                                 , start_time timestamp                 NOT NULL REFERENCES time(start_time)
-                                                 , user_id int                          NOT NULL REFERENCES users(user_id)
-                                                 , level varchar                        NOT NULL
-                                                 , song_id char(19)     SORTKEY DISTKEY NOT NULL REFERENCES songs(song_id)
-                                                 , artist_id char(19)                   NOT NULL REFERENCES artists(artist_id)
-                                                 , session_id int                       NOT NULL
-                                                 , location varchar
-                                                 , user_agent varchar                   NOT NULL)
+songplay_table_create = ("""CREATE TABLE songplays(songplay_id int      IDENTITY(1, 1) ENCODE az64                 PRIMARY KEY
+                                                 , start_time timestamp                ENCODE az64                 NOT NULL REFERENCES time(start_time)
+                                                 , user_id int                         ENCODE az64                 NOT NULL REFERENCES users(user_id)
+                                                 , level varchar                       ENCODE zstd                 NOT NULL
+                                                 , song_id char(19)                    ENCODE raw  SORTKEY DISTKEY NOT NULL REFERENCES songs(song_id)
+                                                 , artist_id char(19)                  ENCODE zstd                 NOT NULL REFERENCES artists(artist_id)
+                                                 , session_id int                      ENCODE az64                 NOT NULL
+                                                 , location varchar                    ENCODE zstd
+                                                 , user_agent varchar                  ENCODE zstd                 NOT NULL)
                             DISTSTYLE KEY;
                          """)
 
-"""
-  Staging table to hold only latest user record based on max timestamp in events file
-  Used in user_table_insert query to filter out older user records from events table
-  This helps capture latest User info from the events file
-"""
-user_table_max_ts_create = ("""CREATE TABLE users_max_ts(userid int    SORTKEY NOT NULL
-                                                       , mx_ts bigint          NOT NULL)
-                               BACKUP NO
-                               DISTSTYLE ALL; 
-                            """)
-
 """ 
   User dimension table
   Given that the table isn't big enough, using distribution style ALL
   Having table available on all compute nodes makes end-user queries efficient when joined with fact table
   Setting user_id as Sort Key enables redshift to skip blocks of data based on its values
 """
-user_table_create = ("""CREATE TABLE users(user_id int         SORTKEY NOT NULL PRIMARY KEY
-                                         , first_name varchar          NOT NULL
-                                         , last_name varchar           NOT NULL
-                                         , gender char
-                                         , level varchar               NOT NULL)
+user_table_create = ("""CREATE TABLE users(user_id int         ENCODE raw  SORTKEY NOT NULL PRIMARY KEY
+                                         , first_name varchar  ENCODE zstd         NOT NULL
+                                         , last_name varchar   ENCODE zstd         NOT NULL
+                                         , gender char         ENCODE zstd
+                                         , level varchar       ENCODE zstd         NOT NULL)
                         DISTSTYLE ALL;
                      """)
 
@@ -124,12 +143,17 @@ user_table_create = ("""CREATE TABLE users(user_id int         SORTKEY NOT NULL
   Using song_id as distribution key so that Redshift colocates songs and songsplay table keys
   Although Songs table is small, distributing table using Key adds to end-user query optimization
   Setting song_id as Sort Key enables redshift to skip blocks of data based on its values when queried
+  content_hash holds the hash of the row's values, so loads only write songs that are new or changed
+  match_key is the song match key of the kept row, computed with its own file's artist name; every load mode
+    matches events to it, so a song matched by a full load is matched the same way by incremental and streaming loads
 """
-song_table_create = ("""CREATE TABLE songs(song_id char(19)    SORTKEY DISTKEY NOT NULL PRIMARY KEY
-                                         , title varchar                       NOT NULL
-                                         , artist_id char(19)                  NOT NULL
-                                         , year int
-                                         , duration float                      NOT NULL)
+song_table_create = ("""CREATE TABLE songs(song_id char(19)       ENCODE raw  SORTKEY DISTKEY NOT NULL PRIMARY KEY
+                                         , title varchar          ENCODE zstd                 NOT NULL
+                                         , artist_id char(19)     ENCODE zstd                 NOT NULL
+                                         , year int               ENCODE az64
+                                         , duration float         ENCODE zstd                 NOT NULL
+                                         , match_key char(32)     ENCODE zstd
+                                         , content_hash char(32)  ENCODE zstd)
                         DISTSTYLE KEY;
                      """)
 
@@ -139,11 +163,12 @@ song_table_create = ("""CREATE TABLE songs(song_id char(19)    SORTKEY DISTKEY N
   Having table available on all compute nodes makes end-user queries efficient when joined with fact table
   Setting artist_id as Sort Key enables redshift to skip blocks of data based on its values when queried
 """
-artist_table_create = ("""CREATE TABLE artists(artist_id char(19)  SORTKEY NOT NULL PRIMARY KEY
-                                             , name varchar                NOT NULL
-                                             , location varchar
-                                             , latitude float
-                                             , longitude float)
+artist_table_create = ("""CREATE TABLE artists(artist_id char(19)     ENCODE raw  SORTKEY NOT NULL PRIMARY KEY
+                                             , name varchar           ENCODE zstd         NOT NULL
+                                             , location varchar       ENCODE zstd
+                                             , latitude float         ENCODE zstd
+                                             , longitude float        ENCODE zstd
+                                             , content_hash char(32)  ENCODE zstd)
                           DISTSTYLE ALL;
                        """)
 
@@ -154,92 +179,323 @@ artist_table_create = ("""CREATE TABLE artists(artist_id char(19)  SORTKEY NOT N
   Having table available on all compute nodes makes end-user queries efficient when joined with fact table
   Setting start_time as Sort Key enables redshift to skip blocks of data based on its values when queried
 """
-time_table_create = ("""CREATE TABLE time(start_time timestamp  SORTKEY NOT NULL PRIMARY KEY 
-                                        , hour int                      NOT NULL             
-                                        , day int                       NOT NULL
-                                        , week int                      NOT NULL
-                                        , month int                     NOT NULL
-                                        , year int                      NOT NULL
-                                        , weekday int                   NOT NULL)
+time_table_create = ("""CREATE TABLE time(start_time timestamp  ENCODE raw  SORTKEY NOT NULL PRIMARY KEY 
+                                        , hour int              ENCODE az64         NOT NULL             
+                                        , day int               ENCODE az64         NOT NULL
+                                        , week int              ENCODE az64         NOT NULL
+                                        , month int             ENCODE az64         NOT NULL
+                                        , year int              ENCODE az64         NOT NULL
+                                        , weekday int           ENCODE az64         NOT NULL)
                         DISTSTYLE ALL;
                      """)
 
+"""
+  Control table for incremental loads
+  Stores a high-water mark per source dataset ('log_data' or 'song_data')
+    last_key - last S3 key loaded; events files are named by day so new files sort after it
+    last_modified - latest S3 modified time loaded; used for song files that aren't named in load order
+    max_ts - max event ts merged into songplays; protects against reloading overlapping events
+  Dropped along with other tables by create_table.py, which resets the next load to a full load
+"""
+load_state_table_create = ("""CREATE TABLE etl_load_state(dataset varchar       NOT NULL PRIMARY KEY
+                                                         , last_key varchar(1024)
+                                                         , last_modified timestamp
+                                                         , max_ts bigint
+                                                         , loaded_at timestamp     NOT NULL)
+                              DISTSTYLE ALL;
+                           """)
+
+"""
+  Rollup tables
+  Pre-aggregated answers to the example analytical queries, so dashboards don't scan songplays on every refresh
+  Kept as tables rather than materialized views: the single transaction mode swaps songplays out, which a
+    view depending on it would block, and tables refresh the same way on a local PostgreSQL
+  song_plays_daily is distributed on song_id like songs, so joining it to songs for titles doesn't move data
+"""
+song_plays_daily_table_create = ("""CREATE TABLE song_plays_daily(play_date date     SORTKEY NOT NULL
+                                                               , song_id char(19)  DISTKEY NOT NULL
+                                                               , play_count bigint         NOT NULL)
+                                    DISTSTYLE KEY;
+                                 """)
+
+location_plays_table_create = ("""CREATE TABLE location_plays(location varchar
+                                                           , play_count bigint  NOT NULL)
+                                  DISTSTYLE ALL;
+                               """)
+
+level_users_table_create = ("""CREATE TABLE level_users(level varchar      NOT NULL
+                                                     , user_count bigint  NOT NULL)
+                               DISTSTYLE ALL;
+                            """)
+
 
 # STATEMENTS TO INSERT DATA TO STAGING TABLES AND STAR SCHEMA TABLES
 
+"""
+  Source file format; set by COPY_FORMAT in the ETL section of config file
+    'json' - original small JSON files
+    'json_gzip' - large gzip compressed newline delimited JSON files written by compact.py
+    'parquet' - large Parquet files written by compact.py
+  Compacted files already use lowercase column names in table order, so neither format needs the JSON path file
+  copy_file_suffixes are used to list source files of the selected format on S3
+  COPY statements depend on config, so they're kept as templates here and rendered by QueryRegistry below
+"""
+copy_file_suffixes = {'json': '.json', 'json_gzip': '.json.gz', 'parquet': '.parquet'}
+# Columns the JSON path file maps the source fields to, in the order it lists them
+staging_events_copy_columns = ("""(artist, auth, firstname, gender, iteminsession, lastname, length, level, location, method, page
+                                , registration, sessionid, song, status, ts, useragent, userid)""")
+
+staging_events_formats = {'json': "FORMAT AS JSON '{log_jsonpath}'",
+                          'json_gzip': "FORMAT AS JSON 'auto' GZIP",
+                          'parquet': "FORMAT AS PARQUET"}
+staging_songs_formats = {'json': "FORMAT AS JSON 'auto'",
+                         'json_gzip': "FORMAT AS JSON 'auto' GZIP",
+                         'parquet': "FORMAT AS PARQUET"}
+
+"""
+  COMPUPDATE OFF keeps the column encodings declared above instead of sampling every load for compression
+    analysis; Redshift would only apply its choice to an empty table without encodings anyway
+  STATUPDATE OFF skips the statistics update at the end of every COPY into the staging tables. Setting
+    COPY_CALIBRATE in the ETL section of config file turns it on for a one-time calibration load, so later
+    loads plan their joins with the statistics of a representative load; column_encodings.py --calibrate
+    then checks the declared encodings against ANALYZE COMPRESSION
+"""
+copy_statistics_options = {False: "COMPUPDATE OFF STATUPDATE OFF",
+                           True: "COMPUPDATE OFF STATUPDATE ON"}
+
 """
   Copying log data from S3
   Files are in JSON format
   JSON path file is needed as data source contains Camel case headers; Redshift only supports lowercase headers
-  Source data path, IAM Role ARN, and JSON path file details are sourced from config file using config parser
+  Source data path, IAM Role ARN, and JSON path file details are sourced from config file
 """
-staging_events_copy = ("""COPY staging_events FROM '{}'
-                          CREDENTIALS 'aws_iam_role={}'
-                          FORMAT AS JSON '{}'
-                          region 'us-west-2';
-                       """).format(config['S3']['LOG_DATA'],config['IAM_ROLE']['ARN'],config['S3']['LOG_JSONPATH'])
+staging_events_copy_template = ("""COPY staging_events {columns} FROM '{log_data}'
+                                   CREDENTIALS 'aws_iam_role={iam_role}'
+                                   {format}
+                                   {copy_options}
+                                   region 'us-west-2';
+                                """)
 
 """
   Copying songs data from S3
   Files are in JSON format
   JSON Paths file not required as headers match Redshift format and can be mapped to table column names
-  Source data path and IAM Role ARN details are sourced from config file using config parser
+  Source data path and IAM Role ARN details are sourced from config file
+"""
+staging_songs_copy_template = ("""COPY staging_songs FROM '{song_data}'
+                                  CREDENTIALS 'aws_iam_role={iam_role}'
+                                  {format}
+                                  {copy_options}
+                                  region 'us-west-2';
+                               """)
+
+"""
+  Manifest COPY templates
+  Same as the COPY statements above but read only the files listed in a manifest generated by etl.py
+  IAM Role ARN and file format details are sourced from config file; manifest path is filled in at run time
+"""
+staging_events_manifest_copy_template = ("""COPY staging_events {columns} FROM '{{}}'
+                                            CREDENTIALS 'aws_iam_role={iam_role}'
+                                            {format}
+                                            {copy_options}
+                                            MANIFEST
+                                            region 'us-west-2';
+                                         """)
+
+staging_songs_manifest_copy_template = ("""COPY staging_songs FROM '{{}}'
+                                           CREDENTIALS 'aws_iam_role={iam_role}'
+                                           {format}
+                                           {copy_options}
+                                           MANIFEST
+                                           region 'us-west-2';
+                                        """)
+
+"""
+  Staging tables only hold the current load; emptied before every COPY, full or incremental
+"""
+staging_events_truncate = "TRUNCATE staging_events;"
+staging_songs_truncate = "TRUNCATE staging_songs;"
+
 """
-staging_songs_copy = ("""COPY staging_songs FROM '{}'
-                         CREDENTIALS 'aws_iam_role={}'
-                         FORMAT AS JSON 'auto'
-                         region 'us-west-2';
-                      """).format(config['S3']['SONG_DATA'],config['IAM_ROLE']['ARN'])
+  Song match key
+    md5 of lower-cased, trimmed title and artist name and the duration rounded to 2 decimals
+    Rounding absorbs float noise that made exact duration equality silently drop matches
+    compact.song_match_key() computes the same value in Python at transform time
+"""
+def song_match_key_sql(title, artist, duration):
+    return ("md5(lower(trim({})) || '|' || lower(trim({})) || '|' || cast(cast({} AS decimal(12, 2)) AS varchar))"
+            .format(title, artist, duration))
+
+"""
+  Keyed staging table only holds the current load; emptied before it's rebuilt after each COPY
+"""
+staging_plays_truncate = "TRUNCATE staging_plays;"
+
+"""
+  Writes the NextSong events of staging_events to staging_plays with their song match key
+  Events missing the title, artist, or length can't match a song and are left out rather than keyed NULL
+"""
+staging_plays_insert = ("""INSERT INTO staging_plays(match_key, ts, start_time, user_id, level, session_id, location, user_agent)
+                           SELECT {}
+                                , ts
+                                , timestamp 'epoch' + (ts/1000) * interval '1 second'
+                                , userid, level, sessionid, location, useragent
+                           FROM staging_events
+                           WHERE page = 'NextSong'
+                             AND ts IS NOT NULL
+                             AND song IS NOT NULL
+                             AND artist IS NOT NULL
+                             AND length IS NOT NULL;
+                        """).format(song_match_key_sql('song', 'artist', 'length'))
+
+"""
+  Diagnostic count of NextSong events in staging with no matching song; run once songs is loaded
+  Returns (NextSong events, unmatched events)
+"""
+unmatched_events_select = ("""SELECT n.nextsong
+                                   , n.nextsong - m.matched
+                              FROM (SELECT count(*) AS nextsong
+                                    FROM staging_events
+                                    WHERE page = 'NextSong') n
+                              CROSS JOIN (SELECT count(*) AS matched
+                                          FROM staging_plays p
+                                          WHERE EXISTS (SELECT 1
+                                                        FROM songs s
+                                                        WHERE s.match_key = p.match_key)) m;
+                           """)
 
 """
   Songplays table is populated using Events and Songs staging tables
   timestamp is converted to date time type as redshift stores and processes it efficiently
   Page value of 'NextSong' is used to identify records of song plays
+  Events are matched to songs on the match_key stored in songs, the same join the incremental merge uses
 """
 songplay_table_insert = ("""INSERT INTO songplays(start_time, user_id, level, song_id, artist_id
                                                 , session_id, location, user_agent)
-                            SELECT DISTINCT timestamp 'epoch' + (e.ts/1000) * interval '1 second'
-                                          , e.userid, e.level, s.song_id, s.artist_id, e.sessionid
-                                          , e.location, e.useragent
-                            FROM staging_events e
-                            INNER JOIN staging_songs s
-                              ON (s.title = e.song
-                                  AND s.duration = e.length
-                                  AND s.artist_name = e.artist)
-                            WHERE e.page = 'NextSong';
+                            SELECT DISTINCT p.start_time, p.user_id, p.level, s.song_id, s.artist_id, p.session_id
+                                          , p.location, p.user_agent
+                            FROM staging_plays p
+                            INNER JOIN songs s
+                              ON (s.match_key = p.match_key);
                          """)
 
 """
-  Using users_max_ts as temp table to store only the latest User records using max timestamp
-"""                            
-user_table_max_ts_insert = ("""INSERT INTO users_max_ts(userid, mx_ts)
-                               SELECT userid, max(ts) mx_ts 
-                               FROM staging_events 
-                               WHERE userid IS NOT NULL
-                               GROUP BY userid;
-                            """)
+  Builds the statement that upserts the latest record of each user in staging_events into users
+  Latest record is picked in a single pass using ROW_NUMBER() over each user's events, newest ts first;
+    iteminsession breaks ties between events sharing the same ts so exactly one row is kept per user
+  Existing users get their level and details updated in place, new users are inserted
+  Dialects:
+    'redshift' - DELETE of the staged users followed by INSERT, run in one transaction by a single execute()
+                 DELETE only reads the userid column of staging_events, so the one full scan is the INSERT
+    'postgres' - INSERT ... ON CONFLICT DO UPDATE; rendered for postgres targets through DIALECT_STATEMENTS
+"""
+def user_table_upsert_sql(dialect='redshift', source='staging_events', target='users'):
+    latest = ("""SELECT userid, firstname, lastname, gender, level
+                 FROM (SELECT userid, firstname, lastname, gender, level
+                            , ROW_NUMBER() OVER (PARTITION BY userid ORDER BY ts DESC, iteminsession DESC) AS rn
+                       FROM {source}
+                       WHERE userid IS NOT NULL) e
+                 WHERE e.rn = 1""").format(source=source)
+    if dialect == 'redshift':
+        return ("""DELETE FROM {target}
+                   USING {source} e
+                   WHERE {target}.user_id = e.userid;
+                   INSERT INTO {target}(user_id, first_name, last_name, gender, level)
+                   {latest};
+                """).format(target=target, source=source, latest=latest)
+    if dialect == 'postgres':
+        return ("""INSERT INTO {target}(user_id, first_name, last_name, gender, level)
+                   {latest}
+                   ON CONFLICT (user_id) DO UPDATE
+                   SET first_name = EXCLUDED.first_name
+                     , last_name = EXCLUDED.last_name
+                     , gender = EXCLUDED.gender
+                     , level = EXCLUDED.level;
+                """).format(target=target, latest=latest)
+    raise ValueError("Unsupported dialect: {}".format(dialect))
 
 """
-  staging_events table joined to users_max_ts table to identify and insert only latest User details   
+  Latest User details from staging_events replace existing users; used by both full and incremental loads
 """
-user_table_insert = ("""INSERT INTO users(user_id, first_name, last_name, gender, level)
-                        SELECT e.userid, e.firstname, e.lastname, e.gender, e.level
-                        FROM staging_events e
-                        INNER JOIN users_max_ts mts
-                                ON (e.userid = mts.userid
-                                    AND e.ts = mts.mx_ts);
-                     """)
+user_table_upsert = user_table_upsert_sql()
 
-song_table_insert = ("""INSERT INTO songs(song_id, title, artist_id, year, duration)
-                        SELECT song_id, title, artist_id, year, duration
-                        FROM staging_songs;
-                     """)
+"""
+  Content hash of a dimension row: md5 of its column values
+  Each value is prefixed with '=' so NULL ('null') and empty values hash differently
+"""
+def content_hash_sql(columns):
+    return "md5({})".format(" || '|' || ".join("coalesce('=' || cast({} AS varchar), 'null')".format(c) for c in columns))
 
-artist_table_insert = ("""INSERT INTO artists(artist_id, name, location, latitude, longitude)
-                          SELECT DISTINCT artist_id, artist_name, artist_location, artist_latitude
-                                        , artist_longitude
-                          FROM staging_songs;
-                       """)
+"""
+  Builds the statements that bring songs up to date with source, a table with the staging_songs columns
+  One row is kept per song_id; when several source rows share a song_id, the lowest content hash wins
+    so the same row is picked on every run
+  Songs whose content hash differs from the stored one are updated in place, new song_ids are inserted,
+    and unchanged songs aren't written at all; run in one transaction by a single execute(), like user_table_upsert
+  The song match key is stored with the kept row, from that row's artist name; the artist name is part of the
+    content hash, so a changed name rewrites the key
+  Used by full, incremental, and streaming loads (the streaming load passes its temporary table as source)
+"""
+def song_table_upsert_sql(source='staging_songs'):
+    content_hash = content_hash_sql(['title', 'artist_id', 'year', 'duration', 'artist_name'])
+    latest = ("""SELECT song_id, title, artist_id, year, duration, {match_key} AS match_key, content_hash
+                 FROM (SELECT song_id, title, artist_id, year, duration, artist_name, {content_hash} AS content_hash
+                            , ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY {content_hash}) AS rn
+                       FROM {source}
+                       WHERE song_id IS NOT NULL) s
+                 WHERE s.rn = 1""").format(match_key=song_match_key_sql('title', 'artist_name', 'duration'),
+                                           content_hash=content_hash, source=source)
+    return ("""UPDATE songs
+               SET title = s.title, artist_id = s.artist_id, year = s.year, duration = s.duration
+                 , match_key = s.match_key, content_hash = s.content_hash
+               FROM ({latest}) s
+               WHERE songs.song_id = s.song_id
+                 AND (songs.content_hash IS NULL OR songs.content_hash <> s.content_hash);
+               INSERT INTO songs(song_id, title, artist_id, year, duration, match_key, content_hash)
+               SELECT s.song_id, s.title, s.artist_id, s.year, s.duration, s.match_key, s.content_hash
+               FROM ({latest}) s
+               WHERE NOT EXISTS (SELECT 1 FROM songs d WHERE d.song_id = s.song_id);
+            """).format(latest=latest)
+
+"""
+  Builds the statements that bring artists up to date with source, the same way as song_table_upsert_sql()
+  Song files repeat their artist's details, which may differ between files, so one canonical row is kept
+    per artist_id: rows with coordinates first, then rows with a location, then the lowest content hash
+  The stored artists row competes with the source rows, so a later load only replaces it with a row that ranks
+    higher; when the stored row wins, its content hash is unchanged and it isn't written
+"""
+def artist_table_upsert_sql(source='staging_songs'):
+    content_hash = content_hash_sql(['artist_name', 'artist_location', 'artist_latitude', 'artist_longitude'])
+    latest = ("""SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude, content_hash
+                 FROM (SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+                            , {content_hash} AS content_hash
+                            , ROW_NUMBER() OVER (PARTITION BY artist_id
+                                                 ORDER BY CASE WHEN artist_latitude IS NULL OR artist_longitude IS NULL
+                                                               THEN 1 ELSE 0 END
+                                                        , CASE WHEN coalesce(artist_location, '') = '' THEN 1 ELSE 0 END
+                                                        , {content_hash}) AS rn
+                       FROM (SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+                             FROM {source}
+                             WHERE artist_id IS NOT NULL
+                             UNION ALL
+                             SELECT a.artist_id, a.name, a.location, a.latitude, a.longitude
+                             FROM artists a
+                             WHERE a.artist_id IN (SELECT artist_id FROM {source})) c) s
+                 WHERE s.rn = 1""").format(content_hash=content_hash, source=source)
+    return ("""UPDATE artists
+               SET name = s.artist_name, location = s.artist_location, latitude = s.artist_latitude
+                 , longitude = s.artist_longitude, content_hash = s.content_hash
+               FROM ({latest}) s
+               WHERE artists.artist_id = s.artist_id
+                 AND (artists.content_hash IS NULL OR artists.content_hash <> s.content_hash);
+               INSERT INTO artists(artist_id, name, location, latitude, longitude, content_hash)
+               SELECT s.artist_id, s.artist_name, s.artist_location, s.artist_latitude, s.artist_longitude, s.content_hash
+               FROM ({latest}) s
+               WHERE NOT EXISTS (SELECT 1 FROM artists d WHERE d.artist_id = s.artist_id);
+            """).format(latest=latest)
+
+song_table_upsert = song_table_upsert_sql()
+artist_table_upsert = artist_table_upsert_sql()
 
 """
   Redshift doesn't have any pre-defined method to convert string to timestamp
@@ -251,20 +507,549 @@ artist_table_insert = ("""INSERT INTO artists(artist_id, name, location, latitud
     ts is in miliseconds hence it is divided by 1000 to convert to seconds and then multiplied 
         by "Interval '1 second'", resulting in the interval of ts seconds since epoch
     Result from interval calc is added to epoch which returns the proper Redshift Timestamp for ts
+  Single scan build of the time dimension
+    Only NextSong events are read, as those are the only timestamps songplays references
+    ts/1000 is de-duplicated before conversion, so the epoch conversion runs once per distinct second
+      and every extract works off the already converted start_time
+    Timestamps already in time are skipped, so the statement serves both full and incremental loads
+    hour and dow are used in place of Redshift only hr and weekday abbreviations, so the same statement
+      also runs on PostgreSQL
 """
 time_table_insert = ("""INSERT INTO time(start_time, hour, day, week, month, year, weekday)
-                        SELECT DISTINCT (timestamp 'epoch' + (ts/1000) * interval '1 second')
-                                       , extract(hr from (timestamp 'epoch' + (ts/1000) * interval '1 second'))
-                                       , extract(day from (timestamp 'epoch' + (ts/1000) * interval '1 second'))
-                                       , extract(week from (timestamp 'epoch' + (ts/1000) * interval '1 second'))
-                                       , extract(month from (timestamp 'epoch' + (ts/1000) * interval '1 second'))
-                                       , extract(year from (timestamp 'epoch' + (ts/1000) * interval '1 second'))
-                                       , extract(weekday from (timestamp 'epoch' + (ts/1000) * interval '1 second'))
-                        FROM staging_events;
+                        SELECT t.start_time
+                             , extract(hour from t.start_time)
+                             , extract(day from t.start_time)
+                             , extract(week from t.start_time)
+                             , extract(month from t.start_time)
+                             , extract(year from t.start_time)
+                             , extract(dow from t.start_time)
+                        FROM (SELECT timestamp 'epoch' + ts_sec * interval '1 second' AS start_time
+                              FROM (SELECT DISTINCT ts/1000 AS ts_sec
+                                    FROM staging_events
+                                    WHERE page = 'NextSong'
+                                      AND ts IS NOT NULL) e
+                             ) t
+                        WHERE NOT EXISTS (SELECT 1 FROM time d WHERE d.start_time = t.start_time);
+                     """)
+
+
+# STATEMENTS TO MERGE AN INCREMENTAL LOAD INTO STAR SCHEMA TABLES
+# Staging tables only hold new files, so each statement merges just the new rows into existing tables
+# Every statement can be rerun after a failure without creating duplicates
+
+"""
+  staging_songs only holds new song files, so events are matched against the match_key stored in songs,
+    the same key a full load matches on
+  Events at or below the max_ts high-water mark have already been merged and are skipped
+"""
+songplay_merge_select = ("""SELECT DISTINCT p.start_time, p.user_id, p.level, s.song_id, s.artist_id
+                                          , p.session_id, p.location, p.user_agent
+                            FROM staging_plays p
+                            INNER JOIN songs s
+                              ON (s.match_key = p.match_key)
+                            WHERE p.ts > (SELECT coalesce(max(max_ts), 0)
+                                          FROM etl_load_state
+                                          WHERE dataset = 'log_data')
+                         """)
+
+"""
+  The new song plays are selected once into a session temporary table; songplays and every rollup are then
+    merged from it, instead of each statement repeating the join against songs and artists
+  Dropped first, as a temporary table lasts until the session ends
+"""
+new_songplays_drop = "DROP TABLE IF EXISTS new_songplays;"
+new_songplays_create = "CREATE TEMP TABLE new_songplays AS {};".format(songplay_merge_select)
+
+songplay_table_merge = ("""INSERT INTO songplays(start_time, user_id, level, song_id, artist_id
+                                               , session_id, location, user_agent)
+                           SELECT start_time, user_id, level, song_id, artist_id, session_id, location, user_agent
+                           FROM new_songplays;
+                        """)
+
+songplay_merge_queries = [new_songplays_drop, new_songplays_create, songplay_table_merge]
+
+"""
+  High-water mark queries for etl_load_state
+  Written in the same transaction as songplay_merge_queries so a failed run never advances the mark
+"""
+load_state_select = ("""SELECT last_key, last_modified, max_ts
+                        FROM etl_load_state
+                        WHERE dataset = %s;
+                     """)
+
+staging_events_max_ts_select = "SELECT max(ts) FROM staging_events;"
+
+"""
+  Number of slices in the cluster; manifests are sized to a multiple of it so every slice loads files
+"""
+slice_count_select = "SELECT count(*) FROM stv_slices;"
+
+load_state_delete = "DELETE FROM etl_load_state WHERE dataset = %s;"
+
+load_state_insert = ("""INSERT INTO etl_load_state(dataset, last_key, last_modified, max_ts, loaded_at)
+                        VALUES (%s, %s, %s, %s, getdate());
+                     """)
+
+# EXAMPLE ANALYTICAL QUERIES
+# Same queries as the README; used as the default workload by tools that model or benchmark end-user queries
+
+top_songs_select = ("""SELECT s.title, count(sp.songplay_id) play_count
+                       FROM songplays sp, songs s
+                       WHERE sp.song_id = s.song_id
+                       GROUP BY s.title
+                       ORDER BY play_count DESC
+                       LIMIT 10;
+                    """)
+
+top_locations_select = ("""SELECT sp.location, count(sp.songplay_id) play_count
+                           FROM songplays sp
+                           GROUP BY sp.location
+                           ORDER BY play_count DESC
+                           LIMIT 10;
+                        """)
+
+users_by_level_select = ("""SELECT u.level, count(u.user_id) user_count
+                            FROM users u
+                            GROUP BY u.level;
+                         """)
+
+# ROLLUP REFRESH
+# Each rollup groups song plays by its key columns and counts them
+# Full loads rebuild the rollups from songplays; incremental loads add the song plays merged in the current run,
+#   read from the new_songplays temporary table the merge filled, in the same transaction
+rollups = [{'table': 'song_plays_daily', 'keys': [('play_date', "cast(sp.start_time AS date)"), ('song_id', "sp.song_id")],
+            'nullable': []},
+           {'table': 'location_plays', 'keys': [('location', "sp.location")],
+            'nullable': ['location']}]
+
+"""
+  Counts song plays of source per rollup key; source is songplays or a subquery with the same columns
+"""
+def rollup_delta_sql(rollup, source):
+    return ("""SELECT {columns}, count(*) AS play_count
+               FROM {source} sp
+               GROUP BY {group}""").format(columns=', '.join("{} AS {}".format(expr, name) for name, expr in rollup['keys']),
+                                           source=source, group=', '.join(expr for _, expr in rollup['keys']))
+
+"""
+  Statements that rebuild a rollup from every row in songplays
+"""
+def rollup_rebuild_sql(rollup):
+    return ["DELETE FROM {};".format(rollup['table']),
+            "INSERT INTO {}({}, play_count) {};".format(rollup['table'], ', '.join(name for name, _ in rollup['keys']),
+                                                       rollup_delta_sql(rollup, 'songplays'))]
+
+"""
+  Statements that add the song plays of source to a rollup: counts of keys already in the rollup are increased,
+    new keys are inserted; nullable keys are compared NULL-safe, as song plays may have no location
+"""
+def rollup_merge_sql(rollup, source):
+    def match(table):
+        return ' AND '.join(("({0}.{1} = d.{1} OR ({0}.{1} IS NULL AND d.{1} IS NULL))" if name in rollup['nullable']
+                             else "{0}.{1} = d.{1}").format(table, name) for name, _ in rollup['keys'])
+
+    delta = rollup_delta_sql(rollup, source)
+    return [("""UPDATE {table}
+                SET play_count = {table}.play_count + d.play_count
+                FROM ({delta}) d
+                WHERE {match};
+             """).format(table=rollup['table'], delta=delta, match=match(rollup['table'])),
+            ("""INSERT INTO {table}({keys}, play_count)
+                SELECT d.*
+                FROM ({delta}) d
+                WHERE NOT EXISTS (SELECT 1 FROM {table} r WHERE {match});
+             """).format(table=rollup['table'], keys=', '.join(name for name, _ in rollup['keys']), delta=delta, match=match('r'))]
+
+"""
+  users is small, so the level counts are always rebuilt in full
+"""
+level_users_rebuild = ["DELETE FROM level_users;",
+                       """INSERT INTO level_users(level, user_count)
+                          SELECT u.level, count(u.user_id)
+                          FROM users u
+                          GROUP BY u.level;
+                       """]
+
+rollup_rebuild_queries = [q for rollup in rollups for q in rollup_rebuild_sql(rollup)] + level_users_rebuild
+rollup_merge_queries = [q for rollup in rollups for q in rollup_merge_sql(rollup, 'new_songplays')] + level_users_rebuild
+
+# ROLLUP QUERIES
+# Same answers as the example analytical queries, read from the rollup tables
+
+top_songs_rollup_select = ("""SELECT s.title, sum(r.play_count) play_count
+                              FROM song_plays_daily r, songs s
+                              WHERE r.song_id = s.song_id
+                              GROUP BY s.title
+                              ORDER BY play_count DESC
+                              LIMIT 10;
+                           """)
+
+top_locations_rollup_select = ("""SELECT r.location, r.play_count
+                                  FROM location_plays r
+                                  ORDER BY r.play_count DESC
+                                  LIMIT 10;
+                               """)
+
+users_by_level_rollup_select = ("""SELECT r.level, r.user_count
+                                   FROM level_users r;
+                                """)
+
+# STREAMING LOAD
+# Statements used when stream.py transforms new files in Python instead of copying them into staging tables
+# Transformed rows are sent in bounded batches by psycopg2 execute_values(), which fills in the VALUES %s placeholder,
+#   into session temporary tables that only hold finished rows; each table is then merged with one statement
+
+stream_songs_create = "CREATE TEMP TABLE stream_songs (LIKE staging_songs);"
+stream_time_create = "CREATE TEMP TABLE stream_time (LIKE time);"
+stream_songplays_create = ("""CREATE TEMP TABLE stream_songplays(start_time timestamp
+                                                                , user_id int
+                                                                , level varchar
+                                                                , song_id char(19)
+                                                                , artist_id char(19)
+                                                                , session_id int
+                                                                , location varchar
+                                                                , user_agent varchar);
+                           """)
+stream_table_drops = ["DROP TABLE IF EXISTS stream_songs;", "DROP TABLE IF EXISTS stream_time;",
+                      "DROP TABLE IF EXISTS stream_songplays;"]
+
+stream_songs_insert = ("""INSERT INTO stream_songs(song_id, title, artist_id, year, duration, artist_name
+                                                  , artist_location, artist_latitude, artist_longitude) VALUES %s""")
+stream_time_insert = "INSERT INTO stream_time(start_time, hour, day, week, month, year, weekday) VALUES %s"
+stream_songplays_insert = ("""INSERT INTO stream_songplays(start_time, user_id, level, song_id, artist_id
+                                                         , session_id, location, user_agent) VALUES %s""")
+
+"""
+  Song lookup index: the match key stored with every song, the same key full and incremental loads match on
+"""
+song_index_select = ("""SELECT s.match_key, s.song_id, s.artist_id
+                        FROM songs s
+                        WHERE s.match_key IS NOT NULL;
+                     """)
+
+"""
+  Latest details of each user in the new events replace existing ones, like user_table_upsert
+  psycopg2 expands a tuple parameter into the IN list
+"""
+user_stream_delete = "DELETE FROM users WHERE user_id IN %s;"
+user_stream_insert = "INSERT INTO users(user_id, first_name, last_name, gender, level) VALUES %s"
+
+time_stream_merge = ("""INSERT INTO time(start_time, hour, day, week, month, year, weekday)
+                        SELECT DISTINCT t.start_time, t.hour, t.day, t.week, t.month, t.year, t.weekday
+                        FROM stream_time t
+                        WHERE NOT EXISTS (SELECT 1 FROM time d WHERE d.start_time = t.start_time);
+                     """)
+
+"""
+  Song plays repeated within the same second are kept once, like the SELECT DISTINCT of songplay_merge_select
+"""
+stream_songplays_select = ("""SELECT DISTINCT start_time, user_id, level, song_id, artist_id, session_id, location
+                                            , user_agent
+                              FROM stream_songplays""")
+songplay_stream_merge = ("""INSERT INTO songplays(start_time, user_id, level, song_id, artist_id
+                                                , session_id, location, user_agent)
+                            {};
+                         """).format(stream_songplays_select)
+
+stream_merge_queries = [song_table_upsert_sql('stream_songs'), artist_table_upsert_sql('stream_songs')]
+rollup_stream_queries = ([q for rollup in rollups for q in rollup_merge_sql(rollup, "({})".format(stream_songplays_select))]
+                         + level_users_rebuild)
+
+# SHADOW TABLE SWAP
+# Single transaction mode rebuilds the star schema tables in shadow tables and swaps them in at the end
+# Readers keep seeing the old tables until the one commit; a failure rolls back and leaves them untouched
+# ALTER TABLE ... APPEND would avoid rewriting data but can't run inside a transaction block, so RENAME is used
+# Dropping the old tables drops their GRANTs, so the grants are read before the swap and applied to the new tables
+# Views bound to the old tables would block the DROP; only late-binding views (WITH NO SCHEMA BINDING) are supported
+
+# Star schema tables in create order; songplays comes last as it references the dimension tables
+star_table_creates = [('users', user_table_create), ('songs', song_table_create), ('artists', artist_table_create),
+                      ('time', time_table_create), ('songplays', songplay_table_create)]
+star_tables = tuple(name for name, _ in star_table_creates)
+
+star_table_pattern = re.compile(r'\b({})\b'.format('|'.join(name for name, _ in star_table_creates)))
+
+"""
+  Rewrites a statement to use the shadow copy of every star schema table it names
+  e.g. INSERT INTO songs ... becomes INSERT INTO songs_shadow ...; staging tables and columns such as start_time
+    are left alone as only whole table names match
+"""
+def shadow_sql(query, suffix='_shadow'):
+    return star_table_pattern.sub(lambda m: m.group(1) + suffix, query)
+
+"""
+  Statements that drop leftover shadow tables from a failed run and create empty ones
+"""
+def shadow_create_queries(suffix='_shadow'):
+    drops = ["DROP TABLE IF EXISTS {}{};".format(name, suffix) for name, _ in reversed(star_table_creates)]
+    return drops + [shadow_sql(create, suffix) for _, create in star_table_creates]
+
+"""
+  Statements that replace the star schema tables with their shadow copies
+  Old tables are dropped songplays first, as it references the others, then the shadow tables take their names
+"""
+def shadow_swap_queries(suffix='_shadow'):
+    drops = ["DROP TABLE {};".format(name) for name, _ in reversed(star_table_creates)]
+    return drops + ["ALTER TABLE {}{} RENAME TO {};".format(name, suffix, name) for name, _ in star_table_creates]
+
+"""
+  Privileges granted on the star schema tables, one row per grantee and privilege
+"""
+table_grants_select = ("""SELECT relation_name, privilege_type, identity_type, identity_name
+                          FROM svv_relation_privileges
+                          WHERE namespace_name = current_schema()
+                            AND relation_name IN %s;
+                       """)
+
+"""
+  Local PostgreSQL stand-in for svv_relation_privileges, built from information_schema.table_privileges
+  PostgreSQL grants to roles only, so every grantee other than PUBLIC is reported as a user
+"""
+relation_privileges_stub_create = ("""CREATE OR REPLACE VIEW svv_relation_privileges AS
+                                      SELECT table_schema::varchar AS namespace_name
+                                           , table_name::varchar AS relation_name
+                                           , privilege_type::varchar AS privilege_type
+                                           , CASE WHEN grantee = 'PUBLIC' THEN 'public' ELSE 'user' END::varchar AS identity_type
+                                           , grantee::varchar AS identity_name
+                                      FROM information_schema.table_privileges;
+                                   """)
+
+"""
+  Regular views reading the star schema tables; DROP TABLE fails while any of them exists
+  Late-binding views have no dependency recorded, so they aren't listed and keep working after the swap
+"""
+dependent_views_select = ("""SELECT DISTINCT v.relname, t.relname
+                             FROM pg_depend d
+                             JOIN pg_rewrite r ON r.oid = d.objid
+                             JOIN pg_class v ON v.oid = r.ev_class
+                             JOIN pg_class t ON t.oid = d.refobjid
+                             JOIN pg_namespace n ON n.oid = t.relnamespace
+                             WHERE v.relkind = 'v'
+                               AND v.oid <> t.oid
+                               AND n.nspname = current_schema()
+                               AND t.relname IN %s
+                             ORDER BY 1, 2;
+                          """)
+
+granted_privileges = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REFERENCES', 'TRIGGER', 'TRUNCATE', 'ALTER', 'DROP')
+
+"""
+  GRANT statement repeating one row of table_grants_select on a table
+  Returns None for privileges that can't be granted on a table one at a time (e.g. RULE)
+"""
+def grant_sql(table, privilege, identity_type, identity_name):
+    if privilege.upper() not in granted_privileges:
+        return None
+    grantee = {'public': 'PUBLIC',
+               'group': 'GROUP "{}"'.format(identity_name),
+               'role': 'ROLE "{}"'.format(identity_name)}.get(identity_type.lower(), '"{}"'.format(identity_name))
+    return "GRANT {} ON {} TO {};".format(privilege.upper(), table, grantee)
+
+# TABLE MAINTENANCE
+# Repeated loads leave an unsorted region and deleted rows behind, and statistics drift from the data
+# maintenance.py reads svv_table_info after each load and vacuums or analyzes only the tables past its thresholds
+# VACUUM can't run inside a transaction block, so these statements run on a connection in autocommit mode
+
+"""
+  Star schema and rollup tables; staging tables are emptied on every load and not maintained
+"""
+maintained_tables = [name for name, _ in star_table_creates] + [rollup['table'] for rollup in rollups] + ['level_users']
+
+"""
+  Per table unsorted percentage, statistics staleness percentage, and row counts
+  tbl_rows includes rows marked for deletion, estimated_visible_rows doesn't; the difference is what VACUUM DELETE reclaims
+"""
+table_info_select = ("""SELECT "table", unsorted, stats_off, tbl_rows, estimated_visible_rows
+                        FROM svv_table_info
+                        WHERE "table" IN %s;
                      """)
 
+"""
+  Local PostgreSQL stand-in for svv_table_info, built from pg_stat_user_tables
+  PostgreSQL tables have no sort order, so unsorted is always 0; dead tuples stand in for deleted rows,
+    and rows modified since the last ANALYZE for stale statistics
+"""
+table_info_stub_create = ("""CREATE OR REPLACE VIEW svv_table_info AS
+                             SELECT relname::varchar AS "table"
+                                  , 0.0 AS unsorted
+                                  , 100.0 * n_mod_since_analyze / greatest(n_live_tup, 1) AS stats_off
+                                  , n_live_tup + n_dead_tup AS tbl_rows
+                                  , n_live_tup AS estimated_visible_rows
+                             FROM pg_stat_user_tables;
+                          """)
+
+"""
+  VACUUM FULL both sorts and reclaims deleted rows in one pass, so it replaces the two ONLY variants
+    when a table is past both thresholds
+"""
+def vacuum_sql(table, sort=True, delete=True):
+    return "VACUUM {} {};".format('FULL' if sort and delete else 'SORT ONLY' if sort else 'DELETE ONLY', table)
+
+def analyze_sql(table):
+    return "ANALYZE {} PREDICATE COLUMNS;".format(table)
+
 # QUERY LISTS
-create_table_queries = [staging_events_table_create, staging_songs_table_create, user_table_max_ts_create, user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create]
-drop_table_queries = [user_table_max_ts_drop, staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
-copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [user_table_max_ts_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert, songplay_table_insert]
+create_table_queries = [staging_events_table_create, staging_songs_table_create, staging_plays_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create, load_state_table_create, song_plays_daily_table_create, location_plays_table_create, level_users_table_create]
+drop_table_queries = [user_table_max_ts_drop, staging_events_table_drop, staging_songs_table_drop, staging_plays_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, load_state_table_drop, song_plays_daily_table_drop, location_plays_table_drop, level_users_table_drop]
+# Keyed staging table is emptied, then rebuilt from staging_events after every COPY
+keyed_table_truncates = [staging_plays_truncate]
+match_key_queries = [staging_plays_insert]
+analytical_queries = [top_songs_select, top_locations_select, users_by_level_select]
+# Rollup query answering each example analytical query, in the same order
+rollup_queries = [top_songs_rollup_select, top_locations_rollup_select, users_by_level_rollup_select]
+insert_table_queries = [user_table_upsert, song_table_upsert, artist_table_upsert, time_table_insert, songplay_table_insert]
+# songplay_merge_queries are left out as they run in the same transaction as the high-water mark update
+merge_table_queries = [user_table_upsert, song_table_upsert, artist_table_upsert, time_table_insert]
+# Single transaction mode runs the same inserts against the shadow tables
+shadow_create_table_queries = shadow_create_queries()
+shadow_insert_table_queries = [shadow_sql(query) for query in insert_table_queries]
+shadow_swap_table_queries = shadow_swap_queries()
+
+# INSERT QUERY DEPENDENCIES
+# Tables each insert query reads from and writes to; list order matches insert_table_queries
+# etl.py uses these to work out which inserts are independent and can run at the same time
+#   e.g. songs and artists both only read staging_songs and write different tables, so they run at the same time
+insert_table_steps = [{'name': 'user_table_upsert', 'query': user_table_upsert, 'reads': ['staging_events'], 'writes': ['users']},
+                      {'name': 'song_table_upsert', 'query': song_table_upsert, 'reads': ['staging_songs'], 'writes': ['songs']},
+                      {'name': 'artist_table_upsert', 'query': artist_table_upsert, 'reads': ['staging_songs'], 'writes': ['artists']},
+                      {'name': 'time_table_insert', 'query': time_table_insert, 'reads': ['staging_events'], 'writes': ['time']},
+                      {'name': 'songplay_table_insert', 'query': songplay_table_insert, 'reads': ['staging_plays', 'songs'], 'writes': ['songplays']}]
+
+
+# QUERY REGISTRY
+
+"""
+  Rewrites a Redshift statement so it runs on a local PostgreSQL
+  Drops distribution, sort key, backup, and column encoding options, and maps the Redshift only
+    IDENTITY column, getdate(), VACUUM and ANALYZE options, and datepart abbreviations to their PostgreSQL equivalents
+"""
+def postgres_sql(sql):
+    sql = re.sub(r'\b(DISTKEY|SORTKEY|BACKUP NO)\b', '', sql)
+    sql = re.sub(r'\b(DISTSTYLE|ENCODE) \w+', '', sql)
+    sql = re.sub(r'\bIDENTITY\(\s*\d+\s*,\s*\d+\s*\)', 'GENERATED BY DEFAULT AS IDENTITY', sql)
+    sql = sql.replace('getdate()', 'now()')
+    sql = re.sub(r'\bVACUUM (FULL|SORT ONLY|DELETE ONLY)\b', 'VACUUM', sql)
+    sql = sql.replace(' PREDICATE COLUMNS', '')
+    sql = re.sub(r'extract\(hr from', 'extract(hour from', sql)
+    return re.sub(r'extract\(weekday from', 'extract(dow from', sql)
+
+DIALECTS = {'redshift': lambda sql: sql,
+            'postgres': postgres_sql}
+
+"""
+  Statements a dialect runs in place of a Redshift one, keyed by the Redshift statement
+  Swapped in wherever that statement is rendered, including inside lists and insert steps
+"""
+DIALECT_STATEMENTS = {'postgres': {user_table_upsert: user_table_upsert_sql('postgres'),
+                                   shadow_sql(user_table_upsert): shadow_sql(user_table_upsert_sql('postgres'))}}
+
+"""
+Purpose:
+    Renders the statements defined in this file for a target, reading the config file only once and only when needed
+    A target picks its settings from config sections named '<SECTION>:<target>' (e.g. [S3:staging]), falling back
+      to the plain section for keys it doesn't override; the default target (None) only reads the plain sections
+    DIALECT in the target's ETL section selects 'redshift' (default) or 'postgres'; the 'postgres' target uses the
+      postgres dialect without any config, so tables and inserts can be run against a local stand-in
+    Rendered statements are memoized per target; lists and insert steps are rendered element by element
+Arg:
+    path - config file read on first use [Optional]
+    config - already parsed config; skips reading the file [Optional]
+"""
+class QueryRegistry:
+    def __init__(self, path='dwh.cfg', config=None):
+        self.path = path
+        self._config = config
+        self._cache = {}
+        self._lock = threading.RLock()
+
+    # Replaces the config, e.g. with the one etl.py already parsed, and forgets statements rendered from the old one
+    def use_config(self, config):
+        with self._lock:
+            self._config = config
+            self._cache = {}
+
+    @property
+    def config(self):
+        with self._lock:
+            if self._config is None:
+                config = configparser.ConfigParser()
+                config.read(self.path)
+                self._config = config
+            return self._config
+
+    def option(self, section, key, target=None, fallback=None):
+        for name in (["{}:{}".format(section, target)] if target else []) + [section]:
+            if self.config.has_option(name, key):
+                return self.config.get(name, key)
+        if fallback is None:
+            raise KeyError("{} not set in {} section of {}".format(key, section, self.path))
+        return fallback
+
+    def dialect(self, target=None):
+        return self.option('ETL', 'DIALECT', target, fallback='postgres' if target == 'postgres' else 'redshift')
+
+    def get(self, name, target=None):
+        key = (name, target)
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = self._render(name, target)
+            return self._cache[key]
+
+    def _render(self, name, target):
+        if name in CONFIG_RENDERERS:
+            return CONFIG_RENDERERS[name](self, target)
+        value = globals()[name]
+        if callable(value):
+            value = value()
+        dialect = self.dialect(target)
+        if dialect == 'redshift':
+            return value
+        statements = DIALECT_STATEMENTS.get(dialect, {})
+        convert = lambda sql: statements[sql] if sql in statements else DIALECTS[dialect](sql)
+        if isinstance(value, str):
+            return convert(value)
+        return [dict(v, query=convert(v['query'])) if isinstance(v, dict) else convert(v) for v in value]
+
+    def copy_settings(self, target=None):
+        if self.dialect(target) != 'redshift':
+            raise ValueError("COPY from S3 is only supported by Redshift targets")
+        copy_format = self.option('ETL', 'COPY_FORMAT', target, fallback='json')
+        iam_role = self.option('IAM_ROLE', 'ARN', target)
+        events_format = staging_events_formats[copy_format]
+        if copy_format == 'json':
+            events_format = events_format.format(log_jsonpath=self.option('S3', 'LOG_JSONPATH', target))
+        calibrate = self.config.BOOLEAN_STATES[self.option('ETL', 'COPY_CALIBRATE', target, fallback='false').lower()]
+        return {'columns': staging_events_copy_columns if copy_format == 'json' else '', 'iam_role': iam_role,
+                'events_format': events_format, 'songs_format': staging_songs_formats[copy_format],
+                'copy_options': copy_statistics_options[calibrate]}
+
+"""
+  Statements and settings that depend on config, rendered by QueryRegistry
+"""
+CONFIG_RENDERERS = {
+    'copy_format': lambda r, t: r.option('ETL', 'COPY_FORMAT', t, fallback='json'),
+    'copy_file_suffix': lambda r, t: copy_file_suffixes[r.get('copy_format', t)],
+    'staging_events_copy': lambda r, t: staging_events_copy_template.format(
+        log_data=r.option('S3', 'LOG_DATA', t), format=r.copy_settings(t)['events_format'], **r.copy_settings(t)),
+    'staging_songs_copy': lambda r, t: staging_songs_copy_template.format(
+        song_data=r.option('S3', 'SONG_DATA', t), format=r.copy_settings(t)['songs_format'], **r.copy_settings(t)),
+    'staging_events_manifest_copy': lambda r, t: staging_events_manifest_copy_template.format(
+        format=r.copy_settings(t)['events_format'], **r.copy_settings(t)),
+    'staging_songs_manifest_copy': lambda r, t: staging_songs_manifest_copy_template.format(
+        format=r.copy_settings(t)['songs_format'], **r.copy_settings(t)),
+    'copy_table_queries': lambda r, t: [r.get('staging_events_copy', t), r.get('staging_songs_copy', t)],
+}
+
+"""
+  Registry used by etl.py and the module level names below
+"""
+registry = QueryRegistry()
+
+"""
+  Keeps 'from sql_queries import staging_events_copy' and the other config dependent names working;
+    they're rendered for the default target on first access instead of at import
+"""
+def __getattr__(name):
+    if name in CONFIG_RENDERERS:
+        return registry.get(name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,212 @@
+import gzip                     # Decompresses json_gzip source objects while reading them
+import json                     # Parse source records
+from datetime import datetime, timedelta                    # Converts event ts to start_time
+from psycopg2.extras import execute_values                  # Multi-row INSERT batches
+from compact import table_columns, to_row, song_match_key   # Source record validation and song match key, same as compact.py
+from sql_queries import staging_events_table_create, staging_songs_table_create     # Staging table definitions
+from sql_queries import song_index_select, user_stream_delete, user_stream_insert    # Streaming load SQL query definitions
+
+"""
+  Redshift timestamp epoch; start_time is the epoch plus ts seconds, as in time_table_insert
+"""
+EPOCH = datetime(1970, 1, 1)
+
+"""
+  staging_songs columns sent to stream_songs, in the order of stream_songs_insert
+"""
+SONG_COLUMNS = ('song_id', 'title', 'artist_id', 'year', 'duration', 'artist_name', 'artist_location',
+                'artist_latitude', 'artist_longitude')
+
+"""
+Purpose:
+    Yields the lines of an S3 object as it is downloaded; '.gz' objects are decompressed on the fly
+Arg:
+    s3 - boto3 S3 client, or manifest.LocalS3Client [Required]
+    bucket - S3 bucket [Required]
+    key - S3 key [Required]
+"""
+def object_lines(s3, bucket, key):
+    body = s3.get_object(Bucket=bucket, Key=key)['Body']
+    try:
+        if key.endswith('.gz'):
+            yield from gzip.GzipFile(fileobj=body)
+        else:
+            yield from body.iter_lines()
+    finally:
+        body.close()
+
+"""
+Purpose:
+    Yields records from a source object one at a time, like compact.read_records() does for local files
+    Log files hold one JSON object per line; song files hold a single object which may span lines,
+      so the object is read again as a whole when a line doesn't parse
+Arg:
+    s3 - boto3 S3 client [Required]
+    bucket - S3 bucket [Required]
+    key - S3 key [Required]
+"""
+def read_object_records(s3, bucket, key):
+    try:
+        for line in object_lines(s3, bucket, key):
+            if line.strip():
+                yield json.loads(line)
+        return
+    except json.JSONDecodeError:
+        pass
+    yield json.loads(b''.join(object_lines(s3, bucket, key)))
+
+"""
+Purpose:
+    Converts an event ts in milliseconds to start_time, truncated to the second like the SQL conversion
+Arg:
+    ts - epoch milliseconds [Required]
+"""
+def start_time(ts):
+    return EPOCH + timedelta(seconds=ts // 1000)
+
+"""
+Purpose:
+    Builds a time dimension row; week is the ISO week and weekday counts from Sunday = 0,
+      the same values extract(week) and extract(dow) return
+Arg:
+    start - start_time [Required]
+"""
+def time_row(start):
+    return (start, start.hour, start.day, start.isocalendar()[1], start.month, start.year, start.isoweekday() % 7)
+
+"""
+Purpose:
+    Sends rows to the database in batches of at most batch_rows with execute_values(), so only one batch
+      is held in memory
+    Rows repeated within a batch are sent once; the merge statements drop repeats across batches
+Arg:
+    cur - Redshift connection cursor [Required]
+    query - INSERT ... VALUES %s statement [Required]
+    batch_rows - rows sent per statement [Required]
+"""
+class BatchWriter:
+    def __init__(self, cur, query, batch_rows):
+        self.cur = cur
+        self.query = query
+        self.batch_rows = batch_rows
+        self.batch = {}
+        self.rows = 0
+
+    def add(self, row):
+        self.batch[row] = None
+        if len(self.batch) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            execute_values(self.cur, self.query, list(self.batch), page_size=len(self.batch))
+            self.rows += len(self.batch)
+            self.batch = {}
+
+"""
+Purpose:
+    In-memory hash index from song match key to (song_id, artist_id), read from the songs and artists tables
+    Keys are kept as 16 byte digests; memory grows with the songs dimension, not with the files being loaded
+Arg:
+    cur - Redshift connection cursor [Required]
+    fetch_rows - rows fetched from the cursor at a time [Optional]
+"""
+class SongIndex:
+    def __init__(self, cur, fetch_rows=10000):
+        self.songs = {}
+        cur.execute(song_index_select)
+        rows = cur.fetchmany(fetch_rows)
+        while rows:
+            for match_key, song_id, artist_id in rows:
+                self.songs[bytes.fromhex(match_key)] = (song_id, artist_id)
+            rows = cur.fetchmany(fetch_rows)
+
+    def __len__(self):
+        return len(self.songs)
+
+    def get(self, match_key):
+        return self.songs.get(bytes.fromhex(match_key)) if match_key else None
+
+"""
+Purpose:
+    Sends song records to stream_songs; records that don't fit the staging_songs columns are rejected,
+      as COPY would reject them
+Arg:
+    writer - BatchWriter of stream_songs_insert [Required]
+    records - iterable of source song records [Required]
+Returns:
+    number of rejected records
+"""
+def stream_songs(writer, records):
+    columns = table_columns(staging_songs_table_create)
+    rejected = 0
+    for record in records:
+        row = to_row(record, columns) if isinstance(record, dict) else None
+        if row is None:
+            rejected += 1
+            continue
+        writer.add(tuple(row[name] for name in SONG_COLUMNS))
+    return rejected
+
+"""
+Purpose:
+    Transforms event records in a single pass, the same way the staging INSERT statements do
+      - users: latest record of each user, newest ts first with iteminsession breaking ties, kept in users
+      - time: one row per NextSong second, sent to stream_time
+      - songplays: NextSong events after max_ts whose title, artist, and length match a song in index,
+          sent to stream_songplays
+Arg:
+    time_writer - BatchWriter of stream_time_insert [Required]
+    songplay_writer - BatchWriter of stream_songplays_insert [Required]
+    records - iterable of source event records [Required]
+    index - SongIndex [Required]
+    max_ts - high-water mark; events at or below it are already in songplays [Required]
+    users - dict of user id to (order, users row), updated in place [Required]
+    stats - dict of counts, updated in place [Required]
+"""
+def stream_events(time_writer, songplay_writer, records, index, max_ts, users, stats):
+    columns = table_columns(staging_events_table_create)
+    for record in records:
+        e = to_row(record, columns) if isinstance(record, dict) else None
+        if e is None:
+            stats['rejected'] += 1
+            continue
+        stats['events'] += 1
+        ts = e['ts']
+        if ts is not None and (stats['max_ts'] is None or ts > stats['max_ts']):
+            stats['max_ts'] = ts
+
+        if e['userid'] is not None:
+            order = (ts if ts is not None else -1, e['iteminsession'] if e['iteminsession'] is not None else -1)
+            latest = users.get(e['userid'])
+            if latest is None or order > latest[0]:
+                users[e['userid']] = (order, (e['userid'], e['firstname'], e['lastname'], e['gender'], e['level']))
+
+        if e['page'] != 'NextSong' or ts is None:
+            continue
+        start = start_time(ts)
+        time_writer.add(time_row(start))
+        if ts <= max_ts:
+            continue
+        stats['nextsong'] += 1
+        song = index.get(song_match_key(e['song'], e['artist'], e['length']))
+        if song is None:
+            stats['unmatched'] += 1
+            continue
+        songplay_writer.add((start, e['userid'], e['level'], song[0], song[1], e['sessionid'], e['location'],
+                             e['useragent']))
+
+"""
+Purpose:
+    Replaces the users found in the new events with their latest record, batch_rows users per statement
+Arg:
+    cur - Redshift connection cursor [Required]
+    users - dict of user id to (order, users row) filled in by stream_events() [Required]
+    batch_rows - users per DELETE and INSERT statement [Required]
+"""
+def upsert_users(cur, users, batch_rows):
+    user_ids = list(users)
+    for start in range(0, len(user_ids), batch_rows):
+        batch = user_ids[start:start + batch_rows]
+        cur.execute(user_stream_delete, (tuple(batch),))
+        execute_values(cur, user_stream_insert, [users[user_id][1] for user_id in batch], page_size=len(batch))
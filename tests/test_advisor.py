@@ -0,0 +1,16 @@
+from advisor import parse_create, analyze_query                 # Code under test
+from sql_queries import songplay_table_create, user_table_create    # Table designs the queries run against
+
+TABLES = {table['name']: table for table in map(parse_create, [songplay_table_create, user_table_create])}
+
+
+def test_group_by_at_end_of_query():
+    usage = analyze_query("SELECT u.level, count(*) FROM songplays sp JOIN users u ON sp.user_id = u.user_id "
+                          "GROUP BY u.level;", TABLES)
+    assert usage['group_by'] == [('users', 'level')]
+    assert usage['joins'] == [(('songplays', 'user_id'), ('users', 'user_id'))]
+
+
+def test_group_by_list_ending_the_query():
+    usage = analyze_query("SELECT session_id, song_id, count(*) FROM songplays\nGROUP BY session_id, song_id ;\n", TABLES)
+    assert usage['group_by'] == [('songplays', 'session_id'), ('songplays', 'song_id')]
@@ -0,0 +1,26 @@
+import random                   # Repeatable sampled values
+from column_encodings import choose_encoding     # Code under test
+
+AGENTS = ['Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{}.0 Safari/537.36'.format(v)
+          for v in range(40)]
+
+
+def test_near_tie_goes_to_zstd():
+    # Four user agents in random order: BYTEDICT is the smallest estimate, but by well under BYTEDICT_MIN_SAVING
+    rng = random.Random(0)
+    encoding, sizes = choose_encoding('varchar', [rng.choice(AGENTS[:4]) for _ in range(5000)])
+    assert sizes['bytedict'] < sizes['zstd'] < 1.05 * sizes['bytedict']
+    assert encoding == 'zstd'
+
+
+def test_clear_bytedict_saving_is_kept():
+    rng = random.Random(0)
+    distinct = [''.join(rng.choice('0123456789abcdef') for _ in range(64)) for _ in range(100)]
+    encoding, sizes = choose_encoding('varchar', [rng.choice(distinct) for _ in range(5000)])
+    assert encoding == 'bytedict'
+
+
+def test_sort_key_and_numbers_skip_estimates():
+    assert choose_encoding('varchar', AGENTS, sortkey=True) == ('raw', {})
+    assert choose_encoding('bigint', [1, 2, 3]) == ('az64', {})
+    assert choose_encoding('varchar', [None, None]) == ('zstd', {})
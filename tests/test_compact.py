@@ -0,0 +1,116 @@
+import gzip                     # Read compacted output
+import hashlib                  # Expected match key
+import json                     # Write source files and read compacted records
+import os                       # Part file names; database to compare the SQL match key with
+import pytest                   # Test runner
+from compact import table_columns, to_row, song_match_key, compact_shard, PartWriter    # Code under test
+from sql_queries import staging_songs_table_create, staging_events_table_create, song_match_key_sql    # Staging tables
+
+SONG = {"num_songs": 1, "artist_id": "ARJIE2Y1187B994AB7", "artist_latitude": None, "artist_longitude": None,
+        "artist_location": "", "artist_name": "Line Renaud", "song_id": "SOUPIRU12A6D4FA1E1",
+        "title": "Der Kleine Dompfaff", "duration": 152.92036, "year": 0}
+
+EVENTS = [{"artist": None, "auth": "Logged Out", "firstName": None, "gender": None, "itemInSession": 0, "lastName": None,
+           "length": None, "level": "free", "location": None, "method": "PUT", "page": "Login", "registration": None,
+           "sessionId": 52, "song": None, "status": 307, "ts": 1541207073796, "userAgent": None, "userId": ""},
+          {"artist": "Line Renaud", "auth": "Logged In", "firstName": "Celeste", "gender": "F", "itemInSession": 1,
+           "lastName": "Williams", "length": 152.92036, "level": "free", "location": "Klamath Falls, OR", "method": "PUT",
+           "page": "NextSong", "registration": 1541077528796.0, "sessionId": 438, "song": "Der Kleine Dompfaff",
+           "status": 200, "ts": 1541990217796, "userAgent": "Mozilla/5.0", "userId": "53"}]
+
+
+def write_json(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+    return str(path)
+
+
+def read_parts(parts):
+    rows = []
+    for part in parts:
+        with gzip.open(part['path'], 'rt', encoding='utf-8') as f:
+            rows.append([json.loads(line) for line in f])
+    return rows
+
+
+def test_table_columns_use_redshift_length_defaults():
+    columns = {name: (col_type, length) for name, col_type, length in table_columns(staging_events_table_create)}
+    assert columns['gender'] == ('char', 1)
+    assert columns['artist'] == ('varchar', 256)
+    assert columns['ts'] == ('bigint', None)
+    assert [name for name, _, _ in table_columns(staging_songs_table_create)] == list(SONG)
+
+
+def test_to_row_maps_camel_case_keys_and_empty_user_id():
+    columns = table_columns(staging_events_table_create)
+    logged_out, played = (to_row(event, columns) for event in EVENTS)
+    assert logged_out['userid'] is None and logged_out['sessionid'] == 52 and logged_out['iteminsession'] == 0
+    assert played['userid'] == 53 and played['firstname'] == 'Celeste' and played['useragent'] == 'Mozilla/5.0'
+    assert played['registration'] == 1541077528796
+    assert set(played) == {name for name, _, _ in columns}
+
+
+def test_to_row_rejects_values_that_dont_fit():
+    columns = table_columns(staging_songs_table_create)
+    assert to_row(SONG, columns) is not None
+    assert to_row(dict(SONG, title='x' * 257), columns) is None
+    # Lengths are in bytes, like Redshift's
+    assert to_row(dict(SONG, title='é' * 128), columns) is not None
+    assert to_row(dict(SONG, title='é' * 129), columns) is None
+    assert to_row(dict(SONG, artist_id='A' * 20), columns) is None
+    assert to_row(dict(SONG, year='unknown'), columns) is None
+    assert to_row(dict(SONG, year=1.5), columns) is None
+
+
+def test_compact_shard_round_trips_json(tmp_path):
+    files = [write_json(tmp_path / 'log_data' / '2018-11-12-events.json', '\n'.join(json.dumps(e) for e in EVENTS) + '\n'),
+             write_json(tmp_path / 'log_data' / '2018-11-13-events.json', json.dumps(dict(EVENTS[1], userId='x')) + '\n')]
+    stats = compact_shard({'dataset': 'log_data', 'files': files, 'output_dir': str(tmp_path), 'shard': 0,
+                           'format': 'json_gzip', 'target_bytes': 1024 * 1024})
+    assert (stats['files'], stats['records'], stats['rejected']) == (2, 2, 1)
+    assert [os.path.basename(part['path']) for part in stats['parts']] == ['log_data-000-0000.json.gz']
+    columns = table_columns(staging_events_table_create)
+    assert read_parts(stats['parts']) == [[to_row(event, columns) for event in EVENTS]]
+
+
+def test_compact_shard_reads_song_files_spanning_lines(tmp_path):
+    files = [write_json(tmp_path / 'song_data' / 'A' / 'TRAAAAW128F429D538.json', json.dumps(SONG, indent=2))]
+    stats = compact_shard({'dataset': 'song_data', 'files': files, 'output_dir': str(tmp_path), 'shard': 1,
+                           'format': 'json_gzip', 'target_bytes': 1024 * 1024})
+    assert read_parts(stats['parts']) == [[SONG]]
+    assert stats['parts'][0]['records'] == 1
+
+
+def test_parts_roll_over_at_target_bytes(tmp_path):
+    columns = table_columns(staging_songs_table_create)
+    row = to_row(SONG, columns)
+    line_bytes = len(json.dumps(row)) + 1
+    writer = PartWriter(str(tmp_path), 'song_data-000', columns, 'json_gzip', target_bytes=2 * line_bytes)
+    for _ in range(5):
+        writer.write(row)
+    writer.close()
+    assert [(os.path.basename(part['path']), part['records']) for part in writer.parts] == [
+        ('song_data-000-0000.json.gz', 2), ('song_data-000-0001.json.gz', 2), ('song_data-000-0002.json.gz', 1)]
+    assert read_parts(writer.parts) == [[row] * 2, [row] * 2, [row]]
+
+
+def test_song_match_key_rounds_half_up():
+    # 123.455 is stored as 123.45499..., but rounds to 123.46 like the SQL cast of the float to decimal(12, 2)
+    expected = hashlib.md5("der kleine dompfaff|line renaud|123.46".encode('utf-8')).hexdigest()
+    assert song_match_key(' Der Kleine Dompfaff ', 'Line Renaud', 123.455) == expected
+    assert song_match_key('Der Kleine Dompfaff', None, 123.455) is None
+
+
+def test_song_match_key_matches_sql():
+    if not os.environ.get('TEST_DSN'):
+        pytest.skip("TEST_DSN not set")
+    psycopg2 = pytest.importorskip('psycopg2')
+    conn = psycopg2.connect(os.environ['TEST_DSN'])
+    try:
+        with conn.cursor() as cur:
+            for duration in (123.455, 152.92036, 0.005, 218.125):
+                cur.execute("SELECT {} FROM (SELECT %s::varchar AS title, %s::varchar AS artist, %s::float AS duration) s;"
+                            .format(song_match_key_sql('title', 'artist', 'duration')), (' Der Kleine Dompfaff ', 'Line Renaud', duration))
+                assert cur.fetchone()[0] == song_match_key(' Der Kleine Dompfaff ', 'Line Renaud', duration)
+    finally:
+        conn.close()
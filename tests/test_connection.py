@@ -0,0 +1,172 @@
+import pytest                   # Test runner
+
+psycopg2 = pytest.importorskip('psycopg2')                            # Real error types the manager classifies
+from psycopg2.extensions import QueryCanceledError                    # Raised when statement_timeout cancels a statement
+import connection                                                     # Code under test
+from connection import ConnectionManager, Checkpoint                  # Code under test
+
+"""
+  Fake DB-API database: every connection it opens shares one list of errors, raised in order by the next
+    execute() calls on any connection; an error raised with closed=True also closes its connection, like a
+    dropped network connection does
+"""
+class FakeDatabase:
+    def __init__(self):
+        self.conns = []
+        self.errors = []
+        self.executed = []
+
+    def connect(self, **kwargs):
+        conn = FakeConnection(self)
+        self.conns.append(conn)
+        return conn
+
+    def fail(self, error, times=1, closed=False):
+        self.errors.extend([(error, closed)] * times)
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+
+    def execute(self, query, params=None):
+        if self.conn.closed:
+            raise psycopg2.InterfaceError("connection already closed")
+        if self.conn.db.errors:
+            error, closed = self.conn.db.errors.pop(0)
+            self.conn.closed = self.conn.closed or closed
+            raise error
+        self.conn.db.executed.append((self.conn, query, self.conn.autocommit))
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+        self.autocommit = False
+        self.closed = False
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def db(monkeypatch):
+    # No jitter, so the delays passed to sleep are the plain exponential backoff
+    monkeypatch.setattr(connection.random, 'uniform', lambda low, high: high)
+    return FakeDatabase()
+
+
+def open_manager(db, sleeps, **kwargs):
+    return ConnectionManager({}, connect=db.connect, sleep=sleeps.append, **kwargs).open()
+
+
+def test_transient_errors_are_retried_with_backoff(db):
+    sleeps = []
+    manager = open_manager(db, sleeps, retries=3, backoff=2.0, max_backoff=5.0)
+    db.fail(psycopg2.OperationalError("server closed the connection"), times=3)
+    manager.run("INSERT INTO songs SELECT 1;", 'insert')
+    assert sleeps == [2.0, 4.0, 5.0]
+    assert [query for _, query, _ in db.executed] == ["INSERT INTO songs SELECT 1;"]
+    assert db.conns[0].rollbacks == 3
+    assert db.conns[0].commits == 1
+
+
+def test_retries_give_up_after_the_last_attempt(db):
+    sleeps = []
+    manager = open_manager(db, sleeps, retries=2, backoff=1.0)
+    db.fail(psycopg2.OperationalError("timeout expired"), times=3)
+    with pytest.raises(psycopg2.OperationalError):
+        manager.run("INSERT INTO songs SELECT 1;", 'insert')
+    assert sleeps == [1.0, 2.0]
+    assert db.executed == []
+    assert db.conns[0].rollbacks == 3
+
+
+def test_closed_connection_is_replaced(db):
+    sleeps = []
+    manager = open_manager(db, sleeps, retries=1, backoff=1.0)
+    old = db.conns[0]
+    db.fail(psycopg2.InterfaceError("connection already closed"), closed=True)
+    manager.run("INSERT INTO songs SELECT 1;", 'insert')
+    assert len(db.conns) == 2
+    new = db.conns[1]
+    assert old.closed and not new.closed
+    assert manager.conns == [new]
+    assert [conn for conn, _, _ in db.executed] == [new]
+    # The replacement goes back into the pool, not the closed connection
+    assert manager.pool.get_nowait() is new
+
+
+def test_query_canceled_by_statement_timeout_is_not_retried(db):
+    sleeps = []
+    manager = open_manager(db, sleeps, retries=3)
+    db.fail(QueryCanceledError("canceling statement due to statement timeout"))
+    with pytest.raises(QueryCanceledError):
+        manager.run("INSERT INTO songplays SELECT 1;", 'insert')
+    assert sleeps == []
+    assert db.conns[0].rollbacks == 1
+
+
+def test_other_errors_roll_back_without_retry(db):
+    sleeps = []
+    manager = open_manager(db, sleeps, retries=3)
+    db.fail(psycopg2.ProgrammingError("relation \"songs\" does not exist"))
+    with pytest.raises(psycopg2.ProgrammingError):
+        manager.run("INSERT INTO songs SELECT 1;", 'insert')
+    assert sleeps == []
+    assert db.conns[0].rollbacks == 1
+    assert db.conns[0].commits == 0
+
+
+def test_checkpoint_skips_completed_and_records_new_keys(db, tmp_path):
+    path = tmp_path / 'etl_checkpoint.txt'
+    path.write_text("copy:COPY staging_events\n")
+    checkpoint = Checkpoint(str(path))
+    manager = open_manager(db, [], checkpoint=checkpoint)
+    assert manager.run("COPY staging_events FROM 's3://bucket/log_data';", 'copy') is None
+    manager.run("COPY staging_songs FROM 's3://bucket/song_data';", 'copy')
+    assert [query for _, query, _ in db.executed] == ["COPY staging_songs FROM 's3://bucket/song_data';"]
+    assert path.read_text().splitlines() == ["copy:COPY staging_events", "copy:COPY staging_songs"]
+    assert "copy:COPY staging_songs" in Checkpoint(str(path))
+
+
+def test_failed_unit_is_not_checkpointed(db, tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'etl_checkpoint.txt'))
+    manager = open_manager(db, [], retries=0, checkpoint=checkpoint)
+    db.fail(psycopg2.OperationalError("server closed the connection"))
+    with pytest.raises(psycopg2.OperationalError):
+        manager.run("INSERT INTO songs SELECT 1;", 'insert')
+    assert "insert:INSERT INTO songs" not in checkpoint
+    assert not (tmp_path / 'etl_checkpoint.txt').exists()
+
+
+def test_autocommit_is_reset_after_work(db):
+    manager = open_manager(db, [])
+    manager.run("VACUUM songs;", 'maintenance', autocommit=True)
+    conn = db.conns[0]
+    assert db.executed == [(conn, "VACUUM songs;", True)]
+    assert conn.autocommit is False
+    # An open transaction is rolled back before autocommit is switched on
+    assert conn.rollbacks == 1
+
+
+def test_autocommit_is_reset_after_failure(db):
+    manager = open_manager(db, [], retries=0)
+    db.fail(psycopg2.ProgrammingError("VACUUM cannot run inside a transaction block"))
+    with pytest.raises(psycopg2.ProgrammingError):
+        manager.run("VACUUM songs;", 'maintenance', autocommit=True)
+    assert db.conns[0].autocommit is False
+    assert manager.pool.get_nowait() is db.conns[0]
@@ -0,0 +1,120 @@
+from explain import parse_plan, summarize, compare_summaries, compare_plans    # Code under test
+
+"""
+  Recorded EXPLAIN output of top_songs_select: Redshift with songplays and songs both distributed on song_id,
+    Redshift after songs lost its distribution key, and PostgreSQL
+"""
+REDSHIFT_PLAN = """XN Limit  (cost=1000000000311.58..1000000000311.61 rows=10 width=40)
+  ->  XN Merge  (cost=1000000000311.58..1000000000312.08 rows=200 width=40)
+        Merge Key: count(*)
+        ->  XN Network  (cost=1000000000311.58..1000000000312.08 rows=200 width=40)
+              Send to leader
+              ->  XN Sort  (cost=1000000000311.58..1000000000312.08 rows=200 width=40)
+                    Sort Key: count(*)
+                    ->  XN HashAggregate  (cost=302.44..303.94 rows=200 width=40)
+                          ->  XN Hash Join DS_DIST_NONE  (cost=12.80..300.14 rows=460 width=32)
+                                Hash Cond: ("outer".song_id = "inner".song_id)
+                                ->  XN Seq Scan on songplays sp  (cost=0.00..4.60 rows=460 width=23)
+                                ->  XN Hash  (cost=10.24..10.24 rows=1024 width=44)
+                                      ->  XN Seq Scan on songs s  (cost=0.00..10.24 rows=1024 width=44)"""
+
+REDSHIFT_REGRESSED_PLAN = """XN Limit  (cost=1000004000311.58..1000004000311.61 rows=10 width=40)
+  ->  XN Merge  (cost=1000004000311.58..1000004000312.08 rows=200 width=40)
+        Merge Key: count(*)
+        ->  XN Network  (cost=1000004000311.58..1000004000312.08 rows=200 width=40)
+              Send to leader
+              ->  XN Sort  (cost=1000004000311.58..1000004000312.08 rows=200 width=40)
+                    Sort Key: count(*)
+                    ->  XN HashAggregate  (cost=4000302.44..4000303.94 rows=200 width=40)
+                          ->  XN Nested Loop DS_BCAST_INNER  (cost=0.00..4000300.14 rows=460 width=32)
+                                Join Filter: ("outer".song_id = "inner".song_id)
+                                ->  XN Seq Scan on songplays sp  (cost=0.00..4.60 rows=460 width=23)
+                                ->  XN Hash Join DS_DIST_BOTH  (cost=12.80..20.48 rows=1024 width=44)
+                                      Hash Cond: ("outer".artist_id = "inner".artist_id)
+                                      ->  XN Seq Scan on songs s  (cost=0.00..10.24 rows=1024 width=44)
+                                      ->  XN Hash  (cost=10.24..10.24 rows=1024 width=21)
+                                            ->  XN Seq Scan on artists a  (cost=0.00..10.24 rows=1024 width=21)
+----- Nested Loop Join in the query plan - review the join predicates to avoid Cartesian products -----"""
+
+POSTGRES_PLAN = """Limit  (cost=107.94..107.97 rows=10 width=40)
+  ->  Sort  (cost=107.94..108.44 rows=200 width=40)
+        Sort Key: (count(*)) DESC
+        ->  HashAggregate  (cost=101.62..103.62 rows=200 width=40)
+              Group Key: s.title
+              ->  Hash Join  (cost=87.04..100.32 rows=260 width=32)
+                    Hash Cond: (sp.song_id = s.song_id)
+                    ->  Seq Scan on songplays sp  (cost=0.00..12.60 rows=260 width=80)
+                    ->  Hash  (cost=74.24..74.24 rows=1024 width=112)
+                          ->  Seq Scan on songs s  (cost=0.00..74.24 rows=1024 width=112)"""
+
+
+def ops(node):
+    return [node['op'], [ops(child) for child in node['children']]]
+
+
+def test_redshift_plan_nests_by_indent():
+    plan = parse_plan(REDSHIFT_PLAN)
+    assert ops(plan) == ['Limit', [['Merge', [['Network', [['Sort', [['HashAggregate', [
+        ['Hash Join', [['Seq Scan', []], ['Hash', [['Seq Scan', []]]]]]]]]]]]]]]]
+    assert plan['total_cost'] == 1000000000311.61 and plan['rows'] == 10 and plan['width'] == 40
+    assert plan['warnings'] == []
+    network = plan['children'][0]['children'][0]
+    assert network['details'] == ['Send to leader']
+    join = network['children'][0]['children'][0]['children'][0]
+    assert join['dist'] == 'DS_DIST_NONE'
+    assert join['details'] == ['Hash Cond: ("outer".song_id = "inner".song_id)']
+    assert [child['relation'] for child in join['children']] == ['songplays', None]
+
+
+def test_redshift_plan_collects_data_movement_and_warnings():
+    plan = parse_plan(REDSHIFT_REGRESSED_PLAN)
+    assert plan['warnings'] == ['Nested Loop Join in the query plan - review the join predicates to avoid Cartesian products']
+    summary = summarize(plan)
+    assert summary['data_movement'] == {'Nested Loop DS_BCAST_INNER': 1, 'Hash Join DS_DIST_BOTH': 1}
+    assert summary['nested_loops'] == 1
+    # DS_DIST_NONE joins don't move data
+    assert summarize(parse_plan(REDSHIFT_PLAN))['data_movement'] == {}
+
+
+def test_postgres_plan():
+    plan = parse_plan(POSTGRES_PLAN)
+    assert ops(plan) == ['Limit', [['Sort', [['HashAggregate', [['Hash Join', [['Seq Scan', []], ['Hash', [['Seq Scan', []]]]]]]]]]]]
+    join = plan['children'][0]['children'][0]['children'][0]
+    assert join['dist'] is None
+    assert [node['relation'] for node in (join['children'][0], join['children'][1]['children'][0])] == ['songplays', 'songs']
+    assert summarize(plan) == {'cost': 107.97, 'rows': 10, 'data_movement': {}, 'nested_loops': 0}
+
+
+def test_text_without_plan_nodes():
+    assert parse_plan("ERROR: relation \"songs\" does not exist\n") is None
+
+
+def test_compare_summaries():
+    baseline = summarize(parse_plan(REDSHIFT_PLAN))
+    current = summarize(parse_plan(REDSHIFT_REGRESSED_PLAN))
+    assert compare_summaries(baseline, baseline) == []
+    assert compare_summaries(baseline, current) == ["1 new Hash Join DS_DIST_BOTH step(s)",
+                                                    "1 new Nested Loop DS_BCAST_INNER step(s)",
+                                                    "1 new nested loop join(s)"]
+    # Fewer data movement steps than the baseline is not a regression
+    assert compare_summaries(current, baseline) == []
+    assert compare_summaries(dict(baseline, cost=100.0), dict(baseline, cost=151.0)) == ["cost up 1.5x (100.00 -> 151.00)"]
+    assert compare_summaries(dict(baseline, cost=100.0), dict(baseline, cost=151.0), cost_increase=2.0) == []
+
+
+def test_compare_plans_reports_regressions_against_baseline():
+    baseline = {'statements': {'analytical:SELECT songs': {'query': 'SELECT ...', 'plan': REDSHIFT_PLAN},
+                               'insert:INSERT INTO time': {'query': 'INSERT ...', 'plan': REDSHIFT_PLAN},
+                               'insert:INSERT INTO users': {'query': 'INSERT ...', 'error': 'relation "users" does not exist'}}}
+    current = {'statements': {'analytical:SELECT songs': {'query': 'SELECT ...', 'plan': REDSHIFT_REGRESSED_PLAN},
+                              'insert:INSERT INTO time': {'query': 'INSERT ...', 'plan': REDSHIFT_PLAN},
+                              'insert:INSERT INTO users': {'query': 'INSERT ...', 'plan': POSTGRES_PLAN},
+                              'rollup:INSERT INTO song_plays_count': {'query': 'INSERT ...', 'plan': POSTGRES_PLAN},
+                              'merge:CREATE TABLE new_songplays': {'query': 'CREATE ...',
+                                                                   'error': 'relation "staging_plays" does not exist'}}}
+    assert compare_plans(baseline, current) == {
+        'analytical:SELECT songs': ["1 new Hash Join DS_DIST_BOTH step(s)", "1 new Nested Loop DS_BCAST_INNER step(s)",
+                                    "1 new nested loop join(s)"],
+        'insert:INSERT INTO users': ["no baseline plan"],
+        'rollup:INSERT INTO song_plays_count': ["no baseline plan"],
+        'merge:CREATE TABLE new_songplays': ['EXPLAIN failed: relation "staging_plays" does not exist']}
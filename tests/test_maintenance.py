@@ -0,0 +1,101 @@
+from maintenance import table_stats, plan_maintenance, run_maintenance, DEFAULT_THRESHOLDS    # Code under test
+from sql_queries import postgres_sql                                                          # PostgreSQL rewrite
+
+"""
+  svv_table_info rows: (table, unsorted, stats_off, tbl_rows, visible rows); Redshift pads table names
+  songplays is past the unsorted and deleted thresholds, songs only past unsorted, time only past deleted,
+    users only has stale statistics, and artists has no sort key (NULL unsorted) and is within every threshold
+"""
+TABLE_INFO = [('songplays   ', 35.0, 20.0, 1000000, 800000),
+              ('songs       ', 12.0, 2.0, 20000, 20000),
+              ('time        ', 0.0, 0.0, 50000, 40000),
+              ('users       ', 0.0, 15.0, 100, 100),
+              ('artists     ', None, 5.0, 10000, 9500)]
+
+"""
+  Fake connection manager and cursor: each executed statement advances the fake clock by its duration
+"""
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.rowcount = -1
+
+    def execute(self, query, params=None):
+        self.db.executed.append((query, params))
+        self.db.clock.now += self.db.durations.get(query, 0)
+
+    def fetchall(self):
+        return TABLE_INFO
+
+class FakeManager:
+    def __init__(self, durations=None):
+        self.clock = FakeClock()
+        self.durations = durations or {}
+        self.executed = []
+        self.autocommit = []
+
+    def run_transaction(self, key, work, autocommit=False):
+        self.autocommit.append(autocommit)
+        return work(FakeCursor(self))
+
+
+def test_table_stats_from_svv_table_info():
+    stats = {s['table']: s for s in table_stats(FakeCursor(FakeManager()))}
+    assert list(stats) == ['songplays', 'songs', 'time', 'users', 'artists']
+    assert stats['songplays']['deleted'] == 20.0
+    assert stats['artists'] == {'table': 'artists', 'unsorted': 0.0, 'stats_off': 5.0, 'rows': 10000, 'deleted': 5.0}
+
+
+def test_plan_vacuums_and_analyzes_tables_past_thresholds():
+    tasks = plan_maintenance(table_stats(FakeCursor(FakeManager())), DEFAULT_THRESHOLDS)
+    # Largest tables furthest past their thresholds first; a table's VACUUM before its ANALYZE
+    assert [task['query'] for task in tasks] == ["VACUUM FULL songplays;",
+                                                 "ANALYZE songplays PREDICATE COLUMNS;",
+                                                 "VACUUM DELETE ONLY time;",
+                                                 "VACUUM SORT ONLY songs;",
+                                                 "ANALYZE users PREDICATE COLUMNS;"]
+    assert not any(task['table'] == 'artists' for task in tasks)
+
+
+def test_thresholds_are_inclusive_and_configurable():
+    stats = [{'table': 'songs', 'unsorted': 10.0, 'stats_off': 9.9, 'rows': 10, 'deleted': 0.0}]
+    assert [task['action'] for task in plan_maintenance(stats, DEFAULT_THRESHOLDS)] == ['vacuum']
+    assert plan_maintenance(stats, {'unsorted': 50.0, 'deleted': 50.0, 'stats_off': 50.0}) == []
+
+
+def test_run_maintenance_within_budget():
+    db = FakeManager(durations={"VACUUM FULL songplays;": 300})
+    tasks = plan_maintenance(table_stats(FakeCursor(db)), DEFAULT_THRESHOLDS)
+    db.executed = []
+    done, skipped = run_maintenance(db, tasks, budget=900, clock=db.clock)
+    assert done == tasks and skipped == []
+    assert [query for query, _ in db.executed] == [task['query'] for task in tasks]
+    assert db.autocommit[-len(tasks):] == [True] * len(tasks)
+
+
+def test_run_maintenance_stops_when_budget_is_spent():
+    db = FakeManager(durations={"VACUUM FULL songplays;": 500, "ANALYZE songplays PREDICATE COLUMNS;": 450,
+                                "VACUUM DELETE ONLY time;": 100})
+    tasks = plan_maintenance(table_stats(FakeCursor(db)), DEFAULT_THRESHOLDS)
+    db.executed = []
+    done, skipped = run_maintenance(db, tasks, budget=900, clock=db.clock)
+    # The ANALYZE started with budget left and is allowed to finish past it; nothing starts after that
+    assert [task['query'] for task in done] == ["VACUUM FULL songplays;", "ANALYZE songplays PREDICATE COLUMNS;"]
+    assert skipped == tasks[2:]
+    assert [query for query, _ in db.executed] == ["VACUUM FULL songplays;", "ANALYZE songplays PREDICATE COLUMNS;"]
+    assert db.clock.now - 1000.0 == 950
+
+
+def test_run_maintenance_converts_for_postgres():
+    db = FakeManager()
+    tasks = plan_maintenance(table_stats(FakeCursor(db)), DEFAULT_THRESHOLDS)[:2]
+    db.executed = []
+    run_maintenance(db, tasks, budget=900, convert=postgres_sql, clock=db.clock)
+    assert [query for query, _ in db.executed] == ["VACUUM songplays;", "ANALYZE songplays;"]
@@ -0,0 +1,23 @@
+from manifest import build_manifest, pack_manifests      # Code under test
+
+OBJECTS = [{'key': 'parquet/log_data/part-{}.parquet'.format(i), 'size': 100 * (i + 1)} for i in range(6)]
+
+
+def test_pack_manifests_keeps_object_sizes():
+    manifests = pack_manifests(OBJECTS, num_slices=2, files_per_slice=2)
+    assert sum(m['files'] for m in manifests) == len(OBJECTS)
+    for m in manifests:
+        assert sorted(m['sizes']) == m['keys']
+        assert sum(m['sizes'].values()) == m['bytes']
+
+
+def test_build_manifest_writes_content_length():
+    m = pack_manifests(OBJECTS, num_slices=2, files_per_slice=10)[0]
+    manifest = build_manifest('bucket', m['keys'], m['sizes'])
+    sizes = {o['key']: o['size'] for o in OBJECTS}
+    for key, entry in zip(m['keys'], manifest['entries']):
+        assert entry == {'url': 's3://bucket/' + key, 'mandatory': True, 'meta': {'content_length': sizes[key]}}
+
+
+def test_build_manifest_without_sizes():
+    assert build_manifest('bucket', ['a.json']) == {'entries': [{'url': 's3://bucket/a.json', 'mandatory': True}]}
@@ -0,0 +1,151 @@
+import threading                # Barrier that only opens when independent steps run at the same time
+import pytest                   # Test runner
+from scheduler import build_dependencies, run_dag, run_queries_parallel    # Code under test
+
+"""
+  Steps shaped like insert_table_steps: users, songs, and artists only read staging, so they can run together;
+    songplays reads users and songs, so it has to wait for both
+"""
+STEPS = [{'name': 'staging', 'query': 'staging', 'reads': [], 'writes': ['staging']},
+         {'name': 'users', 'query': 'users', 'reads': ['staging'], 'writes': ['users']},
+         {'name': 'songs', 'query': 'songs', 'reads': ['staging'], 'writes': ['songs']},
+         {'name': 'artists', 'query': 'artists', 'reads': ['staging'], 'writes': ['artists']},
+         {'name': 'songplays', 'query': 'songplays', 'reads': ['staging', 'users', 'songs'], 'writes': ['songplays']}]
+
+INDEPENDENT = {'users', 'songs', 'artists'}
+
+"""
+Purpose:
+    Records when each step starts and finishes
+    Independent steps wait on a barrier that only opens once all of them are running, so the run fails
+      with BrokenBarrierError unless they actually overlap
+"""
+class StepLog:
+    def __init__(self, timeout=5):
+        self.lock = threading.Lock()
+        self.events = []
+        self.barrier = threading.Barrier(len(INDEPENDENT), timeout=timeout)
+
+    def run(self, name):
+        with self.lock:
+            self.events.append(('start', name))
+        if name in INDEPENDENT:
+            self.barrier.wait()
+        with self.lock:
+            self.events.append(('finish', name))
+
+    def assert_dependency_order(self, steps):
+        dependencies = build_dependencies(steps)
+        for name, required in dependencies.items():
+            started = self.events.index(('start', name))
+            for dependency in required:
+                assert self.events.index(('finish', dependency)) < started, \
+                    "{} started before {} finished".format(name, dependency)
+
+"""
+  Stand-in for ConnectionManager: size sets the worker count and run() gets each step's query
+"""
+class FakeManager:
+    def __init__(self, log, size):
+        self.log = log
+        self.size = size
+        self.keys = []
+
+    def run(self, query, stage, recorder=None, params=None, name=None, key=None, autocommit=False):
+        self.keys.append(key)
+        self.log.run(query)
+
+"""
+  DB-API connection stand-in for ConnectionManager: every executed statement is a step name
+"""
+class FakeCursor:
+    def __init__(self, log):
+        self.log = log
+        self.rowcount = 0
+
+    def execute(self, query, params=None):
+        self.log.run(query)
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self, log):
+        self.log = log
+        self.autocommit = False
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self.log)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_build_dependencies():
+    assert build_dependencies(STEPS) == {'staging': set(),
+                                         'users': {'staging'},
+                                         'songs': {'staging'},
+                                         'artists': {'staging'},
+                                         'songplays': {'staging', 'users', 'songs'}}
+
+
+def test_run_dag_orders_and_overlaps_steps():
+    log = StepLog()
+    finished = run_dag(STEPS, lambda step: log.run(step['name']), max_workers=3)
+    assert sorted(finished) == sorted(step['name'] for step in STEPS)
+    log.assert_dependency_order(STEPS)
+    # users, songs, and artists all started before any of them finished
+    starts = [log.events.index(('start', name)) for name in INDEPENDENT]
+    finishes = [log.events.index(('finish', name)) for name in INDEPENDENT]
+    assert max(starts) < min(finishes)
+
+
+def test_run_dag_stops_after_failure():
+    ran = []
+
+    def run_step(step):
+        ran.append(step['name'])
+        if step['name'] == 'staging':
+            raise RuntimeError("COPY failed")
+
+    with pytest.raises(RuntimeError):
+        run_dag(STEPS, run_step, max_workers=3)
+    assert ran == ['staging']
+
+
+def test_run_queries_parallel_with_fake_manager():
+    log = StepLog()
+    db = FakeManager(log, size=3)
+    steps = [dict(step, key='insert:' + step['name']) for step in STEPS]
+    finished = run_queries_parallel(steps, db, 'insert')
+    assert sorted(finished) == sorted(step['name'] for step in STEPS)
+    assert sorted(db.keys) == sorted(step['key'] for step in steps)
+    log.assert_dependency_order(STEPS)
+
+
+def test_run_queries_parallel_with_connection_manager():
+    pytest.importorskip('psycopg2')
+    from connection import ConnectionManager    # Needs psycopg2 for its transient error types
+
+    log = StepLog()
+    db = ConnectionManager({}, size=3, connect=lambda **kwargs: FakeConnection(log), sleep=lambda s: None).open()
+    try:
+        finished = run_queries_parallel(STEPS, db, 'insert')
+    finally:
+        db.close()
+    assert sorted(finished) == sorted(step['name'] for step in STEPS)
+    log.assert_dependency_order(STEPS)
+
+
+def test_serial_pool_cannot_overlap_independent_steps():
+    # With one worker the barrier never opens, which shows the overlap assertion above is not vacuous
+    log = StepLog(timeout=0.5)
+    with pytest.raises(threading.BrokenBarrierError):
+        run_dag(STEPS, lambda step: log.run(step['name']), max_workers=1)
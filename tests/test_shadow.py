@@ -0,0 +1,19 @@
+from sql_queries import registry, grant_sql, star_tables     # Code under test
+
+
+def test_grant_sql_per_identity_type():
+    assert grant_sql('songplays', 'select', 'group', 'analysts') == 'GRANT SELECT ON songplays TO GROUP "analysts";'
+    assert grant_sql('songplays', 'SELECT', 'role', 'bi') == 'GRANT SELECT ON songplays TO ROLE "bi";'
+    assert grant_sql('songplays', 'SELECT', 'user', 'reader') == 'GRANT SELECT ON songplays TO "reader";'
+    assert grant_sql('songplays', 'SELECT', 'public', 'PUBLIC') == 'GRANT SELECT ON songplays TO PUBLIC;'
+    assert grant_sql('songplays', 'RULE', 'user', 'reader') is None
+
+
+def test_shadow_statements_rendered_for_postgres():
+    creates = registry.get('shadow_create_table_queries', 'postgres')
+    assert len(creates) == 2 * len(star_tables)
+    assert not any(word in query for query in creates for word in ('DISTKEY', 'SORTKEY', 'ENCODE', 'IDENTITY('))
+    swaps = registry.get('shadow_swap_table_queries', 'postgres')
+    assert swaps[-1] == 'ALTER TABLE songplays_shadow RENAME TO songplays;'
+    inserts = registry.get('shadow_insert_table_queries', 'postgres')
+    assert all('_shadow' in query for query in inserts)
@@ -0,0 +1,51 @@
+import os                       # Database to run statements against
+import pytest                   # Test runner
+from sql_queries import registry, user_table_upsert, user_table_upsert_sql    # Code under test
+
+"""
+  Users before the upsert, and staged events: user 1 changes level, user 2 is new with two events sharing a ts
+    (iteminsession breaks the tie), user 3 isn't in the events, and events without a userid are ignored
+"""
+USERS = [(1, 'Ann', 'Lee', 'F', 'free'), (3, 'Bob', 'Ray', 'M', 'paid')]
+EVENTS = [(1, 'Ann', 'Lee', 'F', 'free', 1000, 0), (1, 'Ann', 'Lee', 'F', 'paid', 2000, 0),
+          (2, 'Cid', 'Moe', 'M', 'free', 3000, 0), (2, 'Cid', 'Moe', 'M', 'paid', 3000, 1),
+          (None, None, None, None, 'free', 4000, 0)]
+
+
+def test_postgres_target_renders_on_conflict_upsert():
+    postgres = user_table_upsert_sql('postgres')
+    assert registry.get('user_table_upsert', 'postgres') == postgres
+    assert postgres in registry.get('insert_table_queries', 'postgres')
+    steps = registry.get('insert_table_steps', 'postgres')
+    assert [step['query'] for step in steps if step['name'] == 'user_table_upsert'] == [postgres]
+    assert any('INTO users_shadow' in query and 'ON CONFLICT' in query
+               for query in registry.get('shadow_insert_table_queries', 'postgres'))
+
+
+def run_upsert(cur, upsert):
+    cur.execute("CREATE TEMPORARY TABLE staging_events(userid int, firstname varchar, lastname varchar, gender char"
+                ", level varchar, ts bigint, iteminsession int) ON COMMIT DROP;")
+    cur.execute(registry.get('user_table_create', 'postgres').replace('CREATE TABLE', 'CREATE TEMPORARY TABLE', 1)
+                .rstrip().rstrip(';') + ' ON COMMIT DROP;')
+    cur.executemany("INSERT INTO users VALUES (%s, %s, %s, %s, %s);", USERS)
+    cur.executemany("INSERT INTO staging_events VALUES (%s, %s, %s, %s, %s, %s, %s);", EVENTS)
+    cur.execute(upsert)
+    cur.execute("SELECT user_id, first_name, last_name, gender, level FROM users ORDER BY user_id;")
+    return cur.fetchall()
+
+
+def test_upsert_variants_give_the_same_users():
+    if not os.environ.get('TEST_DSN'):
+        pytest.skip("TEST_DSN not set")
+    psycopg2 = pytest.importorskip('psycopg2')
+    conn = psycopg2.connect(os.environ['TEST_DSN'])
+    try:
+        results = {}
+        for dialect, upsert in [('redshift', user_table_upsert), ('postgres', registry.get('user_table_upsert', 'postgres'))]:
+            with conn.cursor() as cur:
+                results[dialect] = run_upsert(cur, upsert)
+            conn.rollback()
+    finally:
+        conn.close()
+    assert results['redshift'] == results['postgres']
+    assert results['postgres'] == [(1, 'Ann', 'Lee', 'F', 'paid'), (2, 'Cid', 'Moe', 'M', 'paid'), (3, 'Bob', 'Ray', 'M', 'paid')]